@@ -0,0 +1,134 @@
+import argparse
+import math
+import os
+from pathlib import Path
+
+import numpy as np
+
+os.environ['YIRGACHEFFE_BACKEND'] = 'NUMPY'
+import yirgacheffe as yg # pylint: disable=C0413
+
+# The size in pixels of the square tiles the change mask records change for
+TILE_SIZE = 256
+
+class ChangeMask:
+    """A coarse map of where habitat changes under a scenario, with a pixel for each tile of the
+    original map that is set if any pixel in that tile changed."""
+
+    def __init__(self, mask_path: Path) -> None:
+        with yg.read_raster(mask_path) as layer:
+            self.area = layer.area
+            self.map_projection = layer.map_projection
+            self.mask = layer.read_array(0, 0, layer.window.xsize, layer.window.ysize) != 0
+
+    def changed(self, area: yg.Area) -> bool:
+        """Check whether there is any change in the given area. This is conservative, in that
+        any tile that is partly within the area counts."""
+        projection = self.map_projection
+        height, width = self.mask.shape
+        left = max(math.floor((area.left - self.area.left) / projection.xstep), 0)
+        right = min(math.ceil((area.right - self.area.left) / projection.xstep), width)
+        top = max(math.floor((area.top - self.area.top) / projection.ystep), 0)
+        bottom = min(math.ceil((area.bottom - self.area.top) / projection.ystep), height)
+        if (left >= right) or (top >= bottom):
+            return False
+        return bool(self.mask[top:bottom, left:right].any())
+
+    def changed_pixels(self, area: yg.Area, xoffset: int, yoffset: int, width: int, height: int) -> np.ndarray:
+        """Expand the mask to the pixels of a window within an area at the original map's resolution,
+        with anything outside the mask counted as a change, as we can't say that it isn't one."""
+        projection = self.map_projection
+        xstep, ystep = projection.xstep / TILE_SIZE, projection.ystep / TILE_SIZE
+        left = round((area.left - self.area.left) / xstep) + xoffset
+        top = round((area.top - self.area.top) / ystep) + yoffset
+
+        columns = (left + np.arange(width)) // TILE_SIZE
+        rows = (top + np.arange(height)) // TILE_SIZE
+        mask_height, mask_width = self.mask.shape
+        valid_columns = (columns >= 0) & (columns < mask_width)
+        valid_rows = (rows >= 0) & (rows < mask_height)
+
+        changed = np.ones((height, width), dtype=bool)
+        changed[np.ix_(valid_rows, valid_columns)] = self.mask[np.ix_(rows[valid_rows], columns[valid_columns])]
+        return changed
+
+def change_mask_path(masks_path: Path, scenario: str) -> Path:
+    return masks_path / f"{scenario}_change_mask.tif"
+
+def load_change_masks(masks_path: Path | None, scenarios: list[str]) -> dict[str, ChangeMask]:
+    """Load the change masks for the given scenarios from a directory, keyed by scenario name."""
+    if masks_path is None:
+        return {}
+    return {
+        scenario: ChangeMask(change_mask_path(masks_path, scenario))
+        for scenario in scenarios
+        if change_mask_path(masks_path, scenario).exists()
+    }
+
+def make_change_mask(
+    diff_map_path: Path,
+    output_path: Path,
+) -> None:
+    with yg.read_raster(diff_map_path) as diff_map:
+        projection = diff_map.map_projection
+        width, height = diff_map.window.xsize, diff_map.window.ysize
+        tiles_wide = math.ceil(width / TILE_SIZE)
+        tiles_high = math.ceil(height / TILE_SIZE)
+
+        mask = np.zeros((tiles_high, tiles_wide), dtype=np.uint8)
+        for tile_y in range(tiles_high):
+            yoffset = tile_y * TILE_SIZE
+            step = min(TILE_SIZE, height - yoffset)
+            # NaN is counted as a change, as we can't say that it isn't one
+            changed = (diff_map.read_array(0, yoffset, width, step) != 0).any(axis=0)
+            changed = np.pad(changed, (0, (tiles_wide * TILE_SIZE) - width))
+            mask[tile_y] = changed.reshape(tiles_wide, TILE_SIZE).any(axis=1)
+
+        left, top = diff_map.area.left, diff_map.area.top
+
+    mask_projection = yg.MapProjection(projection.name, projection.xstep * TILE_SIZE, projection.ystep * TILE_SIZE)
+    area = yg.Area(
+        left=left,
+        top=top,
+        right=left + (tiles_wide * mask_projection.xstep),
+        bottom=top + (tiles_high * mask_projection.ystep),
+        projection=mask_projection,
+    )
+    os.makedirs(output_path.parent, exist_ok=True)
+    result = yg.layers.RasterLayer.empty_raster_layer(
+        area,
+        mask_projection.scale,
+        yg.DataType.UInt8,
+        filename=output_path,
+        projection=mask_projection.name,
+    )
+    result._dataset.GetRasterBand(1).WriteArray(mask, 0, 0) # pylint: disable=W0212
+    result.close()
+
+    print(f"{int(mask.sum())} of {mask.size} tiles changed")
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Generate a tile level map of where a scenario changes habitat.")
+    parser.add_argument(
+        '--diffmap',
+        type=Path,
+        help='Path of map of scenario difference scaled by area',
+        required=True,
+        dest='diff_map_path',
+    )
+    parser.add_argument(
+        '--output',
+        type=Path,
+        help='Path where the change mask should be stored',
+        required=True,
+        dest='output_path',
+    )
+    args = parser.parse_args()
+
+    make_change_mask(
+        args.diff_map_path,
+        args.output_path,
+    )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+import argparse
+import os
+import sys
+import tempfile
+from pathlib import Path
+from typing import Iterator, NamedTuple
+
+import numpy as np
+import pandas as pd
+from snakemake_argparse_bridge import snakemake_compatible # type: ignore
+
+os.environ['YIRGACHEFFE_BACKEND'] = 'NUMPY'
+import yirgacheffe as yg # pylint: disable=C0413
+
+from delta_p_store import DeltaPStore, METADATA_FILENAME, CHUNK_ROWS # pylint: disable=C0413
+
+class SpeciesSource(NamedTuple):
+    """Where to find the delta P for one species, either a raster or an entry in a sparse store"""
+    taxid : str
+    area : yg.Area
+    raster_path : Path | None
+    store : DeltaPStore | None
+    name : str
+
+def load_groups(groups_path: Path, totals_path: Path | None) -> dict[str, list[str]]:
+    """Load a grouping table, giving the groups each taxid belongs to. The table has a group column,
+    and either a taxid column, or an id_no column, in which case the AOH totals index is used
+    to find the taxids for each id_no. A species can be in more than one group."""
+    groups = pd.read_csv(groups_path, dtype=str)
+    if "group" not in groups.columns:
+        raise ValueError(f"Expected a group column in {groups_path}")
+    if "taxid" not in groups.columns:
+        if "id_no" not in groups.columns:
+            raise ValueError(f"Expected a taxid or id_no column in {groups_path}")
+        if totals_path is None:
+            raise ValueError("The AOH totals index is needed to group species by id_no")
+        totals = pd.read_parquet(totals_path, columns=["taxid", "id_no"]).dropna().drop_duplicates()
+        totals["id_no"] = totals.id_no.astype(str)
+        groups = groups.merge(totals, on="id_no")
+
+    res: dict[str, list[str]] = {}
+    for taxid, group in groups[["taxid", "group"]].drop_duplicates().itertuples(index=False):
+        res.setdefault(str(taxid), []).append(str(group))
+    return res
+
+def taxid_of(name: str) -> str:
+    # Delta P outputs are named deltap_{taxid}_{season}
+    return name.removeprefix("deltap_").rsplit("_", 1)[0]
+
+def find_species(deltap_path: Path) -> Iterator[SpeciesSource]:
+    """Find the delta P for every species under a scenario, which has a directory per taxa
+    containing either per species rasters, a sparse store, or both, in which case the store
+    is used for species in both."""
+    for taxa_path in sorted(x for x in deltap_path.iterdir() if x.is_dir()):
+        stored = set()
+        if (taxa_path / "store" / METADATA_FILENAME).exists():
+            store = DeltaPStore(taxa_path / "store")
+            for name in store.species():
+                stored.add(name)
+                yield SpeciesSource(taxid_of(name), store.area(name), None, store, name)
+        for raster_path in sorted(taxa_path.glob("deltap_*.tif")):
+            if raster_path.stem in stored:
+                continue
+            with yg.read_raster(raster_path) as layer:
+                area = layer.area
+            yield SpeciesSource(taxid_of(raster_path.stem), area, raster_path, None, raster_path.stem)
+
+def find_unchanged(deltap_path: Path) -> list[str]:
+    """Find the taxids of species that the scenario leaves unchanged, which have no delta P
+    output, but still count towards their groups."""
+    return [taxid_of(x.name) for x in sorted(deltap_path.glob("*/unchanged/deltap_*"))]
+
+def delta_p_groups(
+    deltap_path: Path,
+    groups_path: Path,
+    totals_path: Path | None,
+    band: int,
+    output_path: Path,
+) -> None:
+    """Sum the delta P of every species under a scenario by an arbitrary grouping, with a band per
+    group in the result. Each species' delta P is read once, and added into its own window of each
+    of its groups. A sibling CSV records how many species went into each group."""
+    species_groups = load_groups(groups_path, totals_path)
+    labels = sorted({group for groups in species_groups.values() for group in groups})
+    band_index = {label: index for index, label in enumerate(labels)}
+    sources = [x for x in find_species(deltap_path) if x.taxid in species_groups]
+    if not sources:
+        sys.exit(f"No grouped species found in {deltap_path}")
+
+    union = sources[0].area
+    for source in sources[1:]:
+        union = union | source.area
+    assert union.projection is not None
+    projection = union.projection
+    width, height = union.pixel_dimensions
+
+    os.makedirs(output_path.parent, exist_ok=True)
+    counts = dict.fromkeys(labels, 0)
+    with tempfile.TemporaryDirectory(dir=output_path.parent) as tmpdir:
+        total = np.memmap(Path(tmpdir) / "groups.dat", dtype=np.float64, mode="w+", shape=(len(labels), height, width))
+        for source in sources:
+            bands = [band_index[x] for x in species_groups[source.taxid]]
+            for label in species_groups[source.taxid]:
+                counts[label] += 1
+            xoff = round((source.area.left - union.left) / projection.xstep)
+            yoff = round((source.area.top - union.top) / projection.ystep)
+            source_width, source_height = source.area.pixel_dimensions
+
+            if source.store is not None:
+                entry = source.store.read(source.name)
+                rows = (entry.indices // source_width) + yoff
+                columns = (entry.indices % source_width) + xoff
+                for index in bands:
+                    total[index, rows, columns] += entry.values[band - 1]
+            else:
+                assert source.raster_path is not None
+                with yg.read_raster(source.raster_path, band=band) as layer:
+                    for yoffset in range(0, source_height, CHUNK_ROWS):
+                        step = min(CHUNK_ROWS, source_height - yoffset)
+                        data = layer.read_array(0, yoffset, source_width, step)
+                        for index in bands:
+                            total[index, yoff + yoffset:yoff + yoffset + step, xoff:xoff + source_width] += data
+
+        result = yg.layers.RasterLayer.empty_raster_layer(
+            union,
+            projection.scale,
+            yg.DataType.Float64,
+            filename=output_path,
+            projection=projection.name,
+            bands=len(labels),
+        )
+        try:
+            for index, label in enumerate(labels):
+                output_band = result._dataset.GetRasterBand(index + 1) # pylint: disable=W0212
+                output_band.SetDescription(label)
+                for yoffset in range(0, height, CHUNK_ROWS):
+                    output_band.WriteArray(total[index, yoffset:yoffset + CHUNK_ROWS], 0, yoffset)
+        finally:
+            result.close()
+
+    for taxid in find_unchanged(deltap_path):
+        for label in species_groups.get(taxid, []):
+            counts[label] += 1
+    counts_df = pd.DataFrame(list(counts.items()), columns=["group", "count"])
+    counts_df.to_csv(output_path.with_suffix(".csv"), index=False)
+
+@snakemake_compatible(mapping={
+    "deltap_path": "params.deltap_dir",
+    "groups_path": "input.groups",
+    "totals_path": "input.totals",
+    "output_path": "output.tif",
+})
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Sum delta P by an arbitrary grouping of species.")
+    parser.add_argument(
+        '--deltap',
+        type=Path,
+        required=True,
+        dest='deltap_path',
+        help="Directory of delta P for a scenario and curve, with a subdirectory per taxa",
+    )
+    parser.add_argument(
+        '--groups',
+        type=Path,
+        required=True,
+        dest='groups_path',
+        help="CSV with a group column and either a taxid or id_no column",
+    )
+    parser.add_argument(
+        '--totals',
+        type=Path,
+        required=False,
+        default=None,
+        dest='totals_path',
+        help="AOH totals index, as generated by aoh_totals_index.py, needed to group by id_no",
+    )
+    parser.add_argument(
+        '--band',
+        type=int,
+        required=False,
+        default=1,
+        dest='band',
+        help="Which curve's band of the delta P to sum, by default the main curve",
+    )
+    parser.add_argument(
+        '--output',
+        type=Path,
+        required=True,
+        dest='output_path',
+        help="Destination raster with a band per group, along with a CSV of species counts per group",
+    )
+    args = parser.parse_args()
+
+    delta_p_groups(
+        args.deltap_path,
+        args.groups_path,
+        args.totals_path,
+        args.band,
+        args.output_path,
+    )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+import argparse
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+os.environ['YIRGACHEFFE_BACKEND'] = 'NUMPY'
+import yirgacheffe as yg # pylint: disable=C0413
+
+from global_code_residents_pixel import calculate_delta_p, curve_labels, save_delta_p, AOHTotals # pylint: disable=C0413
+from global_code_residents_pixel_batch import load_manifest, DeltaPJob # pylint: disable=C0413
+
+# How many rows of data we read back at once
+CHUNK_ROWS = 512
+
+def write_delta_p(job: DeltaPJob, totals: AOHTotals | None, datatype: yg.DataType, output_paths: list[Path]) -> bool:
+    """Write the delta P for a species as the delta P jobs would, returning whether there was any."""
+    try:
+        result = calculate_delta_p(
+            job.taxid,
+            job.season,
+            job.current_path,
+            job.scenario_paths,
+            job.historic_path,
+            job.exponents,
+            totals,
+        )
+    except ValueError:
+        print(f"Failed to align layers for {job.taxid}_{job.season}", file=sys.stderr)
+        return False
+    if result is None:
+        return False
+    save_delta_p(result.chunks, output_paths, curve_labels(job.exponents), datatype)
+    return True
+
+def compare_rasters(float64_path: Path, float32_path: Path, band: int) -> tuple[float, float, float, float]:
+    """Read back the same band of the float64 and float32 delta P rasters for a species, and find
+    the largest absolute and relative per pixel errors, along with the sum of each. The float32 values
+    are summed as float64, as raster_sum does."""
+    max_abs_error, max_rel_error, total_float64, total_float32 = 0.0, 0.0, 0.0, 0.0
+    with yg.read_raster(float64_path, band=band) as float64_layer, \
+            yg.read_raster(float32_path, band=band) as float32_layer:
+        width, height = float64_layer.window.xsize, float64_layer.window.ysize
+        for yoffset in range(0, height, CHUNK_ROWS):
+            step = min(CHUNK_ROWS, height - yoffset)
+            data = float64_layer.read_array(0, yoffset, width, step).astype(np.float64)
+            stored = float32_layer.read_array(0, yoffset, width, step).astype(np.float64)
+            error = np.abs(stored - data)
+            magnitude = np.abs(data)
+            relative = np.divide(error, magnitude, out=np.zeros_like(error), where=magnitude > 0)
+            max_abs_error = max(max_abs_error, float(np.nanmax(error)))
+            max_rel_error = max(max_rel_error, float(np.nanmax(relative)))
+            total_float64 += float(np.nansum(data))
+            total_float32 += float(np.nansum(stored))
+    return max_abs_error, max_rel_error, total_float64, total_float32
+
+def delta_p_precision(
+    manifest_path: Path,
+    totals_path: Path | None,
+    sample_count: int,
+    output_path: Path,
+) -> None:
+    """Measure how much storing delta P as float32 rather than float64 changes the results, for a sample
+    of the species in a manifest. Each species is written out at both precisions, just as the delta P
+    jobs would, and then read back, and for each scenario and curve this records the largest per
+    pixel error, and the error in the species' total, as that is what gets summed into the final maps."""
+    jobs = load_manifest(manifest_path, 0, 1)
+    # Take an evenly spaced sample, as manifests are ordered by taxa
+    jobs = jobs[::max(1, len(jobs) // sample_count)][:sample_count]
+    totals = AOHTotals(totals_path) if totals_path is not None else None
+
+    os.makedirs(output_path.parent, exist_ok=True)
+    res = []
+    with tempfile.TemporaryDirectory(dir=output_path.parent) as tmpdir:
+        for job in jobs:
+            float64_paths = [Path(tmpdir) / f"float64_{index}.tif" for index in range(len(job.scenario_paths))]
+            float32_paths = [Path(tmpdir) / f"float32_{index}.tif" for index in range(len(job.scenario_paths))]
+            for path in float64_paths + float32_paths:
+                path.unlink(missing_ok=True)
+            if not write_delta_p(job, totals, yg.DataType.Float64, float64_paths):
+                continue
+            write_delta_p(job, totals, yg.DataType.Float32, float32_paths)
+
+            labels = curve_labels(job.exponents)
+            for scenario_path, float64_path, float32_path in zip(job.scenario_paths, float64_paths, float32_paths):
+                # Scenarios that leave the species unchanged have no delta P
+                if not float64_path.exists():
+                    continue
+                for band, label in enumerate(labels, start=1):
+                    res.append([
+                        job.taxid,
+                        job.season,
+                        # The scenario AOHs are stored as {scenario}/{taxa}
+                        scenario_path.parent.name,
+                        label,
+                        *compare_rasters(float64_path, float32_path, band),
+                    ])
+
+    df = pd.DataFrame(res, columns=[
+        "taxid",
+        "season",
+        "scenario",
+        "curve",
+        "max_abs_error",
+        "max_rel_error",
+        "total_float64",
+        "total_float32",
+    ])
+    df["total_error"] = (df.total_float32 - df.total_float64).abs()
+    df.to_csv(output_path, index=False)
+
+    for (scenario, curve), group in df.groupby(["scenario", "curve"]):
+        print(f"{scenario} {curve}: max pixel error {group.max_abs_error.max():.3e}, "
+            f"max relative pixel error {group.max_rel_error.max():.3e}, "
+            f"summed species total error {group.total_error.sum():.3e} of {group.total_float64.abs().sum():.3e}")
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Measure the error from storing delta P as float32.")
+    parser.add_argument(
+        '--manifest',
+        type=Path,
+        required=True,
+        dest='manifest_path',
+        help="CSV of species to process, as generated by persistencegenerator.py",
+    )
+    parser.add_argument(
+        '--totals',
+        type=Path,
+        required=False,
+        default=None,
+        dest='totals_path',
+        help="AOH totals index, as generated by aoh_totals_index.py, used rather than reading the AOH JSON files",
+    )
+    parser.add_argument(
+        '--sample',
+        type=int,
+        required=False,
+        default=100,
+        dest='sample_count',
+        help="How many species from the manifest to test",
+    )
+    parser.add_argument(
+        '--output',
+        type=Path,
+        required=True,
+        dest='output_path',
+        help="Destination CSV of errors per species, scenario, and curve",
+    )
+    args = parser.parse_args()
+
+    delta_p_precision(
+        args.manifest_path,
+        args.totals_path,
+        args.sample_count,
+        args.output_path,
+    )
+
+if __name__ == "__main__":
+    main()
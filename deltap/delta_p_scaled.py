@@ -3,18 +3,26 @@ import os
 import sys
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
 import yirgacheffe as yg
 from snakemake_argparse_bridge import snakemake_compatible # type: ignore
 
 SCALE = 1e6
 
+# How many rows of pixels are processed at once
+YSTEP = 512
+
 def delta_p_scaled_area(
     input_path: Path,
     diff_area_map_path: Path,
-    species_totals_path: Path,
     output_path: Path,
 ):
+    """Scale the summed delta P by the area of habitat changed and the number of species, writing a band
+    for all species and then a band per taxa. This is done in a single sweep over the rows of the diff
+    area map, so each block of it and of each per taxa map is read once, and the all species band is
+    the sum of the per taxa blocks already in memory. The species counts are those recorded by raster_sum
+    alongside each per taxa map, including the species the scenario left unchanged."""
     os.makedirs(output_path.parent, exist_ok=True)
 
     per_taxa = [
@@ -23,44 +31,57 @@ def delta_p_scaled_area(
     if not per_taxa:
         sys.exit(f"Failed to find any per-taxa maps in {input_path}")
 
-    species_total_counts = pd.read_csv(species_totals_path)
+    # get the taxa from the filename
+    labels = ["all"] + [os.path.split(x.name)[1][:-4] for x in per_taxa]
+    taxa_counts = []
+    for label in labels[1:]:
+        species_counts_df = pd.read_csv(input_path / f"{label}.csv")
+        taxa_counts.append(int(species_counts_df.contributing.sum() + species_counts_df.unchanged.sum()))
+    counts = [sum(taxa_counts)] + taxa_counts
+    species_counts = np.reshape(np.asarray(counts, dtype=np.float64), (-1, 1, 1))
 
     with yg.read_raster(diff_area_map_path) as diff_area:
-        diff_area_rescaled = yg.where(diff_area < SCALE, float('nan'), diff_area / SCALE)
-
-        # Process all species in total
-        total_species_count = int(species_total_counts[species_total_counts.taxa=="all"]["count"].values[0])
-        summed_layer = yg.sum(per_taxa)
-        all_scaled_filtered_layer = yg.where(
-            diff_area_rescaled != 0,
-            ((summed_layer / diff_area_rescaled) * -1.0) / total_species_count,
-            float('nan')
+        # The result covers the diff area map, and the per taxa maps are read as zero outside of
+        # their own area. This will raise a ValueError if the layers don't align.
+        for layer in per_taxa:
+            layer.set_window_for_union(diff_area.area)
+        width, height = diff_area.window.xsize, diff_area.window.ysize
+
+        result = yg.layers.RasterLayer.empty_raster_layer_like(
+            diff_area,
+            filename=output_path,
+            datatype=yg.DataType.Float64,
+            nodata=float('nan'),
+            bands=len(labels),
         )
+        for band, label in enumerate(labels, start=1):
+            result._dataset.GetRasterBand(band).SetDescription(label) # pylint: disable=W0212
 
-        bands = [all_scaled_filtered_layer]
-        labels = ["all"]
+        data = np.empty((len(labels), YSTEP, width), dtype=np.float64)
+        for yoffset in range(0, height, YSTEP):
+            step = min(YSTEP, height - yoffset)
+            chunk = data[:, :step]
 
-        # Now per taxa
-        for inlayer in per_taxa:
-            # get the taxa from the filename
-            _, name = os.path.split(inlayer.name)
-            taxa = name[:-4]
-            labels.append(taxa)
+            diff = np.asarray(diff_area.read_array(0, yoffset, width, step), dtype=np.float64)
+            diff_area_rescaled = diff / SCALE
+            diff_area_rescaled[diff < SCALE] = np.nan
 
-            taxa_species_count = int(species_total_counts[species_total_counts.taxa==taxa]["count"].values[0])
-            scaled_filtered_layer = yg.where(
-                diff_area_rescaled != 0,
-                ((inlayer / diff_area_rescaled) * -1.0) / taxa_species_count,
-                float('nan')
-            )
-            bands.append(scaled_filtered_layer)
+            for band, layer in enumerate(per_taxa, start=1):
+                chunk[band] = layer.read_array(0, yoffset, width, step)
+            np.sum(chunk[1:], axis=0, out=chunk[0])
 
-        yg.to_geotiff(output_path, bands, labels, nodata=float('nan'))
+            np.divide(chunk, diff_area_rescaled, out=chunk)
+            np.negative(chunk, out=chunk)
+            np.divide(chunk, species_counts, out=chunk)
+            chunk[:, diff_area_rescaled == 0] = np.nan
+
+            for band, values in enumerate(chunk, start=1):
+                result._dataset.GetRasterBand(band).WriteArray(values, 0, yoffset) # pylint: disable=W0212
+        result.close()
 
 @snakemake_compatible(mapping={
     "input_path": "params.input_dir",
     "diff_area_map_path": "input.diffmap",
-    "totals_path": "input.totals",
     "output_path": "output.final",
 })
 def main() -> None:
@@ -79,13 +100,6 @@ def main() -> None:
         required=True,
         dest='diff_area_map_path',
     )
-    parser.add_argument(
-        '--totals',
-        type=Path,
-        help='Path of CSV with total counts of spcies used',
-        required=True,
-        dest='totals_path',
-    )
     parser.add_argument(
         '--output',
         type=Path,
@@ -98,7 +112,6 @@ def main() -> None:
     delta_p_scaled_area(
         args.input_path,
         args.diff_area_map_path,
-        args.totals_path,
         args.output_path
     )
 
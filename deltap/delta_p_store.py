@@ -0,0 +1,306 @@
+import argparse
+import json
+import os
+import socket
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Iterator, NamedTuple
+
+import numpy as np
+import pandas as pd
+from snakemake_argparse_bridge import snakemake_compatible # type: ignore
+
+os.environ['YIRGACHEFFE_BACKEND'] = 'NUMPY'
+import yirgacheffe as yg # pylint: disable=C0413
+
+# How many rows of data we process at once when moving data in and out of rasters
+CHUNK_ROWS = 512
+
+METADATA_FILENAME = "store.json"
+INDEX_COLUMNS = ["name", "left", "top", "width", "height", "offset", "count", "written"]
+
+# Most delta P rasters are zero outside of the few pixels a scenario changes, so rather than
+# a GeoTIFF per species, the store keeps just the non zero pixels of each species. Each process
+# that writes to the store appends to its own set of files, so there is no locking needed:
+#
+#   index_{part}.csv   - a row per species with its window and where its pixels are in the other files
+#   indices_{part}.bin - the int64 offset of each pixel within the species' window, in row major order
+#   values_{part}.bin  - the values of those pixels, a band at a time for each species
+#
+# This is the same layout as a CSR sparse matrix, with a row per species.
+
+def store_path_for(output_path: Path) -> Path:
+    """Where the store lives for a delta P raster path, which is alongside the rasters."""
+    return output_path.parent / "store"
+
+def part_name() -> str:
+    # The host name is needed as well as the process ID as jobs may run on several
+    # nodes sharing a filesystem.
+    return f"{socket.gethostname()}_{os.getpid()}"
+
+class StoreEntry(NamedTuple):
+    """The non zero pixels of one species, where the indices are within the species' window"""
+    area : yg.Area
+    indices : np.ndarray
+    values : np.ndarray
+
+class DeltaPStoreWriter: # pylint: disable=R0903
+    """Appends species to a delta P store."""
+
+    def __init__(self, store_path: Path, map_projection: yg.MapProjection, labels: list[str], dtype: type) -> None:
+        os.makedirs(store_path, exist_ok=True)
+        self.store_path = store_path
+        self.dtype = np.dtype(dtype)
+        self.bands = len(labels)
+        metadata = {
+            "projection": map_projection.name,
+            "xstep": map_projection.xstep,
+            "ystep": map_projection.ystep,
+            "labels": labels,
+            "dtype": self.dtype.name,
+        }
+        # Many processes, possibly on different nodes, may open the store at once, so the metadata
+        # is written in full to a file of our own and then linked into place, which only one can do.
+        # Everyone else then reads a complete file.
+        metadata_path = store_path / METADATA_FILENAME
+        with tempfile.NamedTemporaryFile("w", dir=store_path, prefix=".store_", delete=False, encoding="utf-8") as f:
+            json.dump(metadata, f)
+        try:
+            os.link(f.name, metadata_path)
+        except FileExistsError:
+            with open(metadata_path, "r", encoding="utf-8") as existing_file:
+                existing = json.load(existing_file)
+            if existing != json.loads(json.dumps(metadata)):
+                raise ValueError(f"Delta P does not match the existing store in {store_path}") from None
+        finally:
+            os.unlink(f.name)
+
+    def write(self, name: str, area: yg.Area, indices: np.ndarray, values: np.ndarray) -> None:
+        """Add a species to the store. The index row is written last, so a species is only visible
+        to readers once all its data is written. If a species is written more than once then readers
+        use the latest."""
+        part = part_name()
+        with open(self.store_path / f"indices_{part}.bin", "ab") as f:
+            offset = f.tell() // np.dtype(np.int64).itemsize
+            f.write(np.ascontiguousarray(indices, dtype=np.int64).tobytes())
+        with open(self.store_path / f"values_{part}.bin", "ab") as f:
+            f.write(np.ascontiguousarray(values, dtype=self.dtype).tobytes())
+        width, height = area.pixel_dimensions
+        with open(self.store_path / f"index_{part}.csv", "a", encoding="utf-8") as f:
+            f.write(f"{name},{area.left!r},{area.top!r},{width},{height},{offset},{len(indices)},{time.time_ns()}\n")
+
+def save_delta_p_store(
+    chunks: Iterator,
+    output_paths: list[Path],
+    labels: list[str],
+    datatype: yg.DataType = yg.DataType.Float64,
+) -> None:
+    """Write the delta P for each scenario to the store alongside where its raster would have been
+    written, keeping only the pixels that are non zero in any band."""
+    dtype = np.float32 if datatype == yg.DataType.Float32 else np.float64
+    # The chunks for the scenarios are interleaved, so we gather each until they are all done
+    entries: dict[int, tuple[yg.Area, list[np.ndarray], list[np.ndarray]]] = {}
+    for chunk in chunks:
+        bands, _, width = chunk.data.shape
+        data = chunk.data.reshape(bands, -1)
+        nonzero = np.flatnonzero((data != 0).any(axis=0))
+        _, indices, values = entries.setdefault(chunk.scenario, (chunk.area, [], []))
+        indices.append(nonzero + (chunk.yoffset * width))
+        values.append(data[:, nonzero])
+
+    for scenario, (area, indices, values) in entries.items():
+        assert area.projection is not None
+        output_path = output_paths[scenario]
+        writer = DeltaPStoreWriter(store_path_for(output_path), area.projection, labels, dtype)
+        writer.write(
+            output_path.stem,
+            area,
+            np.concatenate(indices),
+            np.concatenate(values, axis=1),
+        )
+
+class DeltaPStore:
+    """Reads species from a delta P store."""
+
+    def __init__(self, store_path: Path) -> None:
+        with open(store_path / METADATA_FILENAME, "r", encoding="utf-8") as f:
+            metadata = json.load(f)
+        self.store_path = store_path
+        self.map_projection = yg.MapProjection(metadata["projection"], metadata["xstep"], metadata["ystep"])
+        self.labels: list[str] = metadata["labels"]
+        self.dtype = np.dtype(metadata["dtype"])
+
+        indexes = []
+        for index_path in sorted(store_path.glob("index_*.csv")):
+            df = pd.read_csv(
+                index_path,
+                header=None,
+                names=INDEX_COLUMNS,
+                dtype={"name": str},
+                float_precision="round_trip",
+            )
+            df["part"] = index_path.stem[len("index_"):]
+            indexes.append(df)
+        index = pd.concat(indexes) if indexes else pd.DataFrame(columns=INDEX_COLUMNS + ["part"])
+        # If a species was written more than once, only the latest counts, and if a later run found the
+        # scenario leaves it unchanged then it is left out, as the store is never rewritten
+        index = index.sort_values("written").drop_duplicates("name", keep="last")
+        unchanged_path = store_path.parent / "unchanged"
+        if unchanged_path.is_dir():
+            index = index[~index["name"].isin([x.name for x in unchanged_path.iterdir()])]
+        self.index = index.set_index("name").sort_index()
+
+    def species(self) -> list[str]:
+        return list(self.index.index)
+
+    def area(self, name: str) -> yg.Area:
+        row = self.index.loc[name]
+        projection = self.map_projection
+        return yg.Area(
+            left=row.left,
+            top=row.top,
+            right=row.left + (row.width * projection.xstep),
+            bottom=row.top + (row.height * projection.ystep),
+            projection=projection,
+        )
+
+    def read(self, name: str) -> StoreEntry:
+        row = self.index.loc[name]
+        count, offset = (int(x) for x in self.index.loc[name, ["count", "offset"]].to_numpy(dtype=np.int64))
+        bands = len(self.labels)
+        if count == 0:
+            return StoreEntry(self.area(name), np.zeros(0, dtype=np.int64), np.zeros((bands, 0), dtype=self.dtype))
+        indices = np.memmap(self.store_path / f"indices_{row.part}.bin", dtype=np.int64, mode="r")
+        values = np.memmap(self.store_path / f"values_{row.part}.bin", dtype=self.dtype, mode="r")
+        # Each species has a value per band for each index, so the values offset is scaled by the bands
+        return StoreEntry(
+            self.area(name),
+            np.array(indices[offset:offset + count]),
+            np.array(values[offset * bands:(offset + count) * bands]).reshape(bands, count),
+        )
+
+    def write_raster(self, area: yg.Area, data: np.ndarray, output_path: Path) -> None:
+        """Write a band per curve array covering the given area to a raster."""
+        assert area.projection is not None
+        result = yg.layers.RasterLayer.empty_raster_layer(
+            area,
+            area.projection.scale,
+            yg.DataType.Float64 if data.dtype == np.float64 else yg.DataType.Float32,
+            filename=output_path,
+            projection=area.projection.name,
+            bands=len(self.labels),
+        )
+        try:
+            for band, label in enumerate(self.labels, start=1):
+                output_band = result._dataset.GetRasterBand(band) # pylint: disable=W0212
+                output_band.SetDescription(label)
+                for yoffset in range(0, data.shape[1], CHUNK_ROWS):
+                    output_band.WriteArray(data[band - 1, yoffset:yoffset + CHUNK_ROWS], 0, yoffset)
+        finally:
+            result.close()
+
+    def materialise(self, name: str, output_path: Path) -> None:
+        """Write a species back out as the raster it would have been."""
+        entry = self.read(name)
+        width, height = entry.area.pixel_dimensions
+        data = np.zeros((len(self.labels), height * width), dtype=self.dtype)
+        data[:, entry.indices] = entry.values
+        self.write_raster(entry.area, np.reshape(data, (-1, height, width)), output_path)
+
+    def sum(self, output_path: Path, names: list[str] | None = None) -> None:
+        """Sum species, by default all of them, into a float64 raster covering the union of
+        their areas. This only touches the non zero pixels of each species, and always adds the
+        species in the same order, so the result is reproducible."""
+        names = sorted(names if names is not None else self.species())
+        if not names:
+            raise ValueError(f"No species in store {self.store_path}")
+        union = self.area(names[0])
+        for name in names[1:]:
+            union = union | self.area(name)
+        width, height = union.pixel_dimensions
+        projection = self.map_projection
+
+        with tempfile.TemporaryDirectory(dir=output_path.parent) as tmpdir:
+            total = np.memmap(
+                Path(tmpdir) / "sum.dat",
+                dtype=np.float64,
+                mode="w+",
+                shape=(len(self.labels), height, width),
+            )
+            for name in names:
+                entry = self.read(name)
+                entry_width, _ = entry.area.pixel_dimensions
+                xoff = round((entry.area.left - union.left) / projection.xstep)
+                yoff = round((entry.area.top - union.top) / projection.ystep)
+                rows = (entry.indices // entry_width) + yoff
+                columns = (entry.indices % entry_width) + xoff
+                # Each pixel appears only once per species, so there are no repeated indices
+                total[:, rows, columns] += entry.values
+            self.write_raster(union, total, output_path)
+
+def write_species_counts(store: DeltaPStore, unchanged_path: Path | None, output_path: Path) -> None:
+    """Record how many species were summed, and how many the scenario left unchanged, in the
+    same CSV that raster_sum.py writes alongside its sums."""
+    unchanged = 0
+    if unchanged_path is not None and unchanged_path.is_dir():
+        unchanged = sum(1 for _ in unchanged_path.iterdir())
+    pd.DataFrame(
+        [[len(store.species()), unchanged]],
+        columns=["contributing", "unchanged"],
+    ).to_csv(output_path.with_suffix(".csv"), index=False)
+
+@snakemake_compatible(mapping={
+    "store_path": "params.rasters_dir",
+    "output_path": "output[0]",
+    "unchanged_path": "params.unchanged",
+})
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Sum or extract delta P from a sparse delta P store.")
+    parser.add_argument(
+        '--store',
+        type=Path,
+        required=True,
+        dest='store_path',
+        help="Directory of the delta P store",
+    )
+    parser.add_argument(
+        '--output',
+        type=Path,
+        required=True,
+        dest='output_path',
+        help="Destination raster",
+    )
+    parser.add_argument(
+        '--species',
+        type=str,
+        required=False,
+        default=None,
+        dest='species',
+        help="Rather than summing all species, write out just this one, named as its delta P raster "
+            "would be, e.g. deltap_T12345A1_RESIDENT",
+    )
+    parser.add_argument(
+        '--unchanged',
+        type=Path,
+        required=False,
+        default=None,
+        dest='unchanged_path',
+        help="Directory of markers for the species the scenario left unchanged, to be counted alongside "
+            "the species summed",
+    )
+    args = parser.parse_args()
+
+    os.makedirs(args.output_path.parent, exist_ok=True)
+    store = DeltaPStore(args.store_path)
+    if args.species is not None:
+        if args.species not in store.index.index:
+            sys.exit(f"Species {args.species} not found in {args.store_path}")
+        store.materialise(args.species, args.output_path)
+    else:
+        write_species_counts(store, args.unchanged_path, args.output_path)
+        store.sum(args.output_path)
+
+if __name__ == "__main__":
+    main()
@@ -1,257 +1,669 @@
 import argparse
 import json
-import math
 import os
 import sys
 from pathlib import Path
+from typing import Iterator, NamedTuple
 
+import numpy as np
+import pandas as pd
 from snakemake_argparse_bridge import snakemake_compatible # type: ignore
 
 os.environ['YIRGACHEFFE_BACKEND'] = 'NUMPY'
 import yirgacheffe as yg # pylint: disable=C0413
 
+from change_mask import ChangeMask, load_change_masks # pylint: disable=C0413
+from delta_p_store import save_delta_p_store # pylint: disable=C0413
+
 # This isn't a hard requirement, but in practice most experiments use 0.25, and the original
 # paper used the other three values for comparison. Other values are valid, but to save wasted
 # times with typos, we do restrict this to the subset used for the paper.
 FLOAT_EXPONENTS = {0.1, 0.25, 0.5, 1.0}
 
+SEASONS = {"RESIDENT", "BREEDING", "NONBREEDING"}
+
+# How many rows of pixels are processed at once
+YSTEP = 512
+
+# The delta P is always calculated in float64, but can optionally be stored as float32 to
+# save space, as all the summing of delta P is done in float64.
+STORAGE_TYPES = {
+    "float64": yg.DataType.Float64,
+    "float32": yg.DataType.Float32,
+}
+
 GOMPERTZ_A = 2.5
 GOMPERTZ_B = -14.5
 GOMPERTZ_ALPHA = 1
 
-def open_layer(filename: Path) -> tuple[yg.YirgacheffeLayer,float]:
+class AOHTotals: # pylint: disable=R0903
+    """The AOH totals for all species and scenarios, as gathered by utils/aoh_totals_index.py. This
+    saves reading the JSON file that sits besides every AOH raster we use."""
+
+    def __init__(self, index_path: Path, taxid: str | None = None) -> None:
+        # When we only need one species, let the parquet reader skip the rest. All of its seasons
+        # are kept, as the non-breeding delta P also needs the breeding AOH.
+        index = pd.read_parquet(
+            index_path,
+            columns=["scenario", "taxa", "taxid", "season", "aoh_total", "has_raster"],
+            filters=[("taxid", "==", taxid)] if taxid is not None else None,
+        )
+        self.totals = {
+            (scenario, taxa, f"aoh_{taxid}_{season}"): (aoh_total, has_raster)
+            for scenario, taxa, taxid, season, aoh_total, has_raster in index.itertuples(index=False)
+        }
+
+    def lookup(self, filename: Path) -> tuple[float, bool]:
+        """Get the total and whether there is a raster for an AOH, where the AOH path is
+        of the form {scenario}/{taxa}/aoh_{taxid}_{season}.tif"""
+        try:
+            return self.totals[(filename.parent.parent.name, filename.parent.name, filename.stem)]
+        except KeyError as exc:
+            raise FileNotFoundError(filename) from exc
+
+def load_total(filename: Path, totals: AOHTotals | None = None) -> float:
+    """Get the total area of an AOH without opening the raster, either from the totals index
+    if we have one, or from the JSON file that sits besides the TIFF."""
+    if totals is not None:
+        total_aoh, _ = totals.lookup(filename)
+        return total_aoh
+
+    json_filename = filename.parent / f"{filename.stem}.json"
+    with open(json_filename, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    return data["aoh_total"]
+
+def open_layer(filename: Path, totals: AOHTotals | None = None) -> tuple[yg.YirgacheffeLayer,float]:
     """We use this helper function for two reasons:
     1. The delta-p values are quite small, and so we want to ensure things are in float64.
     2. We almost always need the total area, but rather than calculate it we can get that
-       from the JSON file that sits besides the TIFF.
+       from the totals index or the JSON file that sits besides the TIFF.
     """
     # The "nan" is an artefact of bouncing the data via pandas
     if filename.name == "nan":
         return yg.constant(0.0), 0.0
 
-    layer = yg.read_raster(filename)
-
-    json_filename = filename.parent / f"{filename.stem}.json"
-    with open(json_filename, "r", encoding="utf-8") as f:
-        data = json.load(f)
-    total_aoh = data["aoh_total"]
-
-    return layer, total_aoh
+    if totals is not None:
+        _, has_raster = totals.lookup(filename)
+        if not has_raster:
+            raise FileNotFoundError(filename)
 
-def calc_persistence_value(
-    current_aoh: float,
-    historic_aoh: float,
-    exponent: str | float
-) -> float:
-    scaled_aoh = current_aoh / historic_aoh
-    if isinstance(exponent, float):
-        sp_p = scaled_aoh ** exponent
-    else:
-        assert exponent == "gompetz"
-        sp_p = math.exp(-math.exp(GOMPERTZ_A + (GOMPERTZ_B * (scaled_aoh ** GOMPERTZ_ALPHA))))
-    return 1.0 if sp_p > 1.0 else sp_p
+    layer = yg.read_raster(filename)
+    return layer, load_total(filename, totals)
 
 def process_delta_p(
-    current: yg.YirgacheffeLayer,
-    scenario: yg.YirgacheffeLayer | float,
+    current: np.ndarray,
+    scenario: np.ndarray | float,
     current_aoh: float,
     historic_aoh: float,
-    exponent: str | float
-) -> yg.YirgacheffeLayer:
-
-    new_aoh = (current_aoh - current) + scenario
-
-    scaled_aoh = new_aoh / historic_aoh
-    if isinstance(exponent, float):
-        calc_2 = scaled_aoh ** exponent
-    else:
-        assert exponent == "gompetz"
-        calc_2 = yg.exp(-yg.exp(GOMPERTZ_A + (GOMPERTZ_B * (scaled_aoh ** GOMPERTZ_ALPHA))))
-    new_p = yg.where(calc_2 > 1, 1, calc_2)
-
-    return new_p
-
-def global_code_residents_pixel_ae(
+    exponents: list[str | float],
+    out: np.ndarray | None = None,
+) -> np.ndarray:
+    """Calculate the new probability of persistence for a chunk of pixels, where each
+    pixel is the species AOH if just that pixel were changed from current to the scenario.
+    The scaled AOH is calculated once and then each curve is evaluated on it, giving
+    a result with a band per curve.
+
+    All the work is done in place in the output array, which can be passed in to avoid any
+    allocation. The scaled AOH is kept in the last band whilst the other bands are calculated."""
+    if out is None:
+        out = np.empty((len(exponents),) + np.shape(current), dtype=np.float64)
+
+    scaled_aoh = out[-1]
+    # The AOH rasters may be float32, so force the calculation into float64
+    np.subtract(current_aoh, current, out=scaled_aoh, dtype=np.float64)
+    # A scenario of zero is a species that went extinct under the scenario, and adds nothing
+    if isinstance(scenario, np.ndarray) or scenario != 0.0:
+        np.add(scaled_aoh, scenario, out=scaled_aoh)
+    np.divide(scaled_aoh, historic_aoh, out=scaled_aoh)
+
+    for band, exponent in enumerate(exponents):
+        calc_2 = out[band]
+        match exponent:
+            case 1.0:
+                if band != len(exponents) - 1:
+                    np.copyto(calc_2, scaled_aoh)
+            case 0.5:
+                np.sqrt(scaled_aoh, out=calc_2)
+            case 0.25:
+                np.sqrt(scaled_aoh, out=calc_2)
+                np.sqrt(calc_2, out=calc_2)
+            case float():
+                np.power(scaled_aoh, exponent, out=calc_2)
+            case _:
+                assert exponent == "gompertz"
+                if GOMPERTZ_ALPHA != 1:
+                    np.power(scaled_aoh, GOMPERTZ_ALPHA, out=calc_2)
+                    np.multiply(calc_2, GOMPERTZ_B, out=calc_2)
+                else:
+                    np.multiply(scaled_aoh, GOMPERTZ_B, out=calc_2)
+                np.add(calc_2, GOMPERTZ_A, out=calc_2)
+                np.exp(calc_2, out=calc_2)
+                np.negative(calc_2, out=calc_2)
+                np.exp(calc_2, out=calc_2)
+        np.minimum(calc_2, 1.0, out=calc_2)
+
+    return out
+
+class SeasonAOH(NamedTuple):
+    """The current AOH and AOH totals needed to calculate persistence for one season of a species"""
+    current : yg.YirgacheffeLayer
+    current_aoh : float
+    historic_aoh : float
+
+class DeltaPChunk(NamedTuple):
+    """A block of rows of the delta P for one scenario, where the row offset is relative
+    to the area of that scenario's result. The data has a band per curve."""
+    scenario : int
+    area : yg.Area
+    yoffset : int
+    data : np.ndarray
+
+def load_species(
     taxid: str,
     season: str,
     current_aohs_path: Path,
-    scenario_aohs_path: Path,
     historic_aohs_path: Path,
-    exponent: str | float,
-    output_path: Path,
-) -> None:
-    os.makedirs(output_path.parent, exist_ok=True)
-
-    # snakemake demands we write a file to show we've done something, even if there
-    # is no tiff generated
-    sentinel_path = output_path.parent / f".{taxid}_{season}.done"
-
+    totals: AOHTotals | None = None,
+) -> list[SeasonAOH] | None:
+    """Load the current AOHs and historic totals for a species. Resident species have
+    one season, and migratory species have both breeding and non breeding seasons. This
+    returns None if the species does not contribute a delta P, either because of missing or empty
+    AOHs, or because it is the breeding half of a migratory species, which is covered by the
+    non breeding half."""
     match season:
         case "RESIDENT":
             filename = f"aoh_{taxid}_{season}.tif"
             try:
-                current, current_aoh = open_layer(current_aohs_path / filename)
+                current, current_aoh = open_layer(current_aohs_path / filename, totals)
             except FileNotFoundError:
                 print(f"Failed to open current layer {current_aohs_path / filename}", file=sys.stderr)
-                sentinel_path.touch()
-                return
-
-            try:
-                scenario: yg.YirgacheffeLayer | float
-                scenario, _ = open_layer(scenario_aohs_path / filename)
-            except FileNotFoundError:
-                # If there is a current but now scenario file it's because the species went extinct under the scenario
-                scenario = 0.0
+                return None
 
             try:
-                _, historic_aoh = open_layer(historic_aohs_path / filename)
+                historic_aoh = load_total(historic_aohs_path / filename, totals)
             except FileNotFoundError:
                 print(f"Failed to open historic layer {historic_aohs_path / filename}", file=sys.stderr)
-                sentinel_path.touch()
-                return
+                return None
 
             if historic_aoh == 0.0:
                 print(f"Historic AoH for {taxid} is zero, skipping", file=sys.stderr)
-                sentinel_path.touch()
-                return
+                return None
 
-            old_persistence = calc_persistence_value(current_aoh, historic_aoh, exponent)
-
-
-            # In general Yirgacheffe can infer the behaviour needed for area intersections based on
-            # operator, but in this instance we want to force the caclulation to take place for the
-            # union of the areas involved.
-            layers = [x for x in [current, scenario] if isinstance(x, yg.YirgacheffeLayer)]
-            union = yg.layers.RasterLayer.find_union(layers)
-            for layer in layers:
-                layer.set_window_for_union(union)
-
-            new_p_layer = process_delta_p(current, scenario, current_aoh, historic_aoh, exponent)
-
-            delta_p = new_p_layer - old_persistence
-
-            try:
-                delta_p.to_geotiff(output_path)
-            except ValueError:
-                print(f"Failed to align layers for {taxid}_{season}", file=sys.stderr)
-                sentinel_path.touch()
-                return
-
-            sentinel_path.touch()
+            return [SeasonAOH(current, current_aoh, historic_aoh)]
 
         case "NONBREEDING":
             nonbreeding_filename = f"aoh_{taxid}_NONBREEDING.tif"
             breeding_filename = f"aoh_{taxid}_BREEDING.tif"
 
             try:
-                _, historic_aoh_breeding = open_layer(historic_aohs_path / breeding_filename)
+                historic_aoh_breeding = load_total(historic_aohs_path / breeding_filename, totals)
                 if historic_aoh_breeding == 0.0:
                     print(f"Historic AoH breeding for {taxid} is zero, skipping", file=sys.stderr)
-                    sentinel_path.touch()
-                    return
+                    return None
             except FileNotFoundError:
                 print(f"Historic AoH for breeding {taxid} not found, skipping", file=sys.stderr)
-                sentinel_path.touch()
-                return
+                return None
             try:
-                _, historic_aoh_non_breeding = open_layer(historic_aohs_path / nonbreeding_filename)
+                historic_aoh_non_breeding = load_total(historic_aohs_path / nonbreeding_filename, totals)
                 if historic_aoh_non_breeding == 0.0:
                     print(f"Historic AoH for non breeding {taxid} is zero, skipping", file=sys.stderr)
-                    sentinel_path.touch()
-                    return
+                    return None
             except FileNotFoundError:
                 print(f"Historic AoH for non breeding {taxid} not found, skipping", file=sys.stderr)
-                sentinel_path.touch()
-                return
-
-            if scenario_aohs_path.name != "nan":
-                non_breeding_scenario_path = scenario_aohs_path / nonbreeding_filename
-                breeding_scenario_path = scenario_aohs_path / breeding_filename
-            else:
-                non_breeding_scenario_path = Path("nan") # nan path is the sentinel from csv inputs
-                breeding_scenario_path = Path("nan")
+                return None
 
             try:
-                current_breeding, current_aoh_breeding = open_layer(current_aohs_path / breeding_filename)
+                current_breeding, current_aoh_breeding = open_layer(current_aohs_path / breeding_filename, totals)
             except FileNotFoundError:
                 print(f"Failed to open current breeding {current_aohs_path / breeding_filename}", file=sys.stderr)
-                sentinel_path.touch()
-                return
+                return None
             try:
-                current_non_breeding, current_aoh_non_breeding = open_layer(current_aohs_path / nonbreeding_filename)
+                current_non_breeding, current_aoh_non_breeding = open_layer(
+                    current_aohs_path / nonbreeding_filename,
+                    totals,
+                )
             except FileNotFoundError:
                 print(f"Failed to open current non breeding {current_aohs_path / nonbreeding_filename}",
                     file=sys.stderr)
-                sentinel_path.touch()
-                return
-            try:
-                scenario_breeding: yg.YirgacheffeLayer | float
-                scenario_breeding, _ = open_layer(breeding_scenario_path)
-            except FileNotFoundError:
-                # If there is a current but now scenario file it's because the species went extinct under the scenario
-                scenario_breeding = 0.0
-            try:
-                scenario_non_breeding: yg.YirgacheffeLayer | float
-                scenario_non_breeding, _ = open_layer(non_breeding_scenario_path)
-            except FileNotFoundError:
-                # If there is a current but now scenario file it's because the species went extinct under the scenario
-                scenario_non_breeding = 0.0
-
-            persistence_breeding = calc_persistence_value(
-                current_aoh_breeding,
-                historic_aoh_breeding,
-                exponent,
-            )
-
-            persistence_non_breeding = calc_persistence_value(
-                current_aoh_non_breeding,
-                historic_aoh_non_breeding,
-                exponent,
-            )
-
-            old_persistence = (persistence_breeding ** 0.5) * (persistence_non_breeding ** 0.5)
-
-            # In general Yirgacheffe can infer the behaviour needed for area intersections based on
-            # operator, but in this instance we want to force the calculation to take place for the
-            # union of the areas involved.
-            src_layers = [current_breeding, scenario_breeding, current_non_breeding, scenario_non_breeding]
-            layers = [x for x in src_layers if isinstance(x, yg.YirgacheffeLayer)]
-            union = yg.layers.RasterLayer.find_union(layers)
-            for layer in layers:
-                layer.set_window_for_union(union)
-
-            new_p_breeding = process_delta_p(
-                current_breeding,
-                scenario_breeding,
-                current_aoh_breeding,
-                historic_aoh_breeding,
-                exponent,
-            )
-            new_p_non_breeding = process_delta_p(
-                current_non_breeding,
-                scenario_non_breeding,
-                current_aoh_non_breeding,
-                historic_aoh_non_breeding,
-                exponent,
-            )
-            new_p_layer = (new_p_breeding ** 0.5) * (new_p_non_breeding ** 0.5)
-
-            delta_p_layer = new_p_layer - old_persistence
+                return None
 
-            try:
-                delta_p_layer.to_geotiff(output_path)
-            except ValueError:
-                print(f"Failed to align layers for {taxid}_{season}", file=sys.stderr)
-                sentinel_path.touch()
-                return
-
-            sentinel_path.touch()
+            return [
+                SeasonAOH(current_breeding, current_aoh_breeding, historic_aoh_breeding),
+                SeasonAOH(current_non_breeding, current_aoh_non_breeding, historic_aoh_non_breeding),
+            ]
         case "BREEDING":
             # covered by the nonbreeding case
-            sentinel_path.touch()
+            return None
         case _:
+            raise ValueError(f"Unexpected season for species {taxid}: {season}")
+
+def load_scenario(
+    taxid: str,
+    season: str,
+    scenario_aohs_path: Path,
+    totals: AOHTotals | None = None,
+) -> list[yg.YirgacheffeLayer | float]:
+    """Load the scenario AOHs for a species, in the same order as the seasons from load_species. If
+    there is a current AOH but no scenario AOH it is because the species went extinct under
+    the scenario, and so we use zero in its place."""
+    if season == "RESIDENT":
+        filenames = [f"aoh_{taxid}_RESIDENT.tif"]
+    else:
+        filenames = [f"aoh_{taxid}_BREEDING.tif", f"aoh_{taxid}_NONBREEDING.tif"]
+
+    # nan path is the sentinel from csv inputs, and is treated as the species going extinct
+    if scenario_aohs_path.name == "nan":
+        return [0.0] * len(filenames)
+
+    scenarios: list[yg.YirgacheffeLayer | float] = []
+    for filename in filenames:
+        try:
+            layer, _ = open_layer(scenario_aohs_path / filename, totals)
+            scenarios.append(layer)
+        except FileNotFoundError:
+            scenarios.append(0.0)
+    return scenarios
+
+def scenario_unchanged(
+    taxid: str,
+    season: str,
+    species: list[SeasonAOH],
+    scenario_aohs_path: Path,
+    change_mask: ChangeMask | None,
+    totals: AOHTotals | None = None,
+) -> bool:
+    """Check cheaply whether a scenario leaves a species untouched, in which case the delta P
+    is zero everywhere. This needs both the scenario's change mask to show no habitat change
+    within the species' current AOH, and the scenario AOH totals to match the current ones."""
+    if change_mask is None or scenario_aohs_path.name == "nan":
+        return False
+    if season == "RESIDENT":
+        filenames = [f"aoh_{taxid}_RESIDENT.tif"]
+    else:
+        filenames = [f"aoh_{taxid}_BREEDING.tif", f"aoh_{taxid}_NONBREEDING.tif"]
+
+    for season_aoh, filename in zip(species, filenames):
+        try:
+            scenario_aoh = load_total(scenario_aohs_path / filename, totals)
+        except FileNotFoundError:
+            return False
+        if scenario_aoh != season_aoh.current_aoh:
+            return False
+        if change_mask.changed(season_aoh.current.area):
+            return False
+    return True
+
+def buffer_view(buffer: np.ndarray, shape: tuple[int, ...]) -> np.ndarray:
+    """Get an array of the given shape backed by the start of a preallocated flat buffer."""
+    return buffer[:int(np.prod(shape))].reshape(shape)
+
+def migratory_persistence(
+    species: list[SeasonAOH],
+    current_data: list[np.ndarray],
+    scenario_data: list[np.ndarray | float],
+    exponents: list[str | float],
+    out: np.ndarray,
+    scratch: np.ndarray,
+) -> np.ndarray:
+    """Calculate the new persistence for a block of pixels of a migratory species, which is the
+    geometric mean of the breeding and non breeding persistence. Each season is evaluated
+    straight into its own buffer, and then the two are combined in place with a single
+    multiply and square root, rather than taking the root of each season first."""
+    breeding, non_breeding = species
+    process_delta_p(current_data[0], scenario_data[0], breeding.current_aoh, breeding.historic_aoh, exponents, out)
+    non_breeding_p = buffer_view(scratch, out.shape)
+    process_delta_p(
+        current_data[1],
+        scenario_data[1],
+        non_breeding.current_aoh,
+        non_breeding.historic_aoh,
+        exponents,
+        non_breeding_p,
+    )
+    np.multiply(out, non_breeding_p, out=out)
+    np.sqrt(out, out=out)
+    return out
+
+def new_persistence(
+    species: list[SeasonAOH],
+    current_data: list[np.ndarray],
+    scenario_data: list[np.ndarray | float],
+    exponents: list[str | float],
+    out: np.ndarray,
+    scratch: np.ndarray,
+) -> np.ndarray:
+    """Calculate the new persistence for a block of pixels into the output array. The scratch
+    buffer is used for the second season of migratory species, so must be at least as large
+    as the output."""
+    if len(species) > 1:
+        return migratory_persistence(species, current_data, scenario_data, exponents, out, scratch)
+    season = species[0]
+    return process_delta_p(current_data[0], scenario_data[0], season.current_aoh, season.historic_aoh, exponents, out)
+
+def delta_p_chunks(
+    species: list[SeasonAOH],
+    scenarios: list[list[yg.YirgacheffeLayer | float]],
+    exponents: list[str | float],
+    change_masks: list[ChangeMask | None] | None = None,
+) -> tuple[list[yg.Area], Iterator[DeltaPChunk]]:
+    """Calculate the delta P for a species under several scenarios. The data is processed
+    in blocks of rows, and each block of the current AOH rasters is read once and then
+    shared between all the scenarios, so each extra scenario only costs the read of
+    its own AOH rasters.
+
+    Each scenario's result covers the union of the current and scenario AOHs, as this
+    is what the original per scenario calculation generated. These areas are worked out
+    up front, which raises a ValueError if the layers don't align, and are returned along
+    with the chunks, which are only calculated as they are iterated.
+
+    If a scenario has a change mask, then the delta P is only calculated for the tiles in which
+    the scenario changes habitat. Elsewhere the scenario AOH matches the current AOH, and so the
+    delta P is zero, and neither AOH needs to be read."""
+    currents = [x.current for x in species]
+    projection = currents[0].map_projection
+    if change_masks is None:
+        change_masks = [None] * len(scenarios)
+    # The change mask can't be used if the species went extinct under the scenario, as then
+    # the scenario AOH doesn't match current even where the habitat didn't change.
+    change_masks = [
+        mask if all(isinstance(x, yg.YirgacheffeLayer) for x in scenario) else None
+        for mask, scenario in zip(change_masks, scenarios)
+    ]
+
+    # In general Yirgacheffe can infer the behaviour needed for area intersections based on
+    # operator, but in this instance we want to force the calculation to take place for the
+    # union of the areas involved. Union will raise a ValueError if the layers don't align.
+    scenario_areas = []
+    for scenario in scenarios:
+        layers = [x for x in scenario if isinstance(x, yg.YirgacheffeLayer)]
+        area = yg.layers.RasterLayer.find_union(currents + layers)
+        for layer in layers:
+            layer.set_window_for_union(area)
+        scenario_areas.append(area)
+    union = yg.layers.RasterLayer.find_union(currents)
+    for area in scenario_areas:
+        union = union | area
+    for layer in currents:
+        layer.set_window_for_union(union)
+    width, height = currents[0].window.xsize, currents[0].window.ysize
+
+    # Scratch space for the kernel, which is reused for every block so that the only
+    # allocation per block is the result.
+    bands = len(exponents)
+    season_scratch = np.empty(bands * YSTEP * width, dtype=np.float64)
+    changed_scratch = np.empty(bands * YSTEP * width, dtype=np.float64)
+
+    # The old persistence is the new persistence of a pixel where the scenario AOH is the same as
+    # the current AOH, and using the same kernel for both means that such pixels have a delta P of
+    # exactly zero. This is shaped so that it can be subtracted from each band of the new persistence.
+    unchanged_current: list[np.ndarray] = [np.zeros((1, 1))] * len(species)
+    unchanged_scenario: list[np.ndarray | float] = [0.0] * len(species)
+    old_persistence = new_persistence(
+        species,
+        unchanged_current,
+        unchanged_scenario,
+        exponents,
+        np.empty((bands, 1, 1), dtype=np.float64),
+        np.empty(bands, dtype=np.float64),
+    )
+
+    # Where each scenario result sits within the union of all scenarios
+    scenario_windows = [
+        (
+            round((area.left - union.left) / projection.xstep),
+            round((area.top - union.top) / projection.ystep),
+        ) + area.pixel_dimensions
+        for area in scenario_areas
+    ]
+
+    def generate() -> Iterator[DeltaPChunk]:
+        for yoffset in range(0, height, YSTEP):
+            step = min(YSTEP, height - yoffset)
+
+            # Work out which pixels of each scenario need calculating in this block, where None
+            # means the whole block.
+            blocks = []
+            for index, area in enumerate(scenario_areas):
+                xoff, yoff, xsize, ysize = scenario_windows[index]
+                top = max(yoffset, yoff)
+                bottom = min(yoffset + step, yoff + ysize)
+                if top >= bottom:
+                    continue
+                mask = change_masks[index]
+                changed = mask.changed_pixels(area, 0, top - yoff, xsize, bottom - top) if mask is not None else None
+                blocks.append((index, top, bottom, changed))
+            if not blocks:
+                continue
+
+            if all(changed is not None and not changed.any() for _, _, _, changed in blocks):
+                current_chunks = []
+            else:
+                current_chunks = [layer.read_array(0, yoffset, width, step) for layer in currents]
+
+            for index, top, bottom, changed in blocks:
+                xoff, yoff, xsize, ysize = scenario_windows[index]
+                rows = slice(top - yoffset, bottom - yoffset)
+                scenario = scenarios[index]
+
+                data = np.empty((bands, bottom - top, xsize), dtype=np.float64)
+                if changed is None:
+                    current_data = [x[rows, xoff:xoff + xsize] for x in current_chunks]
+                    scenario_data = [
+                        x.read_array(0, top - yoff, xsize, bottom - top) if isinstance(x, yg.YirgacheffeLayer) else x
+                        for x in scenario
+                    ]
+                    new_persistence(species, current_data, scenario_data, exponents, data, season_scratch)
+                    np.subtract(data, old_persistence, out=data)
+                else:
+                    # Pixels the scenario doesn't change have a delta P of zero, and only the columns
+                    # spanning changed tiles need reading and calculating
+                    data.fill(0.0)
+                    changed_columns = np.flatnonzero(changed.any(axis=0))
+                    if len(changed_columns) > 0:
+                        left, right = int(changed_columns[0]), int(changed_columns[-1]) + 1
+                        current_data = [x[rows, xoff + left:xoff + right] for x in current_chunks]
+                        scenario_data = [
+                            x.read_array(left, top - yoff, right - left, bottom - top)
+                            for x in scenario if isinstance(x, yg.YirgacheffeLayer)
+                        ]
+                        changed_data = buffer_view(changed_scratch, (bands, bottom - top, right - left))
+                        new_persistence(species, current_data, scenario_data, exponents, changed_data, season_scratch)
+                        np.subtract(changed_data, old_persistence, out=changed_data)
+                        np.copyto(data[:, :, left:right], changed_data, where=changed[:, left:right])
+
+                yield DeltaPChunk(index, scenario_areas[index], top - yoff, data)
+
+    return scenario_areas, generate()
+
+class DeltaPResult(NamedTuple):
+    """The delta P for a species under several scenarios, which is calculated a chunk at a time as
+    it is iterated, along with which scenarios leave the species unchanged, and the area each
+    scenario's result covers. Unchanged scenarios generate no chunks and have no area."""
+    chunks : Iterator[DeltaPChunk]
+    unchanged : list[bool]
+    areas : list[yg.Area | None]
+
+def calculate_delta_p(
+    taxid: str,
+    season: str,
+    current_aohs_path: Path,
+    scenario_aohs_paths: list[Path],
+    historic_aohs_path: Path,
+    exponents: list[str | float],
+    totals: AOHTotals | None = None,
+    change_masks: dict[str, ChangeMask] | None = None,
+    changed_tiles_only: bool = False,
+) -> DeltaPResult | None:
+    """Set up the delta P calculation for a species under one or more scenarios. This returns
+    None if the species does not contribute a delta P, and raises a ValueError if its layers
+    don't align. If changed_tiles_only is set then the change masks are also used to only
+    calculate the delta P in tiles the scenario changes."""
+    species = load_species(taxid, season, current_aohs_path, historic_aohs_path, totals)
+    if species is None:
+        return None
+
+    # The scenario AOHs are stored as {scenario}/{taxa}
+    change_masks = change_masks or {}
+    unchanged = [
+        scenario_unchanged(taxid, season, species, x, change_masks.get(x.parent.name), totals)
+        for x in scenario_aohs_paths
+    ]
+    changed = [index for index, x in enumerate(unchanged) if not x]
+    if not changed:
+        return DeltaPResult(iter([]), unchanged, [None] * len(unchanged))
+
+    scenarios = [load_scenario(taxid, season, scenario_aohs_paths[x], totals) for x in changed]
+    tile_masks = [change_masks.get(scenario_aohs_paths[x].parent.name) for x in changed] \
+        if changed_tiles_only else None
+    changed_areas, chunks = delta_p_chunks(species, scenarios, exponents, tile_masks)
+    areas: list[yg.Area | None] = [None] * len(unchanged)
+    for index, area in zip(changed, changed_areas):
+        areas[index] = area
+    return DeltaPResult((x._replace(scenario=changed[x.scenario]) for x in chunks), unchanged, areas)
+
+def unchanged_path_for(output_path: Path) -> Path:
+    """Where the marker for a species left unchanged by a scenario goes, which is named as its
+    delta P raster would be, in a directory alongside the rasters."""
+    return output_path.parent / "unchanged" / output_path.stem
+
+def record_unchanged(output_paths: list[Path], unchanged: list[bool]) -> None:
+    """Mark which scenarios leave a species unchanged, for which no delta P is written, and clear
+    the mark for those that don't. As every run sets or clears the marks, along with removing any
+    raster left from an earlier run in which the scenario did change the species, a species is
+    never counted as both contributing and unchanged."""
+    for output_path, is_unchanged in zip(output_paths, unchanged):
+        marker_path = unchanged_path_for(output_path)
+        if is_unchanged:
+            os.makedirs(marker_path.parent, exist_ok=True)
+            marker_path.touch()
+            output_path.unlink(missing_ok=True)
+        else:
+            marker_path.unlink(missing_ok=True)
+
+def curve_labels(exponents: list[str | float]) -> list[str]:
+    return [str(x) for x in exponents]
+
+def save_delta_p(
+    chunks: Iterator[DeltaPChunk],
+    output_paths: list[Path],
+    labels: list[str],
+    datatype: yg.DataType = yg.DataType.Float64,
+) -> None:
+    """Write the delta P for each scenario to its own raster, with a band per curve."""
+    outputs: dict[int,yg.layers.RasterLayer] = {}
+    try:
+        for chunk in chunks:
+            try:
+                output = outputs[chunk.scenario]
+            except KeyError:
+                assert chunk.area.projection is not None
+                output = yg.layers.RasterLayer.empty_raster_layer(
+                    chunk.area,
+                    chunk.area.projection.scale,
+                    datatype,
+                    filename=output_paths[chunk.scenario],
+                    projection=chunk.area.projection.name,
+                    bands=len(labels),
+                )
+                for band, label in enumerate(labels, start=1):
+                    output._dataset.GetRasterBand(band).SetDescription(label) # pylint: disable=W0212
+                outputs[chunk.scenario] = output
+            for band, data in enumerate(chunk.data, start=1):
+                output._dataset.GetRasterBand(band).WriteArray(data, 0, chunk.yoffset) # pylint: disable=W0212
+    finally:
+        for output in outputs.values():
+            output.close()
+
+def global_code_residents_pixel_scenarios(
+    taxid: str,
+    season: str,
+    current_aohs_path: Path,
+    scenario_aohs_paths: list[Path],
+    historic_aohs_path: Path,
+    exponents: list[str | float],
+    output_paths: list[Path],
+    totals: AOHTotals | None = None,
+    change_masks: dict[str, ChangeMask] | None = None,
+    changed_tiles_only: bool = False,
+    datatype: yg.DataType = yg.DataType.Float64,
+    sparse: bool = False,
+) -> None:
+    """Calculate the delta P for a species under several scenarios and curves at once, so that
+    the current AOH and historic totals are only loaded once. If sparse is set then rather than
+    a raster per scenario, the delta P is added to the sparse store alongside where the raster
+    would have been."""
+    if len(scenario_aohs_paths) != len(output_paths):
+        raise ValueError("Expected an output path for each scenario")
+
+    for output_path in output_paths:
+        os.makedirs(output_path.parent, exist_ok=True)
+
+    # snakemake demands we write a file to show we've done something, even if there
+    # is no tiff generated
+    sentinel_paths = [x.parent / f".{taxid}_{season}.done" for x in output_paths]
+
+    if season not in SEASONS:
+        for sentinel_path in sentinel_paths:
             sentinel_path.touch()
-            sys.exit(f"Unexpected season for species {taxid}: {season}")
+        sys.exit(f"Unexpected season for species {taxid}: {season}")
+
+    try:
+        result = calculate_delta_p(
+            taxid,
+            season,
+            current_aohs_path,
+            scenario_aohs_paths,
+            historic_aohs_path,
+            exponents,
+            totals,
+            change_masks,
+            changed_tiles_only,
+        )
+    except ValueError:
+        print(f"Failed to align layers for {taxid}_{season}", file=sys.stderr)
+        result = None
+    if result is not None:
+        if sparse:
+            save_delta_p_store(result.chunks, output_paths, curve_labels(exponents), datatype)
+        else:
+            save_delta_p(result.chunks, output_paths, curve_labels(exponents), datatype)
+    record_unchanged(output_paths, result.unchanged if result is not None else [False] * len(output_paths))
+
+    for sentinel_path in sentinel_paths:
+        sentinel_path.touch()
+
+def global_code_residents_pixel_ae(
+    taxid: str,
+    season: str,
+    current_aohs_path: Path,
+    scenario_aohs_path: Path,
+    historic_aohs_path: Path,
+    exponents: list[str | float],
+    output_path: Path,
+    totals_path: Path | None = None,
+    change_masks_path: Path | None = None,
+    changed_tiles_only: bool = False,
+    precision: str = "float64",
+    sparse: bool = False,
+) -> None:
+    totals = AOHTotals(totals_path, taxid) if totals_path is not None else None
+    # The scenario AOHs are stored as {scenario}/{taxa}
+    change_masks = load_change_masks(change_masks_path, [scenario_aohs_path.parent.name])
+    global_code_residents_pixel_scenarios(
+        taxid,
+        season,
+        current_aohs_path,
+        [scenario_aohs_path],
+        historic_aohs_path,
+        exponents,
+        [output_path],
+        totals,
+        change_masks,
+        changed_tiles_only,
+        STORAGE_TYPES[precision],
+        sparse,
+    )
 
 def exponent_type(value: str):
     if value == "gompertz":
@@ -264,6 +676,14 @@ def exponent_type(value: str):
         raise argparse.ArgumentTypeError(f"numeric exponent must be one of {sorted(FLOAT_EXPONENTS)}, got {f}")
     return f
 
+def exponents_type(value: str) -> list[str | float]:
+    """Several curves can be given separated by commas, each of which becomes a band
+    in the output, in the order given."""
+    exponents = [exponent_type(x.strip()) for x in value.split(",")]
+    if len(set(exponents)) != len(exponents):
+        raise argparse.ArgumentTypeError(f"duplicate exponent in {value!r}")
+    return exponents
+
 @snakemake_compatible(mapping={
     "taxid": "params.taxon_id",
     "season": "params.season",
@@ -271,7 +691,12 @@ def exponent_type(value: str):
     "historic_path": "params.pnv_path",
     "scenario_path": "params.scenario_path",
     "output_path": "params.output_tif",
-    "exponent": "params.curve",
+    "exponents": "params.curve",
+    "totals_path": "input.totals",
+    "change_masks_path": "params.change_masks_dir",
+    "changed_tiles_only": "params.changed_tiles_only",
+    "precision": "params.precision",
+    "sparse": "params.sparse",
 })
 def main() -> None:
     parser = argparse.ArgumentParser()
@@ -318,9 +743,54 @@ def main() -> None:
     )
     parser.add_argument(
         '--z',
-        dest='exponent',
-        type=exponent_type,
-        default=0.25
+        dest='exponents',
+        type=exponents_type,
+        default=[0.25],
+        help="extinction curve, or several comma separated curves to generate a band for each"
+    )
+    parser.add_argument(
+        '--totals',
+        type=Path,
+        required=False,
+        default=None,
+        dest="totals_path",
+        help="AOH totals index, as generated by aoh_totals_index.py, used rather than reading the AOH JSON files"
+    )
+    parser.add_argument(
+        '--change_masks',
+        type=Path,
+        required=False,
+        default=None,
+        dest="change_masks_path",
+        help="Directory of scenario change masks, as generated by change_mask.py, used to skip species "
+            "the scenario does not change"
+    )
+    parser.add_argument(
+        '--changed_tiles_only',
+        action='store_true',
+        default=False,
+        required=False,
+        dest="changed_tiles_only",
+        help="Only calculate delta P in the tiles the change masks show the scenario changes, filling "
+            "the rest with the unchanged value"
+    )
+    parser.add_argument(
+        '--precision',
+        type=str,
+        choices=list(STORAGE_TYPES.keys()),
+        default="float64",
+        required=False,
+        dest="precision",
+        help="Data type used to store the delta P rasters, the calculation is always done in float64"
+    )
+    parser.add_argument(
+        '--sparse',
+        action='store_true',
+        default=False,
+        required=False,
+        dest="sparse",
+        help="Store just the non zero delta P pixels in the sparse store alongside the output path, "
+            "rather than writing a raster"
     )
     args = parser.parse_args()
 
@@ -330,8 +800,13 @@ def main() -> None:
         args.current_path,
         args.scenario_path,
         args.historic_path,
-        args.exponent,
+        args.exponents,
         args.output_path,
+        args.totals_path,
+        args.change_masks_path,
+        args.changed_tiles_only,
+        args.precision,
+        args.sparse,
     )
 
 if __name__ == "__main__":
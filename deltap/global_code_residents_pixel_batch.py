@@ -0,0 +1,573 @@
+import argparse
+import json
+import os
+import sys
+from functools import partial, reduce
+from multiprocessing import Pool, cpu_count
+from pathlib import Path
+from typing import Iterator, NamedTuple
+
+import numpy as np
+import pandas as pd
+from snakemake_argparse_bridge import snakemake_compatible # type: ignore
+
+os.environ['YIRGACHEFFE_BACKEND'] = 'NUMPY'
+import yirgacheffe as yg # pylint: disable=C0413
+
+from change_mask import ChangeMask, load_change_masks # pylint: disable=C0413
+from delta_p_store import save_delta_p_store # pylint: disable=C0413
+from global_code_residents_pixel import calculate_delta_p, global_code_residents_pixel_scenarios, \
+    save_delta_p, exponents_type, curve_labels, record_unchanged, AOHTotals, DeltaPChunk, SEASONS, STORAGE_TYPES # pylint: disable=C0413
+
+# How many rows of data we process at once when moving data out of the accumulator
+CHUNK_ROWS = 512
+
+class DeltaPJob(NamedTuple):
+    """The delta P calculations for a species/season under all the scenarios in a manifest"""
+    taxid : str
+    season : str
+    current_path : Path
+    historic_path : Path
+    exponents : list[str | float]
+    scenario_paths : list[Path]
+    output_paths : list[Path]
+
+class DeltaPOptions(NamedTuple):
+    """How each species in the batch is processed"""
+    write_rasters : bool
+    changed_tiles_only : bool
+    datatype : yg.DataType
+    sparse : bool
+
+class DeltaPAccumulator: # pylint: disable=R0903
+    """Sums delta P into a float64 array with the same extent as a reference
+    raster, with a band per curve. The array is backed by a memory mapped file, so only
+    the parts of the map actually covered by species ranges take up memory or disk.
+
+    The accumulator also keeps track of the window of pixels it has added anything to, in a
+    JSON file alongside the array, so that only that window need be read back."""
+
+    def __init__(self, reference_path: Path, filename: Path, bands: int) -> None:
+        with yg.read_raster(reference_path) as reference:
+            self.area = reference.area
+            self.map_projection = reference.map_projection
+            self.shape = (bands, reference.window.ysize, reference.window.xsize)
+        self.data = np.memmap(filename, dtype=np.float64, mode="w+", shape=self.shape)
+        self.extent_path = extent_path_for(filename)
+        self.extent: tuple[int, int, int, int] | None = None
+
+    def offset(self, area: yg.Area) -> tuple[int, int]:
+        """Find where the delta P for an area goes in the accumulator, raising a ValueError
+        if it doesn't fit."""
+        projection = self.map_projection
+        if area.projection != projection:
+            raise ValueError("Delta P map projection does not match accumulator")
+
+        xoff = round((area.left - self.area.left) / projection.xstep)
+        yoff = round((area.top - self.area.top) / projection.ystep)
+        width, height = area.pixel_dimensions
+        if (xoff < 0) or (yoff < 0) or (xoff + width > self.shape[2]) or (yoff + height > self.shape[1]):
+            raise ValueError("Delta P is not within the accumulator area")
+        return xoff, yoff
+
+    def add(self, chunk: DeltaPChunk) -> None:
+        bands, height, width = chunk.data.shape
+        if bands != self.shape[0]:
+            raise ValueError("Delta P curves do not match accumulator")
+        xoff, yoff = self.offset(chunk.area)
+        yoff += chunk.yoffset
+        self.data[:, yoff:yoff + height, xoff:xoff + width] += chunk.data
+
+        extent = (xoff, yoff, xoff + width, yoff + height)
+        if self.extent is not None:
+            extent = union_extent(self.extent, extent)
+        if extent != self.extent:
+            self.extent = extent
+            with open(self.extent_path, "w", encoding="utf-8") as f:
+                json.dump(extent, f)
+
+def extent_path_for(filename: Path) -> Path:
+    return filename.with_suffix(".json")
+
+def union_extent(a: tuple[int, int, int, int], b: tuple[int, int, int, int]) -> tuple[int, int, int, int]:
+    """The smallest window, as left, top, right, and bottom pixels, covering both windows."""
+    return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+def partials_path_for(output_path: Path) -> Path:
+    return output_path.parent / "partials"
+
+# Each worker process in the pool has its own accumulators, one per output directory, as
+# there is no locking between workers.
+_ACCUMULATORS: dict[Path,DeltaPAccumulator] = {}
+_ACCUMULATOR_SETTINGS: tuple[Path, int, int] | None = None
+
+# The AOH totals index and change masks are loaded once per worker rather than being sent
+# with every job
+_TOTALS: AOHTotals | None = None
+_CHANGE_MASKS: dict[str, ChangeMask] = {}
+
+def init_worker(
+    totals_path: Path | None,
+    change_masks_path: Path | None,
+    scenarios: list[str],
+    accumulator_settings: tuple[Path, int, int] | None,
+) -> None:
+    global _ACCUMULATOR_SETTINGS, _TOTALS, _CHANGE_MASKS # pylint: disable=W0603
+    _ACCUMULATOR_SETTINGS = accumulator_settings
+    _TOTALS = AOHTotals(totals_path) if totals_path is not None else None
+    _CHANGE_MASKS = load_change_masks(change_masks_path, scenarios)
+
+def get_accumulator(partials_path: Path) -> DeltaPAccumulator:
+    try:
+        return _ACCUMULATORS[partials_path]
+    except KeyError:
+        assert _ACCUMULATOR_SETTINGS is not None
+        reference_path, chunk, bands = _ACCUMULATOR_SETTINGS
+        accumulator = DeltaPAccumulator(reference_path, partials_path / f"chunk_{chunk}_{os.getpid()}.dat", bands)
+        _ACCUMULATORS[partials_path] = accumulator
+        return accumulator
+
+def combine_partials(
+    reference_path: Path,
+    partial_paths: list[Path],
+    output_path: Path,
+    labels: list[str],
+) -> None:
+    """Sum the worker accumulators into a raster covering just the window that any of them added
+    delta P to, reading only the window each one touched."""
+    with yg.read_raster(reference_path) as reference:
+        reference_area = reference.area
+        projection = reference.map_projection
+        full_height, full_width = reference.window.ysize, reference.window.xsize
+
+    extents = {}
+    for partial_path in partial_paths:
+        try:
+            with open(extent_path_for(partial_path), "r", encoding="utf-8") as f:
+                extents[partial_path] = tuple(json.load(f))
+        except FileNotFoundError:
+            # The worker never added anything to this accumulator
+            continue
+    if extents:
+        left, top, right, bottom = reduce(union_extent, extents.values())
+    else:
+        # Nothing in this chunk contributed, but a sum is still needed, so it is a single empty pixel
+        left, top, right, bottom = 0, 0, 1, 1
+    width = right - left
+
+    area = yg.Area(
+        left=reference_area.left + (left * projection.xstep),
+        top=reference_area.top + (top * projection.ystep),
+        right=reference_area.left + (right * projection.xstep),
+        bottom=reference_area.top + (bottom * projection.ystep),
+        projection=projection,
+    )
+    result = yg.layers.RasterLayer.empty_raster_layer(
+        area,
+        projection.scale,
+        yg.DataType.Float64,
+        filename=output_path,
+        projection=projection.name,
+        bands=len(labels),
+    )
+    shape = (len(labels), full_height, full_width)
+    partials = [
+        (np.memmap(x, dtype=np.float64, mode="r", shape=shape), extent)
+        for x, extent in extents.items()
+    ]
+
+    try:
+        for index, label in enumerate(labels):
+            band = result._dataset.GetRasterBand(index + 1) # pylint: disable=W0212
+            band.SetDescription(label)
+            for yoffset in range(top, bottom, CHUNK_ROWS):
+                step = min(CHUNK_ROWS, bottom - yoffset)
+                total = np.zeros((step, width), dtype=np.float64)
+                for data, (partial_left, partial_top, partial_right, partial_bottom) in partials:
+                    start, end = max(yoffset, partial_top), min(yoffset + step, partial_bottom)
+                    if start >= end:
+                        continue
+                    total[start - yoffset:end - yoffset, partial_left - left:partial_right - left] += \
+                        data[index, start:end, partial_left:partial_right]
+                band.WriteArray(total, 0, yoffset - top)
+    finally:
+        result.close()
+
+def clear_stale_chunks(partials_path: Path, chunks: int) -> None:
+    """Remove the sums left by chunks beyond the current number of chunks, from a run when there
+    were more, as otherwise they would be summed along with the current ones."""
+    for stale in list(partials_path.glob("chunk_*.tif")) + list(partials_path.glob("chunk_*.csv")):
+        index = stale.stem.removeprefix("chunk_")
+        if index.isdigit() and int(index) >= chunks:
+            stale.unlink(missing_ok=True)
+
+def load_manifest(
+    manifest_path: Path,
+    chunk: int,
+    chunks: int,
+) -> list[DeltaPJob]:
+    """Load the species list generated by persistencegenerator.py, and select every
+    nth species starting at the chunk index, so that the work can be split over several jobs.
+    The manifest has a row per species per scenario, and these are grouped so that all the
+    scenarios for a species are calculated together."""
+    if not 0 <= chunk < chunks:
+        raise ValueError(f"Chunk {chunk} is out of range for {chunks} chunks")
+
+    # Everything is read as a string, as otherwise pandas will turn the exponent into a float
+    # and any missing scenario paths into NaN.
+    manifest = pd.read_csv(manifest_path, dtype=str, keep_default_na=False)
+
+    grouped = manifest.groupby(
+        ["--taxid", "--season", "--current_path", "--historic_path", "--z"],
+        sort=False,
+    )
+    jobs = [
+        DeltaPJob(
+            str(taxid),
+            str(season),
+            Path(str(current_path)),
+            Path(str(historic_path)),
+            exponents_type(str(exponents)),
+            # An empty path here is the same as the "nan" sentinel used when the csv is
+            # processed by littlejohn
+            [Path(x or "nan") for x in rows["--scenario_path"]],
+            [Path(x) for x in rows["--output_path"]],
+        )
+        for (taxid, season, current_path, historic_path, exponents), rows in grouped
+    ]
+    return jobs[chunk::chunks]
+
+def accumulate_chunks(
+    chunks: Iterator[DeltaPChunk],
+    accumulators: list[DeltaPAccumulator],
+    contributed: list[bool],
+) -> Iterator[DeltaPChunk]:
+    """Add each chunk to the accumulator for its scenario, and note which scenarios got any."""
+    for chunk in chunks:
+        accumulators[chunk.scenario].add(chunk)
+        contributed[chunk.scenario] = True
+        yield chunk
+
+def accumulate_job(job: DeltaPJob, options: DeltaPOptions) -> tuple[bool, list[bool]]:
+    for output_path in job.output_paths:
+        os.makedirs(output_path.parent, exist_ok=True)
+    sentinel_paths = [x.parent / f".{job.taxid}_{job.season}.done" for x in job.output_paths]
+
+    if job.season not in SEASONS:
+        print(f"Unexpected season for species {job.taxid}: {job.season}", file=sys.stderr)
+        for sentinel_path in sentinel_paths:
+            sentinel_path.touch()
+        return False, [False] * len(job.output_paths)
+
+    # A species is only added to the sums once we know all of it fits, so that one which fails
+    # to align is left out entirely rather than partly summed
+    accumulators = [get_accumulator(partials_path_for(x)) for x in job.output_paths]
+    try:
+        result = calculate_delta_p(
+            job.taxid,
+            job.season,
+            job.current_path,
+            job.scenario_paths,
+            job.historic_path,
+            job.exponents,
+            _TOTALS,
+            _CHANGE_MASKS,
+            options.changed_tiles_only,
+        )
+        if result is not None:
+            for accumulator, area in zip(accumulators, result.areas):
+                if area is not None:
+                    accumulator.offset(area)
+    except ValueError:
+        print(f"Failed to align layers for {job.taxid}_{job.season}", file=sys.stderr)
+        result = None
+
+    # Only scenarios that actually generated delta P contributed to their sums, as the
+    # others either left the species unchanged or failed
+    contributed = [False] * len(job.output_paths)
+    if result is not None:
+        accumulated = accumulate_chunks(result.chunks, accumulators, contributed)
+        if options.write_rasters and options.sparse:
+            save_delta_p_store(accumulated, job.output_paths, curve_labels(job.exponents), options.datatype)
+        elif options.write_rasters:
+            save_delta_p(accumulated, job.output_paths, curve_labels(job.exponents), options.datatype)
+        else:
+            for _ in accumulated:
+                pass
+
+    record_unchanged(job.output_paths, result.unchanged if result is not None else [False] * len(job.output_paths))
+    for sentinel_path in sentinel_paths:
+        sentinel_path.touch()
+    return True, contributed
+
+def process_job(job: DeltaPJob, options: DeltaPOptions) -> tuple[DeltaPJob, bool, list[bool]]:
+    """Process a single species, returning whether it succeeded, and for each scenario whether it
+    contributed to the accumulated sums if we are accumulating."""
+    if _ACCUMULATOR_SETTINGS is not None:
+        success, contributed = accumulate_job(job, options)
+        return job, success, contributed
+
+    # global_code_residents_pixel_scenarios will exit if the season is not recognised, which in a pool
+    # worker would take down the worker rather than just fail this species.
+    try:
+        global_code_residents_pixel_scenarios(
+            job.taxid,
+            job.season,
+            job.current_path,
+            job.scenario_paths,
+            job.historic_path,
+            job.exponents,
+            job.output_paths,
+            _TOTALS,
+            _CHANGE_MASKS,
+            options.changed_tiles_only,
+            options.datatype,
+            options.sparse,
+        )
+    except SystemExit as exc:
+        print(f"Failed to process {job.taxid}_{job.season}: {exc}", file=sys.stderr)
+        return job, False, [False] * len(job.output_paths)
+    return job, True, [False] * len(job.output_paths)
+
+def global_code_residents_pixel_batch(
+    manifest_path: Path,
+    chunk: int,
+    chunks: int,
+    processes_count: int,
+    totals_path: Path | None,
+    change_masks_path: Path | None,
+    reference_path: Path | None,
+    accumulate: bool,
+    options: DeltaPOptions,
+    sentinel_paths: list[Path],
+) -> None:
+    jobs = load_manifest(manifest_path, chunk, chunks)
+    print(f"Processing {len(jobs)} species in chunk {chunk} of {chunks}")
+
+    partials_paths = {partials_path_for(x) for job in jobs for x in job.output_paths}
+    # The scenario AOHs are stored as {scenario}/{taxa}
+    scenarios = sorted({x.parent.name for job in jobs for x in job.scenario_paths if x.name != "nan"})
+
+    # The accumulated sums have a band per curve, so every species must use the same curves
+    curves = {tuple(job.exponents) for job in jobs}
+    labels = curve_labels(jobs[0].exponents) if jobs else []
+    if accumulate:
+        if reference_path is None:
+            sys.exit("A reference raster is required to accumulate delta P")
+        if len(curves) > 1:
+            sys.exit("All species must use the same curves to accumulate delta P")
+        for partials_path in partials_paths:
+            os.makedirs(partials_path, exist_ok=True)
+            # Clear out anything left behind by a previous failed run, or by a run with more chunks
+            for stale in list(partials_path.glob(f"chunk_{chunk}_*.dat")) + \
+                    list(partials_path.glob(f"chunk_{chunk}_*.json")):
+                stale.unlink()
+            clear_stale_chunks(partials_path, chunks)
+        accumulator_settings: tuple[Path, int, int] | None = (reference_path, chunk, len(labels))
+    else:
+        if not options.write_rasters:
+            sys.exit("Per species rasters can only be skipped when accumulating delta P")
+        accumulator_settings = None
+
+    failed = []
+    contributors = []
+    with Pool(
+        processes=processes_count,
+        initializer=init_worker,
+        initargs=(totals_path, change_masks_path, scenarios, accumulator_settings),
+    ) as pool:
+        # The per species work varies massively in size, from a handful of pixels to
+        # a global map, so we don't batch up jobs to the workers
+        results = pool.imap_unordered(
+            partial(process_job, options=options),
+            jobs,
+            chunksize=1,
+        )
+        for count, (job, success, contributed) in enumerate(results, start=1):
+            if not success:
+                failed.append(job)
+            if any(contributed):
+                contributors.append((job, contributed))
+            if count % 1000 == 0:
+                print(f"Processed {count} of {len(jobs)} species")
+
+    if failed:
+        sys.exit(f"Failed to process {len(failed)} species")
+
+    if accumulate:
+        assert reference_path is not None
+        for partials_path in partials_paths:
+            worker_partials = list(partials_path.glob(f"chunk_{chunk}_*.dat"))
+            combine_partials(reference_path, worker_partials, partials_path / f"chunk_{chunk}.tif", labels)
+            for worker_partial in worker_partials:
+                worker_partial.unlink()
+                extent_path_for(worker_partial).unlink(missing_ok=True)
+
+            # Without the per species rasters we need to record which species contributed
+            # to the sum so that they can still be counted.
+            contributors_df = pd.DataFrame(
+                [
+                    [job.taxid, job.season] for job, contributed in contributors
+                    if any(
+                        is_contributor and partials_path_for(output_path) == partials_path
+                        for output_path, is_contributor in zip(job.output_paths, contributed)
+                    )
+                ],
+                columns=["taxid", "season"],
+            )
+            contributors_df.to_csv(partials_path / f"chunk_{chunk}.csv", index=False)
+
+    # The per species sentinels are written by each job, but snakemake needs one
+    # output to say when the chunk is done.
+    for sentinel_path in sentinel_paths:
+        os.makedirs(sentinel_path.parent, exist_ok=True)
+        sentinel_path.touch()
+
+@snakemake_compatible(mapping={
+    "manifest_path": "input.manifest",
+    "chunk": "params.chunk",
+    "chunks": "params.chunks",
+    "totals_path": "input.totals",
+    "change_masks_path": "params.change_masks_dir",
+    "changed_tiles_only": "params.changed_tiles_only",
+    "precision": "params.precision",
+    "sparse": "params.sparse",
+    "reference_path": "params.reference",
+    "accumulate": "params.accumulate",
+    "write_rasters": "params.write_rasters",
+    "processes_count": "threads",
+    "sentinel_paths": "output.sentinels",
+})
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Calculate delta P for many species in a single process pool.")
+    parser.add_argument(
+        '--manifest',
+        type=Path,
+        required=True,
+        dest='manifest_path',
+        help="CSV of species to process, as generated by persistencegenerator.py",
+    )
+    parser.add_argument(
+        '--chunk',
+        type=int,
+        required=False,
+        default=0,
+        dest='chunk',
+        help="Which chunk of the manifest to process",
+    )
+    parser.add_argument(
+        '--chunks',
+        type=int,
+        required=False,
+        default=1,
+        dest='chunks',
+        help="How many chunks the manifest is split into",
+    )
+    parser.add_argument(
+        '--totals',
+        type=Path,
+        required=False,
+        default=None,
+        dest='totals_path',
+        help="AOH totals index, as generated by aoh_totals_index.py, used rather than reading the AOH JSON files",
+    )
+    parser.add_argument(
+        '--change_masks',
+        type=Path,
+        required=False,
+        default=None,
+        dest='change_masks_path',
+        help="Directory of scenario change masks, as generated by change_mask.py, used to skip species "
+            "the scenario does not change",
+    )
+    parser.add_argument(
+        '--changed_tiles_only',
+        action='store_true',
+        default=False,
+        required=False,
+        dest='changed_tiles_only',
+        help="Only calculate delta P in the tiles the change masks show the scenario changes, filling "
+            "the rest with the unchanged value",
+    )
+    parser.add_argument(
+        '--precision',
+        type=str,
+        choices=list(STORAGE_TYPES.keys()),
+        default="float64",
+        required=False,
+        dest='precision',
+        help="Data type used to store the delta P rasters, the calculation is always done in float64",
+    )
+    parser.add_argument(
+        '--sparse',
+        action='store_true',
+        default=False,
+        required=False,
+        dest='sparse',
+        help="Store just the non zero delta P pixels in a sparse store alongside the outputs, rather than "
+            "writing per species rasters",
+    )
+    parser.add_argument(
+        '--reference',
+        type=Path,
+        required=False,
+        default=None,
+        dest='reference_path',
+        help="Raster that defines the extent and pixel grid of the accumulated delta P",
+    )
+    parser.add_argument(
+        '--accumulate',
+        action='store_true',
+        default=False,
+        required=False,
+        dest='accumulate',
+        help="If set, add each species delta P into a sum for the chunk, stored in a partials directory "
+            "next to the per species outputs",
+    )
+    parser.add_argument(
+        '--no_species_rasters',
+        action='store_false',
+        default=True,
+        required=False,
+        dest='write_rasters',
+        help="When accumulating, do not also write the per species delta P rasters",
+    )
+    parser.add_argument(
+        '-j',
+        type=int,
+        required=False,
+        default=cpu_count() // 2,
+        dest='processes_count',
+        help="Number of concurrent processes to use.",
+    )
+    # There is no type, as under Snakemake the whole list of sentinels would be passed to it
+    parser.add_argument(
+        '--sentinel',
+        nargs='*',
+        help='Generate sentinel files on completion for snakemake to track',
+        required=False,
+        default=[],
+        dest='sentinel_paths',
+    )
+    args = parser.parse_args()
+
+    global_code_residents_pixel_batch(
+        args.manifest_path,
+        args.chunk,
+        args.chunks,
+        args.processes_count,
+        args.totals_path,
+        args.change_masks_path,
+        args.reference_path,
+        args.accumulate,
+        DeltaPOptions(
+            args.write_rasters,
+            args.changed_tiles_only,
+            STORAGE_TYPES[args.precision],
+            args.sparse,
+        ),
+        [Path(x) for x in args.sentinel_paths],
+    )
+
+if __name__ == "__main__":
+    main()
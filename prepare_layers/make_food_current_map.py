@@ -5,7 +5,7 @@ import resource
 import sys
 import time
 from pathlib import Path
-from multiprocessing import Process, cpu_count
+from multiprocessing import Process, cpu_count, shared_memory
 from queue import Queue
 from typing import NamedTuple
 from osgeo import gdal
@@ -22,6 +22,15 @@ PASTURE_CODE = 1402
 # Codes not to touch. We're currently working at Level 1 except for artificial which is level 2
 PRESERVE_CODES = [600, 700, 900, 1000, 1100, 1200, 1300, 1405]
 
+# How many tiles each worker can have in flight before waiting for the assemblers to catch up
+SLOTS_PER_WORKER = 4
+
+# How many tiles are handed to a worker at once
+TILES_PER_BATCH = 256
+
+# In strip mode, the most adjacent tiles along a row that are processed together
+STRIP_TILES = 16
+
 # PNV codes
 # array([ 100,  200,  300,  400,  500,  600,  800,  900, 1100, 1200], dtype=uint16)
 
@@ -34,6 +43,100 @@ class TileInfo(NamedTuple):
     crop_target : float
     pasture_target : float
 
+def tile_dtype(crop_dtype: np.dtype, pasture_dtype: np.dtype) -> np.dtype:
+    """The tile list is kept as a structured array with the fields of TileInfo, as there are millions
+    of tiles. The targets keep the type of the rasters they come from, as that sets the precision of
+    the sums they take part in."""
+    return np.dtype([(name, np.int64) for name in TileInfo._fields[:4]] + \
+        [("crop_target", crop_dtype), ("pasture_target", pasture_dtype)])
+
+def tile_at(tiles: np.ndarray, index: int) -> TileInfo:
+    row = tiles[index]
+    return TileInfo(
+        int(row["x_position"]),
+        int(row["y_position"]),
+        int(row["width"]),
+        int(row["height"]),
+        row["crop_target"],
+        row["pasture_target"],
+    )
+
+class TileSlots:
+    """A pool of slots in shared memory, each big enough to hold one tile of every land cover class.
+    Workers write the result for a tile into a free slot, and only the tile and slot number are sent
+    over the queues to the assemblers, which read their class straight from shared memory. Once every
+    assembler has written out its class of a tile the slot goes back in the pool."""
+
+    def __init__(self, dtypes: dict[int,np.dtype], max_width: int, max_height: int, slot_count: int) -> None:
+        self.offsets: dict[int,tuple[int,np.dtype]] = {}
+        offset = 0
+        for lcc, dtype in dtypes.items():
+            self.offsets[lcc] = (offset, np.dtype(dtype))
+            offset += max_width * max_height * np.dtype(dtype).itemsize
+        self.slot_size = offset
+        self.memory = shared_memory.SharedMemory(create=True, size=max(1, self.slot_size * slot_count))
+        self.free: multiprocessing.queues.Queue = multiprocessing.Queue()
+        for slot in range(slot_count):
+            self.free.put(slot)
+        # How many assemblers have still to read each slot
+        self.pending = multiprocessing.Array('i', slot_count)
+
+    def view(self, slot: int, lcc: int, tile: TileInfo) -> np.ndarray:
+        offset, dtype = self.offsets[lcc]
+        return np.ndarray(
+            (tile.height, tile.width),
+            dtype=dtype,
+            buffer=self.memory.buf,
+            offset=(slot * self.slot_size) + offset,
+        )
+
+    def acquire(self) -> int:
+        slot = self.free.get()
+        # Nothing else can touch a slot until it is handed to the assemblers
+        self.pending[slot] = len(self.offsets)
+        return slot
+
+    def release(self, slot: int) -> None:
+        with self.pending.get_lock():
+            self.pending[slot] -= 1
+            done = self.pending[slot] == 0
+        if done:
+            self.free.put(slot)
+
+    def close(self) -> None:
+        self.memory.close()
+        self.memory.unlink()
+
+class LandCover(NamedTuple):
+    """The land cover classes of an area held as a single (n_classes, height, width) array, with the
+    classes in ascending order of their codes. Rules that apply to every class, such as reallocating
+    land to its PNV class, are then a single array operation rather than a loop over the classes."""
+    codes : np.ndarray
+    data : np.ndarray
+
+    @classmethod
+    def from_map(cls, lcc_data_map: dict[int,np.ndarray]) -> "LandCover":
+        codes = np.array(sorted(lcc_data_map))
+        return cls(codes, np.stack([lcc_data_map[lcc] for lcc in codes]))
+
+    def as_map(self) -> dict[int,np.ndarray]:
+        return {int(lcc): self.data[index] for index, lcc in enumerate(self.codes)}
+
+    def layer(self, lcc: int) -> np.ndarray:
+        index = np.searchsorted(self.codes, lcc)
+        assert self.codes[index] == lcc
+        return self.data[index]
+
+    def indices(self, codes: list[int], invert: bool = False) -> np.ndarray:
+        """The indices of the classes with the given codes, or with any other code if inverted."""
+        return np.flatnonzero(np.isin(self.codes, codes, invert=invert))
+
+    def class_index(self, values: np.ndarray) -> np.ndarray:
+        """Map an array of land cover codes, such as the PNV, to class indices, with -1 for codes
+        that aren't one of the classes."""
+        index = np.minimum(np.searchsorted(self.codes, values), len(self.codes) - 1)
+        return np.where(self.codes[index] == values, index, -1)
+
 def balance_crop_and_pasture_differences(
     crop_diff: float,
     pasture_diff: float,
@@ -88,12 +191,12 @@ def remove_land_cover(
     lcc_code: int,
     diff: float,
     pnv: np.ndarray,
-    lcc_data_map: dict[int,np.ndarray],
+    land_cover: LandCover,
 ) -> None:
     assert diff <= 0
     diff = abs(diff)
 
-    agri_raster = lcc_data_map[lcc_code]
+    agri_raster = land_cover.layer(lcc_code)
     removal_mask = agri_raster > 0
 
     current_coverage = agri_raster.sum() / agri_raster.size
@@ -106,15 +209,15 @@ def remove_land_cover(
     agri_raster -= removed_grid
 
     # Reallocate to PNV classes - note we assume this does not include the agricultural classes
-    # so as to not undo what we just did!
-    for lcc, lcc_data in lcc_data_map.items():
-        pnv_match = (pnv == lcc) & removal_mask
-        lcc_data[pnv_match] += removed_grid[pnv_match]
+    # so as to not undo what we just did! Each cell goes to a single class, so this is one scatter.
+    pnv_index = land_cover.class_index(pnv)
+    pnv_match = removal_mask & (pnv_index >= 0)
+    land_cover.data[(pnv_index[pnv_match],) + np.nonzero(pnv_match)] += removed_grid[pnv_match]
 
 def add_land_cover(
     eligible_mask: np.ndarray,
     diffs: list[tuple[float, int]],
-    lcc_data_map: dict[int,np.ndarray],
+    land_cover: LandCover,
 ) -> None:
 
     # Calculate capacity
@@ -130,7 +233,7 @@ def add_land_cover(
     for diff, lcc_code in diffs:
         assert 0 <= diff <= 1
 
-        agri_raster = lcc_data_map[lcc_code]
+        agri_raster = land_cover.layer(lcc_code)
 
         per_cell_addition = diff / eligible_fraction
         per_cell_addition = min(per_cell_addition, 1.0)
@@ -142,48 +245,77 @@ def add_land_cover(
     # stage the LCC pixels are:
     # * only non-zero in a single layer
     # * only starting at 100%
-    for lcc, lcc_data in lcc_data_map.items():
-        if lcc in [CROP_CODE, PASTURE_CODE] + PRESERVE_CODES:
-            continue
-        lcc_data[eligible_mask & (lcc_data > 0)] -= total_addition
-        lcc_data[eligible_mask] = np.maximum(lcc_data[eligible_mask], 0.0)
+    others = land_cover.indices([CROP_CODE, PASTURE_CODE] + PRESERVE_CODES, invert=True)
+    other_data = land_cover.data[others]
+    np.subtract(other_data, total_addition, out=other_data, where=eligible_mask & (other_data > 0))
+    np.maximum(other_data, 0.0, out=other_data, where=eligible_mask)
+    land_cover.data[others] = other_data
+
+def is_passthrough(tile: TileInfo) -> bool:
+    """Tiles with no agricultural targets are left as they are, so can be copied from the current maps."""
+    return bool(np.isnan(tile.crop_target) and np.isnan(tile.pasture_target))
+
+def agricultural_diffs(
+    tile: TileInfo,
+    crop_data: np.ndarray,
+    pasture_data: np.ndarray,
+) -> tuple[float,float]:
+    """How far the crop and pasture coverage of a tile are from their targets, or zero
+    where there is no target."""
+    if not np.isnan(tile.crop_target):
+        crop_diff = tile.crop_target - (crop_data.sum() / crop_data.size)
+        assert not np.isnan(crop_diff)
+    else:
+        crop_diff = 0
+    if not np.isnan(tile.pasture_target):
+        pasture_diff = tile.pasture_target - (pasture_data.sum() / pasture_data.size)
+        assert not np.isnan(pasture_diff)
+    else:
+        pasture_diff = 0
+    return crop_diff, pasture_diff
+
+def tile_unchanged(
+    current_maps: dict[int,yg.YirgacheffeLayer],
+    tile: TileInfo,
+) -> tuple[bool,dict[int,np.ndarray]]:
+    """Check whether a tile already meets its targets, reading just the crop and pasture maps. The
+    arrays read are returned too, so that process_tile need not read them again."""
+    read_data = {
+        lcc: current_maps[lcc].read_array(tile.x_position, tile.y_position, tile.width, tile.height)
+        for lcc in (CROP_CODE, PASTURE_CODE)
+    }
+    crop_diff, pasture_diff = agricultural_diffs(tile, read_data[CROP_CODE], read_data[PASTURE_CODE])
+    return (crop_diff == 0) and (pasture_diff == 0), read_data
 
 def process_tile(
     current_maps: dict[int,yg.YirgacheffeLayer],
     pnv: yg.YirgacheffeLayer,
     tile: TileInfo,
+    read_data: dict[int,np.ndarray] | None = None,
 ) -> dict[int,np.ndarray]:
+    read_data = read_data or {}
     lcc_data_map = {
-        lcc: current_map.read_array(tile.x_position, tile.y_position, tile.width, tile.height)
+        lcc: (read_data[lcc] if lcc in read_data else
+            current_map.read_array(tile.x_position, tile.y_position, tile.width, tile.height))
         for lcc, current_map in current_maps.items()
     }
 
-    if np.isnan(tile.crop_target) and np.isnan(tile.pasture_target):
+    if is_passthrough(tile):
         return lcc_data_map
 
     for current in current_maps.values():
         assert current.map_projection == pnv.map_projection
         assert current.area == pnv.area
 
-    if not np.isnan(tile.crop_target):
-        crop_data = lcc_data_map[CROP_CODE]
-        crop_diff = tile.crop_target - (crop_data.sum() / crop_data.size)
-        assert not np.isnan(crop_diff)
-    else:
-        crop_diff = 0
-    if not np.isnan(tile.pasture_target):
-        pasture_data = lcc_data_map[PASTURE_CODE]
-        pasture_diff = tile.pasture_target - (pasture_data.sum() / pasture_data.size)
-        assert not np.isnan(pasture_diff)
-    else:
-        pasture_diff = 0
+    crop_diff, pasture_diff = agricultural_diffs(tile, lcc_data_map[CROP_CODE], lcc_data_map[PASTURE_CODE])
     if (crop_diff == 0) and (pasture_diff == 0):
         return lcc_data_map
 
+    land_cover = LandCover.from_map(lcc_data_map)
     crop_diff, pasture_diff = balance_crop_and_pasture_differences(
         crop_diff,
         pasture_diff,
-        lcc_data_map,
+        land_cover.as_map(),
     )
 
     # We first do all the removals and then the additions
@@ -198,22 +330,19 @@ def process_tile(
     for diff_value, habitat_code in removals:
         if pnv_data is None:
             pnv_data = pnv.read_array(tile.x_position, tile.y_position, tile.width, tile.height)
-        remove_land_cover(habitat_code, diff_value, pnv_data, lcc_data_map)
+        remove_land_cover(habitat_code, diff_value, pnv_data, land_cover)
 
     # If there's no additions we don't need to make the eligible_mask, and we can go
     # home early.
     if not additions:
-        return lcc_data_map
+        return land_cover.as_map()
 
     # Find areas we can put the new data. This is anywhere we don't already
     # have agricultural land, and other places unlikely to be converted (cities, lakes, etc.)
     # We know that there should be no partial cells involving crop/pasture at this stage
     # because of the balancing we did initially.
-    excluded_codes = [CROP_CODE, PASTURE_CODE] + PRESERVE_CODES
-    eligible_mask = np.ones_like(lcc_data_map[CROP_CODE], dtype=bool)
-    for excluded_code in excluded_codes:
-        if excluded_code in lcc_data_map:
-            eligible_mask &= (lcc_data_map[excluded_code] == 0)
+    excluded = land_cover.indices([CROP_CODE, PASTURE_CODE] + PRESERVE_CODES)
+    eligible_mask = ~(land_cover.data[excluded] != 0).any(axis=0)
 
     # There is a risk that the total is not achievable as there is a disagreement between the combined
     # GAEZ/HYDE, Jung, and our PRESERVE_CODES list (that say don't covert urban or rocky land to farmland).
@@ -227,16 +356,218 @@ def process_tile(
             for (change, klass) in additions
         ]
 
-    add_land_cover(eligible_mask, additions, lcc_data_map)
+    add_land_cover(eligible_mask, additions, land_cover)
+
+    return land_cover.as_map()
+
 
-    return lcc_data_map
+def segment_sums(data: np.ndarray, bounds: list[tuple[int,int]]) -> np.ndarray:
+    """Sum each segment of columns of a strip. Each segment is copied out and summed as a whole, so that
+    the rounding is exactly that of summing the tile on its own, which a segmented reduction over
+    the strip doesn't guarantee."""
+    return np.array([np.ascontiguousarray(data[:, start:end]).sum() for start, end in bounds])
 
+def process_strip(
+    current_maps: dict[int,yg.YirgacheffeLayer],
+    pnv: yg.YirgacheffeLayer,
+    tiles: list[TileInfo],
+) -> dict[int,np.ndarray] | None:
+    """Process a run of adjacent tiles along a row at once, giving the same results as calling
+    process_tile on each. Each class is read once for the whole strip, and the balancing, removal,
+    and addition rules are applied to every tile in the strip together, with each tile's values
+    spread over its columns. Returns None if no tile in the strip changes."""
+    x_position, y_position, height = tiles[0].x_position, tiles[0].y_position, tiles[0].height
+    width = tiles[-1].x_position + tiles[-1].width - x_position
+    bounds = [(x.x_position - x_position, x.x_position - x_position + x.width) for x in tiles]
+    starts = np.array([start for start, _ in bounds])
+    # Which tile each column of the strip belongs to
+    columns = np.repeat(np.arange(len(tiles)), [x.width for x in tiles])
+
+    def read(layer: yg.YirgacheffeLayer) -> np.ndarray:
+        return layer.read_array(x_position, y_position, width, height)
+
+    def per_tile(lcc_data_map: dict[int,np.ndarray]) -> dict[int,np.ndarray]:
+        res = {
+            lcc: lcc_data_map[lcc] if lcc in lcc_data_map else read(current_map)
+            for lcc, current_map in current_maps.items()
+        }
+        for tile, (start, end) in zip(tiles, bounds):
+            for lcc, data in process_tile(current_maps, pnv, tile).items():
+                res[lcc][:, start:end] = data
+        return res
+
+    crop_data = read(current_maps[CROP_CODE])
+    pasture_data = read(current_maps[PASTURE_CODE])
+    crop_sums = segment_sums(crop_data, bounds)
+    pasture_sums = segment_sums(pasture_data, bounds)
+    crop_targets = np.array([x.crop_target for x in tiles])
+    pasture_targets = np.array([x.pasture_target for x in tiles])
+    # The diffs take the types they would for a single tile, where the targets may be Python floats
+    diff_type = np.result_type(*[x.crop_target for x in tiles], crop_sums.dtype)
+    if (diff_type != np.result_type(*[x.pasture_target for x in tiles], pasture_sums.dtype)) or \
+            (crop_data.dtype != pasture_data.dtype):
+        # The rules mix crop and pasture values, which can't be done together for every tile
+        # if they have different types, so we fall back to doing each tile on its own.
+        return per_tile({CROP_CODE: crop_data, PASTURE_CODE: pasture_data})
+
+    sizes = np.array([x.width * x.height for x in tiles])
+    data_sizes = sizes.astype(crop_data.dtype)
+    with np.errstate(invalid="ignore"):
+        crop_diff = (crop_targets.astype(diff_type) - (crop_sums / data_sizes)).astype(diff_type)
+        pasture_diff = (pasture_targets.astype(diff_type) - (pasture_sums / data_sizes)).astype(diff_type)
+    crop_diff[np.isnan(crop_targets)] = 0
+    pasture_diff[np.isnan(pasture_targets)] = 0
+    assert not np.isnan(crop_diff).any()
+    assert not np.isnan(pasture_diff).any()
+    if not (crop_diff.any() or pasture_diff.any()):
+        return None
+
+    lcc_data_map = {CROP_CODE: crop_data, PASTURE_CODE: pasture_data}
+    for lcc, current_map in current_maps.items():
+        if lcc not in lcc_data_map:
+            lcc_data_map[lcc] = read(current_map)
+    if len({x.dtype for x in lcc_data_map.values()}) > 1:
+        # The classes are stacked in a common type, so the rules wouldn't be working with the
+        # crop and pasture sums above.
+        return per_tile(lcc_data_map)
+    land_cover = LandCover.from_map(lcc_data_map)
+    for current in current_maps.values():
+        assert current.map_projection == pnv.map_projection
+        assert current.area == pnv.area
+
+    # Balance crop and pasture where one is removed and the other added, as in
+    # balance_crop_and_pasture_differences.
+    balance = (crop_diff * pasture_diff) < 0
+    if balance.any():
+        transfer_amount = np.minimum(np.abs(crop_diff), np.abs(pasture_diff))
+        crop_increasing = crop_diff > 0
+        src_sums = np.where(crop_increasing, pasture_sums, crop_sums)
+        empty = np.flatnonzero(balance & (src_sums == 0))
+        if empty.size:
+            index = empty[0]
+            if crop_increasing[index]:
+                raise ValueError(f"not cells in pasture {src_sums[index]}, but pasture diff is -ve "
+                    f"{pasture_diff[index]}")
+            raise ValueError(f"not cells in crop {src_sums[index]}, but crop diff is -ve {crop_diff[index]}")
+        with np.errstate(divide="ignore", invalid="ignore"):
+            per_cell_factor = transfer_amount / (src_sums / data_sizes)
+        for increasing, src_lcc, dst_lcc in ((True, PASTURE_CODE, CROP_CODE), (False, CROP_CODE, PASTURE_CODE)):
+            selected = np.flatnonzero((balance & (crop_increasing == increasing))[columns])
+            if selected.size == 0:
+                continue
+            src_raster = land_cover.layer(src_lcc)
+            dst_raster = land_cover.layer(dst_lcc)
+            transferred = (src_raster[:, selected] > 0) * per_cell_factor[columns[selected]]
+            src_raster[:, selected] -= transferred
+            dst_raster[:, selected] += transferred
+        crop_diff, pasture_diff = (
+            np.where(balance, crop_diff + transfer_amount * np.sign(pasture_diff), crop_diff),
+            np.where(balance, pasture_diff + transfer_amount * np.sign(crop_diff), pasture_diff),
+        )
+
+    # We first do all the removals and then the additions, as in remove_land_cover
+    pnv_data = None # lazy PNV load as it's expensive
+    for diffs, lcc_code in ((crop_diff, CROP_CODE), (pasture_diff, PASTURE_CODE)):
+        removing = diffs < 0
+        if not removing.any():
+            continue
+        if pnv_data is None:
+            pnv_data = read(pnv)
+        agri_raster = land_cover.layer(lcc_code)
+        coverage = segment_sums(agri_raster, bounds) / data_sizes
+        removing &= coverage != 0
+        selected = np.flatnonzero(removing[columns])
+        if selected.size == 0:
+            continue
+        with np.errstate(divide="ignore", invalid="ignore"):
+            fraction = np.abs(diffs) / coverage
+        per_cell_fraction = np.where(fraction > 1.0, 1.0, fraction).astype(fraction.dtype)
+
+        agri_data = agri_raster[:, selected]
+        removal_mask = agri_data > 0
+        removed_grid = agri_data * (removal_mask * per_cell_fraction[columns[selected]])
+        agri_raster[:, selected] -= removed_grid
+        pnv_index = land_cover.class_index(pnv_data[:, selected])
+        pnv_match = removal_mask & (pnv_index >= 0)
+        rows, cols = np.nonzero(pnv_match)
+        land_cover.data[pnv_index[pnv_match], rows, selected[cols]] += removed_grid[pnv_match]
+
+    # Then the additions, as in process_tile and add_land_cover
+    crop_adding = crop_diff > 0
+    pasture_adding = pasture_diff > 0
+    adding = crop_adding | pasture_adding
+    if not adding.any():
+        return land_cover.as_map()
+
+    excluded_codes = [CROP_CODE, PASTURE_CODE] + PRESERVE_CODES
+    eligible_mask = ~(land_cover.data[land_cover.indices(excluded_codes)] != 0).any(axis=0)
+    eligible_count = np.add.reduceat(eligible_mask.sum(axis=0), starts)
+    eligible_fraction = eligible_count / sizes
+
+    crop_addition = np.where(crop_adding, crop_diff, 0)
+    pasture_addition = np.where(pasture_adding, pasture_diff, 0)
+    total_desired_change = crop_addition + pasture_addition
+    scale = adding & (total_desired_change > eligible_fraction)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        crop_addition, pasture_addition = (
+            np.where(scale, (x / total_desired_change) * eligible_fraction, x).astype(np.float64)
+            for x in (crop_addition, pasture_addition)
+        )
+
+    adding &= eligible_count != 0
+    total_addition = np.zeros(len(tiles))
+    for additions, lcc_adding, lcc_code in (
+        (crop_addition, crop_adding & adding, CROP_CODE),
+        (pasture_addition, pasture_adding & adding, PASTURE_CODE),
+    ):
+        assert ((additions >= 0) & (additions <= 1))[lcc_adding].all()
+        selected = np.flatnonzero(lcc_adding[columns])
+        if selected.size == 0:
+            continue
+        with np.errstate(divide="ignore", invalid="ignore"):
+            per_cell_addition = np.minimum(additions / eligible_fraction, 1.0)
+        total_addition[lcc_adding] += per_cell_addition[lcc_adding]
+        agri_raster = land_cover.layer(lcc_code)
+        agri_selected = agri_raster[:, selected]
+        eligible_selected = eligible_mask[:, selected]
+        agri_selected[eligible_selected] += np.broadcast_to(
+            per_cell_addition[columns[selected]],
+            agri_selected.shape,
+        )[eligible_selected]
+        agri_raster[:, selected] = agri_selected
+
+    selected = np.flatnonzero(adding[columns])
+    eligible_selected = eligible_mask[:, selected]
+    total_selected = np.broadcast_to(total_addition[columns[selected]], eligible_selected.shape)
+    others = np.ix_(land_cover.indices(excluded_codes, invert=True), np.arange(height), selected)
+    other_data = land_cover.data[others]
+    np.subtract(other_data, total_selected, out=other_data, where=eligible_selected & (other_data > 0))
+    np.maximum(other_data, 0.0, out=other_data, where=eligible_selected)
+    land_cover.data[others] = other_data
+
+    return land_cover.as_map()
+
+def strips_of(tiles: list[TileInfo]) -> list[list[TileInfo]]:
+    """Split tiles, in row order, into runs of up to STRIP_TILES adjacent tiles along a row."""
+    strips: list[list[TileInfo]] = []
+    for tile in tiles:
+        if strips:
+            last = strips[-1][-1]
+            if (len(strips[-1]) < STRIP_TILES) and (last.y_position == tile.y_position) and \
+                    (last.x_position + last.width == tile.x_position):
+                strips[-1].append(tile)
+                continue
+        strips.append([tile])
+    return strips
 
 def process_tile_concurrently(
     current_lvl1_path: Path,
     pnv_path: Path,
+    tiles: np.ndarray,
     input_queue: Queue,
     result_queues: dict[int,Queue],
+    slots: TileSlots,
+    strips: bool,
 ) -> None:
     current_maps = {
         int(filename.stem.split('_')[1]): yg.read_raster(filename) for filename in current_lvl1_path.glob("lcc_*.tif")
@@ -245,22 +576,59 @@ def process_tile_concurrently(
     with yg.read_raster(pnv_path) as pnv:
         pnv.set_window_for_intersection(reference_layer.area)
         while True:
-            tile : TileInfo | None = input_queue.get()
-            if tile is None:
+            batch : tuple[int,int] | None = input_queue.get()
+            if batch is None:
                 break
-            res = process_tile(current_maps, pnv, tile)
-            for lcc, data in res.items():
-                result_queues[lcc].put((tile, data.tobytes()))
+            batch_tiles = [tile_at(tiles, index) for index in range(*batch)]
+            if strips:
+                for strip in strips_of(batch_tiles):
+                    # The assemblers see the strip as one big tile
+                    strip_tile = strip[0]._replace(width=strip[-1].x_position + strip[-1].width - strip[0].x_position)
+                    res = process_strip(current_maps, pnv, strip)
+                    send_result(strip_tile, res, result_queues, slots)
+                continue
+            for tile in batch_tiles:
+                # If the tile doesn't change then the assemblers copy it straight from the current maps
+                unchanged, read_data = tile_unchanged(current_maps, tile)
+                if unchanged:
+                    send_result(tile, None, result_queues, slots)
+                    continue
+                send_result(tile, process_tile(current_maps, pnv, tile, read_data), result_queues, slots)
     for queue in result_queues.values():
         queue.put(None)
 
+def send_result(
+    tile: TileInfo,
+    res: dict[int,np.ndarray] | None,
+    result_queues: dict[int,Queue],
+    slots: TileSlots,
+) -> None:
+    """Pass the result for a tile to the assemblers through a shared memory slot, or if there is no
+    result, tell them to copy the tile from the current maps."""
+    if res is None:
+        for queue in result_queues.values():
+            queue.put((tile, None))
+        return
+    slot = slots.acquire()
+    for lcc, data in res.items():
+        slots.view(slot, lcc, tile)[:] = data
+    for lcc in res:
+        result_queues[lcc].put((tile, slot))
+
+def tile_steps(size: int, count: int) -> np.ndarray:
+    """The pixel offsets at which each of count tiles across size pixels start, plus the end."""
+    scale = size / count
+    return np.append(np.rint(np.arange(count) * scale).astype(np.int64), size)
+
 def build_tile_list(
     current_lvl1_path: Path,
     crop_adjustment_path: Path,
     pasture_adjustment_path: Path,
-) -> list[TileInfo]:
-    tiles = []
-
+) -> tuple[np.ndarray,np.ndarray]:
+    """Build the tables of tiles, as structured arrays in row order, split into those with
+    agricultural targets, which need processing, and those without, which are passed through
+    unchanged. Runs of pass through tiles along a row are merged into a single tile, so they can
+    be copied in one go."""
     with yg.read_raster(next(current_lvl1_path.glob("*.tif"))) as example:
         current_dimensions = example.window.xsize, example.window.ysize
     with (
@@ -268,35 +636,44 @@ def build_tile_list(
         yg.read_raster(pasture_adjustment_path) as pasture,
     ):
         assert crop.window == pasture.window
-        argi_dimensions = crop.window.xsize, crop.window.ysize
-
-        x_scale = current_dimensions[0] / argi_dimensions[0]
-        y_scale = current_dimensions[1] / argi_dimensions[1]
-
-        x_steps = [round(i * x_scale) for i in range(argi_dimensions[0])]
-        x_steps.append(current_dimensions[0])
-        y_steps = [round(i * y_scale) for i in range(argi_dimensions[1])]
-        y_steps.append(current_dimensions[1])
-
-        for y in range(crop.window.ysize):
-            crop_row = crop.read_array(0, y, crop.window.xsize, 1)
-            pasture_row = pasture.read_array(0, y, pasture.window.xsize, 1)
-            for x in range(crop.window.xsize):
-                tiles.append(TileInfo(
-                    x_steps[x],
-                    y_steps[y],
-                    (x_steps[x+1] - x_steps[x]),
-                    (y_steps[y+1] - y_steps[y]),
-                    crop_row[0][x],
-                    pasture_row[0][x],
-                ))
-    return tiles
+        argi_width, argi_height = crop.window.xsize, crop.window.ysize
+        crop_data = crop.read_array(0, 0, argi_width, argi_height)
+        pasture_data = pasture.read_array(0, 0, argi_width, argi_height)
+
+    x_steps = tile_steps(current_dimensions[0], argi_width)
+    y_steps = tile_steps(current_dimensions[1], argi_height)
+    passthrough_mask = np.isnan(crop_data) & np.isnan(pasture_data)
+    dtype = tile_dtype(crop_data.dtype, pasture_data.dtype)
+
+    rows, columns = np.nonzero(~passthrough_mask)
+    tiles = np.empty(len(rows), dtype=dtype)
+    tiles["x_position"] = x_steps[columns]
+    tiles["y_position"] = y_steps[rows]
+    tiles["width"] = x_steps[columns + 1] - x_steps[columns]
+    tiles["height"] = y_steps[rows + 1] - y_steps[rows]
+    tiles["crop_target"] = crop_data[rows, columns]
+    tiles["pasture_target"] = pasture_data[rows, columns]
+
+    # Runs start where the padded mask goes from False to True, and end where it goes back
+    edges = np.diff(np.pad(passthrough_mask, ((0, 0), (1, 1))).astype(np.int8), axis=1)
+    run_rows, run_starts = np.nonzero(edges == 1)
+    _, run_ends = np.nonzero(edges == -1)
+    passthrough = np.empty(len(run_rows), dtype=dtype)
+    passthrough["x_position"] = x_steps[run_starts]
+    passthrough["y_position"] = y_steps[run_rows]
+    passthrough["width"] = x_steps[run_ends] - x_steps[run_starts]
+    passthrough["height"] = y_steps[run_rows + 1] - y_steps[run_rows]
+    passthrough["crop_target"] = np.nan
+    passthrough["pasture_target"] = np.nan
+
+    return tiles, passthrough
 
 def assemble_map(
     lcc: int,
     current_lvl1_path: Path,
     output_path: Path,
     result_queue: Queue,
+    slots: TileSlots,
     sentinal_count: int,
 ) -> None:
     os.makedirs(output_path, exist_ok=True)
@@ -306,49 +683,70 @@ def assemble_map(
             filename=output_path / f"lcc_{lcc}.tif",
             threads=16,
         )
-        dtype = current_map.read_array(0, 0, 1, 1).dtype
-    band = new_map._dataset.GetRasterBand(1) # pylint: disable=W0212
-
-    count = 0
-    while True:
-        result : tuple[TileInfo,bytearray] | None = result_queue.get()
-        if result is None:
-            sentinal_count -= 1
-            if sentinal_count == 0:
-                break
-            continue
+        band = new_map._dataset.GetRasterBand(1) # pylint: disable=W0212
 
-        count += 1
-        tile, rawdata = result
-        n = np.frombuffer(rawdata, dtype=dtype)
-        data = np.reshape(n, (tile.height, tile.width))
-        band.WriteArray(data, tile.x_position, tile.y_position)
-        if count % 1000 == 0:
-            print(f"{lcc}: assembled {count} tiles")
+        count = 0
+        while True:
+            result : tuple[TileInfo,int | None] | None = result_queue.get()
+            if result is None:
+                sentinal_count -= 1
+                if sentinal_count == 0:
+                    break
+                continue
+
+            count += 1
+            tile, slot = result
+            if slot is None:
+                # Tiles that don't change are copied directly from the current map
+                data = current_map.read_array(tile.x_position, tile.y_position, tile.width, tile.height)
+                band.WriteArray(data, tile.x_position, tile.y_position)
+            else:
+                band.WriteArray(slots.view(slot, lcc, tile), tile.x_position, tile.y_position)
+                slots.release(slot)
+            if count % 1000 == 0:
+                print(f"{lcc}: assembled {count} tiles")
 
 def pipeline_source(
-    current_lvl1_path: Path,
-    crop_adjustment_path: Path,
-    pasture_adjustment_path: Path,
+    tiles: np.ndarray,
+    passthrough: np.ndarray,
     source_queue: Queue,
+    result_queues: dict[int,Queue],
     sentinal_count: int,
 ) -> None:
-    tiles = build_tile_list(
-        current_lvl1_path,
-        crop_adjustment_path,
-        pasture_adjustment_path,
-    )
-    print(f"There are {len(tiles)} tiles")
-    for tile in tiles:
-        source_queue.put(tile)
+    """Hand out the tiles to process to the workers as ranges of the tile table, and send the pass
+    through tiles straight to the assemblers. Both tables are in row order, and are kept in step so
+    that neither the workers nor the assemblers are left waiting on the other."""
+    print(f"There are {len(tiles)} tiles to process and {len(passthrough)} runs of tiles to copy")
+    sent = 0
+    for start in range(0, len(tiles), TILES_PER_BATCH):
+        end = min(start + TILES_PER_BATCH, len(tiles))
+        row_end = np.searchsorted(passthrough["y_position"], tiles["y_position"][end - 1], side="right")
+        for index in range(sent, row_end):
+            tile = tile_at(passthrough, index)
+            for queue in result_queues.values():
+                queue.put((tile, None))
+        sent = max(sent, row_end)
+        source_queue.put((start, end))
+    for index in range(sent, len(passthrough)):
+        tile = tile_at(passthrough, index)
+        for queue in result_queues.values():
+            queue.put((tile, None))
     for _ in range(sentinal_count):
         source_queue.put(None)
-
+    for queue in result_queues.values():
+        queue.put(None)
 
 def get_lcc_list(current_lvl1_path: Path) -> list[int]:
     rasters = current_lvl1_path.glob("*.tif")
     return [int(x.stem.split('_')[1]) for x in rasters]
 
+def get_lcc_dtypes(current_lvl1_path: Path, lcc_list: list[int]) -> dict[int,np.dtype]:
+    res = {}
+    for lcc in lcc_list:
+        with yg.read_raster(current_lvl1_path / f"lcc_{lcc}.tif") as current_map:
+            res[lcc] = current_map.read_array(0, 0, 1, 1).dtype
+    return res
+
 def make_food_current_map(
     current_lvl1_path: Path,
     pnv_path: Path,
@@ -357,6 +755,7 @@ def make_food_current_map(
     output_path: Path,
     processes_count: int,
     sentinel_path: Path | None,
+    strips: bool = False,
 ) -> None:
     # We'll use a lot of processes which will talk back to the main process, so
     # we need to adjust the ulimit, which is quite low by default
@@ -366,6 +765,48 @@ def make_food_current_map(
     os.makedirs(output_path.parent, exist_ok=True)
 
     lcc_list = get_lcc_list(current_lvl1_path)
+    # The tile tables are built before the other processes start, so they all share them
+    tiles, passthrough = build_tile_list(
+        current_lvl1_path,
+        crop_adjustment_path,
+        pasture_adjustment_path,
+    )
+    # In strip mode each slot holds a whole strip
+    slots = TileSlots(
+        get_lcc_dtypes(current_lvl1_path, lcc_list),
+        int(tiles["width"].max(initial=1)) * (STRIP_TILES if strips else 1),
+        int(tiles["height"].max(initial=1)),
+        processes_count * SLOTS_PER_WORKER,
+    )
+    try:
+        run_pipeline(
+            current_lvl1_path,
+            pnv_path,
+            tiles,
+            passthrough,
+            output_path,
+            processes_count,
+            lcc_list,
+            slots,
+            strips,
+        )
+    finally:
+        slots.close()
+
+    if sentinel_path:
+        sentinel_path.touch()
+
+def run_pipeline(
+    current_lvl1_path: Path,
+    pnv_path: Path,
+    tiles: np.ndarray,
+    passthrough: np.ndarray,
+    output_path: Path,
+    processes_count: int,
+    lcc_list: list[int],
+    slots: TileSlots,
+    strips: bool,
+) -> None:
     result_queues: dict[int,multiprocessing.queues.Queue] = {
         lcc: multiprocessing.Queue(maxsize=10) for lcc in lcc_list
     }
@@ -376,7 +817,9 @@ def make_food_current_map(
             current_lvl1_path,
             output_path,
             queue,
-            processes_count,
+            slots,
+            # Each worker and the source send an end marker once they are done
+            processes_count + 1,
         )) for lcc, queue in result_queues.items()
     ]
     for assembly_worker in assembly_processes:
@@ -387,17 +830,20 @@ def make_food_current_map(
     workers = [Process(target=process_tile_concurrently, args=(
         current_lvl1_path,
         pnv_path,
+        tiles,
         source_queue,
         result_queues,
+        slots,
+        strips,
     )) for _ in range(processes_count)]
     for worker_process in workers:
         worker_process.start()
 
     source_worker = Process(target=pipeline_source, args=(
-        current_lvl1_path,
-        crop_adjustment_path,
-        pasture_adjustment_path,
+        tiles,
+        passthrough,
         source_queue,
+        result_queues,
         processes_count,
     ))
     source_worker.start()
@@ -415,9 +861,6 @@ def make_food_current_map(
             processes.remove(candidate)
         time.sleep(0.1)
 
-    if sentinel_path:
-        sentinel_path.touch()
-
 @snakemake_compatible(mapping={
     "current_lvl1_path": "params.jung_dir",
     "pnv_path": "input.pnv",
@@ -427,6 +870,7 @@ def make_food_current_map(
     "output_path": "params.output_dir",
     "sentinel_path": "output.sentinel",
     "parallelism": "threads",
+    "strips": "params.strips",
 })
 def main() -> None:
     parser = argparse.ArgumentParser(description="Build the food current map")
@@ -479,6 +923,15 @@ def main() -> None:
         dest="parallelism",
         help="Number of concurrent threads to use."
     )
+    parser.add_argument(
+        "--strips",
+        action="store_true",
+        required=False,
+        default=False,
+        dest="strips",
+        help="Process runs of adjacent tiles along each row together, which gives the same results "
+            "with much less overhead per tile."
+    )
     args = parser.parse_args()
 
     make_food_current_map(
@@ -489,6 +942,7 @@ def main() -> None:
         args.output_path,
         args.parallelism,
         args.sentinel_path,
+        args.strips,
     )
 
 if __name__ == "__main__":
@@ -0,0 +1,65 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+import yirgacheffe as yg
+
+from deltap.change_mask import ChangeMask, TILE_SIZE, make_change_mask
+
+PROJECTION = yg.MapProjection("epsg:4326", 1.0, -1.0)
+
+@pytest.fixture(name="change_mask")
+def fixture_change_mask(tmp_path: Path) -> ChangeMask:
+    # A map of two rows of three tiles, with a change in the last tile of the bottom row,
+    # and a NaN in the first tile of the top row
+    diff = np.zeros((TILE_SIZE * 2, TILE_SIZE * 3))
+    diff[TILE_SIZE + 44, (TILE_SIZE * 2) + 8] = 0.5
+    diff[10, 10] = np.nan
+    diff_path = tmp_path / "diff.tif"
+    with yg.from_array(diff, (0, 0), PROJECTION) as layer:
+        layer.to_geotiff(diff_path)
+    mask_path = tmp_path / "mask.tif"
+    make_change_mask(diff_path, mask_path)
+    return ChangeMask(mask_path)
+
+def area(left: int, top: int, right: int, bottom: int) -> yg.Area:
+    # Areas are given in pixels, with y increasing downwards
+    return yg.Area(left=left, top=-top, right=right, bottom=-bottom, projection=PROJECTION)
+
+def test_change_mask_tiles(change_mask: ChangeMask) -> None:
+    assert (change_mask.mask == np.array([[True, False, False], [False, False, True]])).all()
+
+@pytest.mark.parametrize(
+    "left,top,right,bottom,expected",
+    [
+        # The changed tile exactly
+        (512, 256, 768, 512, True),
+        # Ending at the left edge of the changed tile
+        (256, 256, 512, 512, False),
+        # One pixel over the left edge of the changed tile
+        (256, 256, 513, 512, True),
+        # Ending at the top edge of the changed tile
+        (512, 0, 768, 256, False),
+        # One pixel over the top edge of the changed tile
+        (512, 0, 768, 257, True),
+        # Within the tile with a NaN
+        (100, 100, 200, 200, True),
+        # Entirely outside the map
+        (768, 0, 1000, 512, False),
+        # Partly outside the map, overlapping the changed tile
+        (700, 400, 1000, 1000, True),
+    ]
+)
+def test_changed(change_mask: ChangeMask, left: int, top: int, right: int, bottom: int, expected: bool) -> None:
+    assert change_mask.changed(area(left, top, right, bottom)) == expected
+
+def test_changed_pixels(change_mask: ChangeMask) -> None:
+    changed = change_mask.changed_pixels(area(256, 256, 768, 512), 0, 0, 512, 256)
+    assert not changed[:, :256].any()
+    assert changed[:, 256:].all()
+
+def test_changed_pixels_outside_mask(change_mask: ChangeMask) -> None:
+    # Beyond the edge of the mask we can't say there is no change
+    changed = change_mask.changed_pixels(area(256, 0, 868, 100), 0, 0, 612, 100)
+    assert not changed[:, :512].any()
+    assert changed[:, 512:].all()
@@ -0,0 +1,70 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+# The delta P scripts import each other by module name, as that's how they are run
+sys.path.append(str(Path(__file__).parent.parent / "deltap"))
+from global_code_residents_pixel import process_delta_p, GOMPERTZ_A, GOMPERTZ_B, GOMPERTZ_ALPHA # pylint: disable=C0413
+
+def baseline_delta_p(
+    current: np.ndarray,
+    scenario: np.ndarray | float,
+    current_aoh: float,
+    historic_aoh: float,
+    exponent: str | float,
+) -> np.ndarray:
+    # The per curve calculation from before process_delta_p did all curves at once
+    scaled_aoh = ((current_aoh - current.astype(np.float64)) + scenario) / historic_aoh
+    if isinstance(exponent, float):
+        calc_2 = scaled_aoh ** exponent
+    else:
+        calc_2 = np.exp(-np.exp(GOMPERTZ_A + (GOMPERTZ_B * (scaled_aoh ** GOMPERTZ_ALPHA))))
+    return np.where(calc_2 > 1, 1, calc_2)
+
+@pytest.mark.parametrize(
+    "exponents",
+    [
+        [1.0],
+        [0.5],
+        [0.25],
+        [0.1],
+        ["gompertz"],
+        [0.1, 0.25, 0.5, 1.0, "gompertz"],
+        # The scaled AOH is kept in the last band, which is where a curve of 1.0 is left as is
+        ["gompertz", 0.5, 1.0],
+    ]
+)
+@pytest.mark.parametrize("scenario_kind", ["array", "constant", "zero"])
+def test_process_delta_p_matches_baseline(exponents: list[str | float], scenario_kind: str) -> None:
+    rng = np.random.default_rng(42)
+    current = rng.uniform(0.0, 10.0, (16, 20)).astype(np.float32)
+    scenario: np.ndarray | float = {
+        # Large enough that some pixels take the AOH beyond its historic value, which caps at 1
+        "array": rng.uniform(0.0, 30.0, (16, 20)).astype(np.float32),
+        "constant": 5.0,
+        "zero": 0.0,
+    }[scenario_kind]
+    current_aoh, historic_aoh = 100.0, 80.0
+
+    result = process_delta_p(current, scenario, current_aoh, historic_aoh, exponents)
+
+    assert result.shape == (len(exponents), 16, 20)
+    assert result.dtype == np.float64
+    for band, exponent in enumerate(exponents):
+        expected = baseline_delta_p(current, scenario, current_aoh, historic_aoh, exponent)
+        assert np.allclose(result[band], expected, rtol=1e-12, atol=0.0)
+
+def test_process_delta_p_caps_at_one() -> None:
+    current = np.zeros((2, 2))
+    result = process_delta_p(current, 50.0, 100.0, 80.0, [0.25, 1.0])
+    assert (result == 1.0).all()
+
+def test_process_delta_p_into_out() -> None:
+    current = np.full((4, 4), 2.0)
+    out = np.empty((2, 4, 4))
+    result = process_delta_p(current, 1.0, 10.0, 16.0, [0.5, 1.0], out)
+    assert result is out
+    assert np.allclose(out[0], 0.75)
+    assert np.allclose(out[1], 0.5625)
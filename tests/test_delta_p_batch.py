@@ -0,0 +1,106 @@
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import yirgacheffe as yg
+
+# The delta P scripts import each other by module name, as that's how they are run
+sys.path.append(str(Path(__file__).parent.parent / "deltap"))
+import global_code_residents_pixel_batch # pylint: disable=C0413
+from global_code_residents_pixel_batch import DeltaPAccumulator, clear_stale_chunks, combine_partials # pylint: disable=C0413
+from global_code_residents_pixel import DeltaPChunk # pylint: disable=C0413
+
+PROJECTION = yg.MapProjection("epsg:4326", 1.0, -1.0)
+
+def species_area(left: int, top: int, width: int, height: int) -> yg.Area:
+    # Areas are given in pixels, with y increasing downwards
+    return yg.Area(left=left, top=-top, right=left + width, bottom=-(top + height), projection=PROJECTION)
+
+def test_main_from_snakemake(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    calls = []
+    monkeypatch.setattr(
+        global_code_residents_pixel_batch,
+        "global_code_residents_pixel_batch",
+        lambda *args: calls.append(args),
+    )
+    # The bridge looks for the object Snakemake injects into scripts on the main module
+    snakemake = SimpleNamespace(
+        input=SimpleNamespace(manifest=str(tmp_path / "manifest.csv"), totals=str(tmp_path / "totals.parquet")),
+        params=SimpleNamespace(
+            chunk=2,
+            chunks=4,
+            change_masks_dir=str(tmp_path / "habitat"),
+            changed_tiles_only=True,
+            precision="float32",
+            sparse=False,
+            reference=None,
+            accumulate=False,
+            write_rasters=True,
+        ),
+        # Snakemake gives a list of files for a named output
+        output=SimpleNamespace(sentinels=[str(tmp_path / x / ".chunk_2.done") for x in ("a", "b")]),
+        threads=3,
+    )
+    monkeypatch.setattr(sys.modules["__main__"], "snakemake", snakemake, raising=False)
+
+    global_code_residents_pixel_batch.main()
+
+    assert len(calls) == 1
+    manifest_path, chunk, chunks, processes_count, totals_path, change_masks_path, reference_path, accumulate, \
+        options, sentinel_paths = calls[0]
+    assert manifest_path == tmp_path / "manifest.csv"
+    assert (chunk, chunks, processes_count) == (2, 4, 3)
+    assert totals_path == tmp_path / "totals.parquet"
+    assert change_masks_path == tmp_path / "habitat"
+    assert reference_path is None
+    assert not accumulate
+    assert options.changed_tiles_only
+    assert sentinel_paths == [tmp_path / "a" / ".chunk_2.done", tmp_path / "b" / ".chunk_2.done"]
+
+def test_combine_partials(tmp_path: Path) -> None:
+    reference_path = tmp_path / "reference.tif"
+    with yg.from_array(np.zeros((16, 20)), (0, 0), PROJECTION) as layer:
+        layer.to_geotiff(reference_path)
+
+    # Each worker has its own accumulator, and one never gets any species
+    rng = np.random.default_rng(5)
+    additions = [
+        [
+            (species_area(2, 3, 4, 5), rng.uniform(size=(2, 5, 4))),
+            (species_area(5, 1, 3, 2), rng.uniform(size=(2, 2, 3))),
+        ],
+        [(species_area(9, 6, 6, 4), rng.uniform(size=(2, 4, 6)))],
+        [],
+    ]
+    expected = np.zeros((2, 16, 20))
+    partial_paths = []
+    for worker, species in enumerate(additions):
+        accumulator = DeltaPAccumulator(reference_path, tmp_path / f"chunk_0_{worker}.dat", 2)
+        for area, data in species:
+            # Species arrive in blocks of rows
+            accumulator.add(DeltaPChunk(0, area, 0, data[:, :2]))
+            accumulator.add(DeltaPChunk(0, area, 2, data[:, 2:]))
+            expected[:, -int(area.top):-int(area.top) + data.shape[1], int(area.left):int(area.right)] += data
+        accumulator.data.flush()
+        partial_paths.append(accumulator.data.filename)
+
+    output_path = tmp_path / "chunk_0.tif"
+    combine_partials(reference_path, [Path(x) for x in partial_paths], output_path, ["0.25", "gompertz"])
+
+    # The result only covers the pixels the species did
+    with yg.read_raster(output_path) as layer:
+        assert layer.area == species_area(2, 1, 13, 9)
+    for band in range(2):
+        with yg.read_raster(output_path, band=band + 1) as layer:
+            assert np.allclose(layer.read_array(0, 0, 13, 9), expected[band, 1:10, 2:15], rtol=1e-12, atol=0.0)
+
+def test_clear_stale_chunks(tmp_path: Path) -> None:
+    for name in ["chunk_0.tif", "chunk_0.csv", "chunk_1.tif", "chunk_1.csv", "chunk_2.tif", "chunk_2.csv",
+            "chunk_12.tif", "chunk_12.csv", "chunk_1_123.dat"]:
+        (tmp_path / name).touch()
+    clear_stale_chunks(tmp_path, 2)
+    assert sorted(x.name for x in tmp_path.iterdir()) == [
+        "chunk_0.csv", "chunk_0.tif", "chunk_1.csv", "chunk_1.tif", "chunk_1_123.dat",
+    ]
@@ -0,0 +1,80 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import yirgacheffe as yg
+
+# The delta P scripts import each other by module name, as that's how they are run
+sys.path.append(str(Path(__file__).parent.parent / "deltap"))
+from delta_p_groups import delta_p_groups # pylint: disable=C0413
+from delta_p_store import save_delta_p_store # pylint: disable=C0413
+from global_code_residents_pixel import DeltaPChunk # pylint: disable=C0413
+
+PROJECTION = yg.MapProjection("epsg:4326", 1.0, -1.0)
+WIDTH, HEIGHT = 8, 6
+
+def species_area(left: int, top: int, width: int, height: int) -> yg.Area:
+    # Areas are given in pixels, with y increasing downwards
+    return yg.Area(left=left, top=-top, right=left + width, bottom=-(top + height), projection=PROJECTION)
+
+def place(left: int, top: int, data: np.ndarray) -> np.ndarray:
+    result = np.zeros((HEIGHT, WIDTH))
+    height, width = data.shape
+    result[top:top + height, left:left + width] = data
+    return result
+
+def test_delta_p_groups(tmp_path: Path) -> None:
+    rng = np.random.default_rng(3)
+    deltap_path = tmp_path / "deltap"
+
+    # Some species as rasters, as the per species delta P jobs write them
+    rasters = {
+        "deltap_1_RESIDENT": (0, 0, rng.uniform(-1e-4, 1e-4, (3, 4))),
+        "deltap_2_BREEDING": (2, 1, rng.uniform(-1e-4, 1e-4, (4, 4))),
+        "deltap_2_NONBREEDING": (5, 3, rng.uniform(-1e-4, 1e-4, (3, 3))),
+    }
+    aves_path = deltap_path / "AVES"
+    aves_path.mkdir(parents=True)
+    for name, (left, top, data) in rasters.items():
+        with yg.from_array(data, (left, -top), PROJECTION) as layer:
+            layer.to_geotiff(aves_path / f"{name}.tif")
+    # A species the scenario leaves unchanged, which counts towards its groups but adds nothing
+    (aves_path / "unchanged").mkdir()
+    (aves_path / "unchanged" / "deltap_5_RESIDENT").touch()
+
+    # And some in a sparse store, with a band per curve of which only the first is summed
+    stored = {
+        "deltap_3_RESIDENT": (1, 2, rng.uniform(-1e-4, 1e-4, (2, 3, 5))),
+        "deltap_4_RESIDENT": (0, 0, rng.uniform(-1e-4, 1e-4, (2, 6, 8))),
+    }
+    for name, (left, top, data) in stored.items():
+        _, height, width = data.shape
+        save_delta_p_store(
+            iter([DeltaPChunk(0, species_area(left, top, width, height), 0, data)]),
+            [deltap_path / "MAMMALIA" / f"{name}.tif"],
+            ["0.25", "gompertz"],
+        )
+
+    # Species 4 is in no group, and there is no delta P for species 9
+    groups_path = tmp_path / "groups.csv"
+    pd.DataFrame(
+        [["1", "a"], ["2", "a"], ["5", "a"], ["2", "b"], ["3", "b"], ["9", "c"]],
+        columns=["taxid", "group"],
+    ).to_csv(groups_path, index=False)
+
+    output_path = tmp_path / "groups" / "groups.tif"
+    delta_p_groups(deltap_path, groups_path, None, 1, output_path)
+
+    species_1 = place(*rasters["deltap_1_RESIDENT"])
+    species_2 = place(*rasters["deltap_2_BREEDING"]) + place(*rasters["deltap_2_NONBREEDING"])
+    left, top, data = stored["deltap_3_RESIDENT"]
+    species_3 = place(left, top, data[0])
+    expected = {"a": species_1 + species_2, "b": species_2 + species_3, "c": np.zeros((HEIGHT, WIDTH))}
+    for band, group in enumerate(["a", "b", "c"], start=1):
+        with yg.read_raster(output_path, band=band) as layer:
+            assert layer.window.xsize == WIDTH and layer.window.ysize == HEIGHT
+            assert np.allclose(layer.read_array(0, 0, WIDTH, HEIGHT), expected[group], rtol=1e-12, atol=0.0)
+
+    counts = pd.read_csv(output_path.with_suffix(".csv"), dtype={"group": str})
+    assert dict(zip(counts.group, counts["count"])) == {"a": 4, "b": 3, "c": 0}
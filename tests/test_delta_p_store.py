@@ -0,0 +1,77 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+import yirgacheffe as yg
+
+# The delta P scripts import each other by module name, as that's how they are run
+sys.path.append(str(Path(__file__).parent.parent / "deltap"))
+from delta_p_store import DeltaPStore, DeltaPStoreWriter, save_delta_p_store, store_path_for # pylint: disable=C0413
+from global_code_residents_pixel import DeltaPChunk # pylint: disable=C0413
+
+PROJECTION = yg.MapProjection("epsg:4326", 1.0, -1.0)
+LABELS = ["0.25", "gompertz"]
+
+def species_area(left: int, top: int, width: int, height: int) -> yg.Area:
+    # Areas are given in pixels, with y increasing downwards
+    return yg.Area(left=left, top=-top, right=left + width, bottom=-(top + height), projection=PROJECTION)
+
+def sparse_delta_p(rng: np.random.Generator, height: int, width: int) -> np.ndarray:
+    data = rng.uniform(-1e-4, 1e-4, (len(LABELS), height, width))
+    # Most pixels have no delta P, and some are only non zero in one band
+    data[:, rng.uniform(size=(height, width)) < 0.6] = 0.0
+    data[0, 0, :] = 0.0
+    return data
+
+def save(output_path: Path, area: yg.Area, data: np.ndarray) -> None:
+    # Save the delta P as the delta P calculation would, in blocks of rows
+    chunks = (DeltaPChunk(0, area, yoffset, data[:, yoffset:yoffset + 2]) for yoffset in range(0, data.shape[1], 2))
+    save_delta_p_store(chunks, [output_path], LABELS)
+
+def read_bands(path: Path, width: int, height: int) -> np.ndarray:
+    bands = []
+    for band in range(1, len(LABELS) + 1):
+        with yg.read_raster(path, band=band) as layer:
+            bands.append(layer.read_array(0, 0, width, height))
+    return np.array(bands)
+
+def test_store_round_trip(tmp_path: Path) -> None:
+    rng = np.random.default_rng(17)
+    taxa_path = tmp_path / "deltap" / "AVES"
+    species = {
+        "deltap_1_RESIDENT": (species_area(0, 0, 6, 5), sparse_delta_p(rng, 5, 6)),
+        "deltap_2_BREEDING": (species_area(3, 2, 7, 4), sparse_delta_p(rng, 4, 7)),
+    }
+    save(taxa_path / "deltap_1_RESIDENT.tif", *species["deltap_1_RESIDENT"])
+    save(taxa_path / "deltap_2_BREEDING.tif", *species["deltap_2_BREEDING"])
+    # Rewriting a species replaces what was stored for it before
+    species["deltap_1_RESIDENT"] = (species_area(0, 0, 6, 5), sparse_delta_p(rng, 5, 6))
+    save(taxa_path / "deltap_1_RESIDENT.tif", *species["deltap_1_RESIDENT"])
+
+    store = DeltaPStore(store_path_for(taxa_path / "deltap_1_RESIDENT.tif"))
+    assert store.species() == sorted(species)
+
+    for name, (area, data) in species.items():
+        output_path = tmp_path / f"{name}.tif"
+        store.materialise(name, output_path)
+        _, height, width = data.shape
+        with yg.read_raster(output_path) as layer:
+            assert layer.area == area
+        assert np.array_equal(read_bands(output_path, width, height), data)
+
+    expected = np.zeros((len(LABELS), 6, 10))
+    for area, data in species.values():
+        _, height, width = data.shape
+        expected[:, -int(area.top):-int(area.top) + height, int(area.left):int(area.left) + width] += data
+    store.sum(tmp_path / "sum.tif")
+    assert np.allclose(read_bands(tmp_path / "sum.tif", 10, 6), expected, rtol=1e-12, atol=0.0)
+
+def test_store_metadata(tmp_path: Path) -> None:
+    store_path = tmp_path / "store"
+    DeltaPStoreWriter(store_path, PROJECTION, LABELS, np.float64)
+    # Opening the store again with the same metadata is fine, and leaves no temporary files behind
+    DeltaPStoreWriter(store_path, PROJECTION, LABELS, np.float64)
+    assert [x.name for x in store_path.iterdir()] == ["store.json"]
+    with pytest.raises(ValueError):
+        DeltaPStoreWriter(store_path, PROJECTION, LABELS, np.float32)
@@ -1,4 +1,5 @@
 import math
+from pathlib import Path
 
 import numpy as np
 import pytest
@@ -6,7 +7,8 @@ from pytest import param as P
 import yirgacheffe as yg
 
 from prepare_layers.make_food_current_map import balance_crop_and_pasture_differences, \
-    CROP_CODE, PASTURE_CODE, remove_land_cover, add_land_cover, TileInfo, process_tile, PRESERVE_CODES
+    CROP_CODE, PASTURE_CODE, remove_land_cover, add_land_cover, TileInfo, process_tile, PRESERVE_CODES, \
+    LandCover, tile_unchanged, build_tile_list, TileSlots, process_strip
 
 @pytest.mark.parametrize(
     [
@@ -148,23 +150,23 @@ def test_remove_land_simple(
     expected_other_cell: float,
 ) -> None:
     # 100% crop, 0% other 1
-    lcc_data_map = {
+    land_cover = LandCover.from_map({
         1: np.zeros((10, 10)),
         CROP_CODE: np.ones((10, 10)),
-    }
+    })
     pnv_data = np.full((10, 10), 1)
 
     remove_land_cover(
         CROP_CODE,
         crop_diff,
         pnv_data,
-        lcc_data_map,
+        land_cover,
     )
 
     expected_crop_map = np.full((10, 10), expected_crop_cell)
     expected_other_map = np.full((10, 10), expected_other_cell)
-    assert (expected_crop_map == lcc_data_map[CROP_CODE]).all()
-    assert (expected_other_map == lcc_data_map[1]).all()
+    assert (expected_crop_map == land_cover.layer(CROP_CODE)).all()
+    assert (expected_other_map == land_cover.layer(1)).all()
 
 
 @pytest.mark.parametrize(
@@ -191,27 +193,27 @@ def test_remove_land_less_simple(
     expected_other_2_cell: float,
 ) -> None:
     # 50% crop, 50% other 2, 0% other 1
-    lcc_data_map = {
+    land_cover = LandCover.from_map({
         1: np.zeros((10, 10)),
         2: np.array([[(i + 1) % 2] * 10 for i in range(10)]).astype(float),
         CROP_CODE: np.array([[i % 2] * 10 for i in range(10)]).astype(float),
-    }
+    })
     pnv_data = np.full((10, 10), pnv_value)
 
     remove_land_cover(
         CROP_CODE,
         crop_diff,
         pnv_data,
-        lcc_data_map,
+        land_cover,
     )
 
     expected_crop_map = np.array([[i % 2] * 10 for i in range(10)]).astype(float) * expected_crop_cell
-    assert (expected_crop_map == lcc_data_map[CROP_CODE]).all()
+    assert (expected_crop_map == land_cover.layer(CROP_CODE)).all()
     expected_other_1_map = np.array([[i % 2] * 10 for i in range(10)]).astype(float) * expected_other_1_cell
-    assert (expected_other_1_map == lcc_data_map[1]).all()
+    assert (expected_other_1_map == land_cover.layer(1)).all()
     expected_other_2_map = np.array([[(i + 1) % 2] * 10 for i in range(10)]).astype(float) + \
         (np.array([[i % 2] * 10 for i in range(10)]).astype(float) * expected_other_2_cell)
-    assert (expected_other_2_map == lcc_data_map[2]).all()
+    assert (expected_other_2_map == land_cover.layer(2)).all()
 
 
 @pytest.mark.parametrize("crop_diff,expected_crop_cell,expected_other_cell", [
@@ -224,21 +226,21 @@ def test_add_land_simple(
     expected_other_cell: float,
 ) -> None:
     # 100% crop, 0% other 1
-    lcc_data_map = {
+    land_cover = LandCover.from_map({
         1: np.ones((10, 10)),
         CROP_CODE: np.zeros((10, 10)),
-    }
+    })
 
     add_land_cover(
         np.ones((10, 10), dtype=bool),
         [(crop_diff, CROP_CODE)],
-        lcc_data_map,
+        land_cover,
     )
 
     expected_crop_map = np.full((10, 10), expected_crop_cell)
     expected_other_map = np.full((10, 10), expected_other_cell)
-    assert (expected_crop_map == lcc_data_map[CROP_CODE]).all()
-    assert (expected_other_map == lcc_data_map[1]).all()
+    assert (expected_crop_map == land_cover.layer(CROP_CODE)).all()
+    assert (expected_other_map == land_cover.layer(1)).all()
 
 
 @pytest.mark.parametrize("crop_diff,expected_crop_cell,expected_other_cell", [
@@ -251,24 +253,24 @@ def test_add_land_avoid_excluded(
     expected_other_cell: float,
 ) -> None:
     # 100% crop, 0% other 1
-    lcc_data_map = {
+    land_cover = LandCover.from_map({
         1: np.array([[(i + 1) % 2] * 10 for i in range(10)]).astype(float),
         PASTURE_CODE: np.array([[i % 2] * 10 for i in range(10)]).astype(float),
         CROP_CODE: np.zeros((10, 10)),
-    }
+    })
 
     add_land_cover(
         np.array([[(i + 1) % 2] * 10 for i in range(10)]).astype(bool),
         [(crop_diff, CROP_CODE)],
-        lcc_data_map,
+        land_cover,
     )
 
     expected_crop_map = np.array([[(i + 1) % 2] * 10 for i in range(10)]).astype(float) * expected_crop_cell
     expected_pasture_map = np.array([[i % 2] * 10 for i in range(10)]).astype(float) # unchanged
     expected_other_map = np.array([[(i + 1) % 2] * 10 for i in range(10)]).astype(float) * expected_other_cell
-    assert (expected_crop_map == lcc_data_map[CROP_CODE]).all()
-    assert (expected_pasture_map == lcc_data_map[PASTURE_CODE]).all()
-    assert (expected_other_map == lcc_data_map[1]).all()
+    assert (expected_crop_map == land_cover.layer(CROP_CODE)).all()
+    assert (expected_pasture_map == land_cover.layer(PASTURE_CODE)).all()
+    assert (expected_other_map == land_cover.layer(1)).all()
 
 
 @pytest.mark.parametrize(["crop_diff", "pasture_diff", "expected_totals"], [
@@ -396,12 +398,191 @@ def test_ensure_no_negative_values() -> None:
     crop = np.zeros(shape)
     other = np.array([0.05, 0.05, 0.8, 0.8])
 
-    lcc_data_map = {
+    land_cover = LandCover.from_map({
         CROP_CODE: crop,
         1: other,
-    }
+    })
 
-    add_land_cover(eligible_mask, [(0.1, CROP_CODE)], lcc_data_map)
+    add_land_cover(eligible_mask, [(0.1, CROP_CODE)], land_cover)
 
-    for lcc_data in lcc_data_map.values():
-        assert (lcc_data >= 0).all()
+    assert (land_cover.data >= 0).all()
+
+@pytest.mark.parametrize(
+    "crop_target,pasture_target,expected",
+    [
+        (float("nan"), float("nan"), True),
+        (0.25, 0.25, True),
+        (0.25, float("nan"), True),
+        (float("nan"), 0.25, True),
+        (0.3, 0.25, False),
+        (0.25, 0.0, False),
+    ]
+)
+def test_tile_unchanged(crop_target: float, pasture_target: float, expected: bool) -> None:
+    data = np.ones((5, 5))
+    projection = yg.MapProjection("epsg:4326", 1.0, -1.0)
+    lcc_maps = {
+        CROP_CODE: yg.from_array(np.pad(data, ((0, 5), (5, 0))), (0, 0), projection),
+        PASTURE_CODE: yg.from_array(np.pad(data, ((5, 0), (0, 5))), (0, 0), projection),
+    }
+    tile = TileInfo(0, 0, 10, 10, crop_target, pasture_target)
+    unchanged, read_data = tile_unchanged(lcc_maps, tile)
+    assert unchanged == expected
+    assert read_data.keys() == {CROP_CODE, PASTURE_CODE}
+    for lcc, layer in lcc_maps.items():
+        assert np.array_equal(read_data[lcc], layer.read_array(0, 0, 10, 10))
+
+    # Handing the arrays on must give the same result as process_tile reading them itself
+    pnv_map = yg.from_array(np.zeros((10, 10)), (0, 0), projection)
+    if not unchanged:
+        expected_maps = process_tile(lcc_maps, pnv_map, tile)
+        reused_maps = process_tile(lcc_maps, pnv_map, tile, read_data)
+        for lcc, data in expected_maps.items():
+            assert np.array_equal(reused_maps[lcc], data)
+
+def test_build_tile_list(tmp_path: Path) -> None:
+    nan = float("nan")
+    # The targets are on a 4 by 3 grid of tiles over a 10 by 7 map, so the tiles aren't all the same size
+    crop = np.array([
+        [0.1, nan, nan, 0.2],
+        [nan, nan, nan, nan],
+        [0.3, nan, 0.4, nan],
+    ], dtype=np.float32)
+    pasture = np.array([
+        [0.1, nan, 0.5, nan],
+        [nan, nan, nan, nan],
+        [nan, nan, nan, 0.6],
+    ], dtype=np.float32)
+    projection = yg.MapProjection("epsg:4326", 1.0, -1.0)
+    current_path = tmp_path / "current"
+    current_path.mkdir()
+    with yg.from_array(np.zeros((7, 10)), (0, 0), projection) as layer:
+        layer.to_geotiff(current_path / f"lcc_{CROP_CODE}.tif")
+    # Only the size of the target rasters matters, not their resolution
+    for name, data in (("crop.tif", crop), ("pasture.tif", pasture)):
+        with yg.from_array(data, (0, 0), projection) as layer:
+            layer.to_geotiff(tmp_path / name)
+
+    tiles, passthrough = build_tile_list(current_path, tmp_path / "crop.tif", tmp_path / "pasture.tif")
+
+    positions = ["x_position", "y_position", "width", "height"]
+    assert [tuple(int(x) for x in row) for row in tiles[positions]] == [
+        (0, 0, 2, 2), (5, 0, 3, 2), (8, 0, 2, 2),
+        (0, 5, 2, 2), (5, 5, 3, 2), (8, 5, 2, 2),
+    ]
+    # The targets keep the type of their rasters
+    assert tiles["crop_target"].dtype == np.float32
+    assert np.array_equal(tiles["crop_target"], crop[[0, 0, 0, 2, 2, 2], [0, 2, 3, 0, 2, 3]], equal_nan=True)
+    assert np.array_equal(tiles["pasture_target"], pasture[[0, 0, 0, 2, 2, 2], [0, 2, 3, 0, 2, 3]], equal_nan=True)
+
+    # Runs of tiles with no targets along a row are merged
+    assert [tuple(int(x) for x in row) for row in passthrough[positions]] == [
+        (2, 0, 3, 2), (0, 2, 10, 3), (2, 5, 3, 2),
+    ]
+    assert np.isnan(passthrough["crop_target"]).all()
+    assert np.isnan(passthrough["pasture_target"]).all()
+
+    # Between them every pixel of the map is covered exactly once
+    coverage = np.zeros((7, 10), dtype=int)
+    for row in np.concatenate([tiles, passthrough]):
+        x, y, width, height = (int(row[field]) for field in positions)
+        coverage[y:y + height, x:x + width] += 1
+    assert (coverage == 1).all()
+
+def test_tile_slots() -> None:
+    slots = TileSlots({CROP_CODE: np.dtype(np.float32), PASTURE_CODE: np.dtype(np.float64)}, 4, 3, 2)
+    try:
+        tile = TileInfo(0, 0, 4, 3, 0.5, 0.5)
+        first, second = slots.acquire(), slots.acquire()
+        assert {first, second} == {0, 1}
+        assert slots.free.empty()
+
+        # Each class of each slot has its own memory
+        for slot, value in ((first, 1.0), (second, 2.0)):
+            slots.view(slot, CROP_CODE, tile)[:] = value
+            slots.view(slot, PASTURE_CODE, tile)[:] = -value
+        assert (slots.view(first, CROP_CODE, tile) == 1.0).all()
+        assert (slots.view(first, PASTURE_CODE, tile) == -1.0).all()
+        assert (slots.view(second, CROP_CODE, tile) == 2.0).all()
+        assert slots.view(second, CROP_CODE, tile).dtype == np.float32
+
+        # A slot only goes back in the pool once every class has been read
+        slots.release(first)
+        assert slots.free.empty()
+        slots.release(first)
+        assert slots.free.get(timeout=5) == first
+    finally:
+        slots.close()
+
+@pytest.mark.parametrize(
+    "seed,class_dtypes,target_type,target_kinds",
+    [
+        P(1, {}, float, "mixed", id="float64"),
+        P(2, {}, np.float32, "mixed", id="float32-targets"),
+        P(3, {CROP_CODE: np.float32, PASTURE_CODE: np.float32, 100: np.float32, 200: np.float32,
+            300: np.float32, 600: np.float32}, np.float32, "mixed", id="float32"),
+        P(4, {}, float, "removals", id="removals"),
+        P(5, {}, float, "additions", id="additions"),
+        # Crop and pasture of different types can't be done together, so each tile is done on its own
+        P(6, {CROP_CODE: np.float32}, float, "mixed", id="mixed-crop-pasture"),
+        # As can't classes of different types
+        P(7, {300: np.float32}, float, "mixed", id="mixed-classes"),
+        P(8, {}, float, "unchanged", id="unchanged"),
+    ]
+)
+def test_process_strip_matches_process_tile(
+    seed: int,
+    class_dtypes: dict[int,type],
+    target_type: type,
+    target_kinds: str,
+) -> None:
+    rng = np.random.default_rng(seed)
+    projection = yg.MapProjection("epsg:4326", 1.0, -1.0)
+    codes = [100, 200, 300, CROP_CODE, PASTURE_CODE, 600]
+    widths = [4, 7, 3, 5, 6, 4]
+    height, width = 6, sum(widths) + 4
+
+    # Mostly whole pixels of a class, with some split between natural habitat and crop
+    classes = rng.choice(len(codes), size=(height, width), p=[0.2, 0.15, 0.15, 0.2, 0.2, 0.1])
+    data_map = {code: (classes == index).astype(np.float64) for index, code in enumerate(codes)}
+    split = (rng.random((height, width)) < 0.2) & (classes == 0)
+    fraction = rng.random((height, width))
+    data_map[100] = np.where(split, fraction, data_map[100])
+    data_map[CROP_CODE] = np.where(split, 1.0 - fraction, data_map[CROP_CODE])
+    lcc_maps = {
+        code: yg.from_array(data.astype(class_dtypes.get(code, np.float64)), (0, 0), projection)
+        for code, data in data_map.items()
+    }
+    pnv_map = yg.from_array(rng.choice([100, 200, 300], size=(height, width)), (0, 0), projection)
+
+    tiles = []
+    x_position = 2
+    for tile_width in widths:
+        window = (x_position, 1, tile_width, height - 1)
+        crop_coverage = lcc_maps[CROP_CODE].read_array(*window).mean()
+        pasture_coverage = lcc_maps[PASTURE_CODE].read_array(*window).mean()
+        crop_target, pasture_target = {
+            "mixed": (rng.choice([math.nan, crop_coverage, rng.random()]), rng.choice([math.nan, rng.random()])),
+            "removals": (crop_coverage * 0.5, pasture_coverage * 0.25),
+            "additions": (min(1.0, crop_coverage + 0.2), pasture_coverage + 0.05),
+            "unchanged": (crop_coverage, math.nan),
+        }[target_kinds]
+        tiles.append(TileInfo(*window, target_type(crop_target), target_type(pasture_target)))
+        x_position += tile_width
+
+    expected = {code: [] for code in codes}
+    for tile in tiles:
+        for code, data in process_tile(lcc_maps, pnv_map, tile).items():
+            expected[code].append(data)
+
+    result = process_strip(lcc_maps, pnv_map, tiles)
+
+    if result is None:
+        # No tile changes, so the strip is just the current maps
+        assert target_kinds == "unchanged"
+        result = {code: lcc_maps[code].read_array(2, 1, sum(widths), height - 1) for code in codes}
+    for code in codes:
+        # Each class is written out in the type of its map, whatever type the rules worked in
+        dtype = class_dtypes.get(code, np.float64)
+        strip = np.concatenate([x.astype(dtype) for x in expected[code]], axis=1)
+        assert np.array_equal(result[code].astype(dtype), strip)
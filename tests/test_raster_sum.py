@@ -0,0 +1,135 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+import yirgacheffe as yg
+
+from utils.raster_sum import RasterAccumulator, count_contributing, count_unchanged, counts_path_for, raster_info, \
+    raster_sum, deterministic_sum, LEDGER_FILENAME
+
+PROJECTION = yg.MapProjection("epsg:4326", 1.0, -1.0)
+
+# Small species rasters, by name, with where they sit in pixels within a 12 by 10 map
+SPECIES = {
+    "deltap_1_RESIDENT.tif": (0, 0, np.arange(1, 13, dtype=np.float64).reshape(3, 4) * 1e-3),
+    "deltap_2_RESIDENT.tif": (2, 1, np.full((5, 6), -2.5e-4)),
+    "deltap_3_BREEDING.tif": (7, 4, np.linspace(-1e-5, 1e-5, 30).reshape(6, 5)),
+    "deltap_3_NONBREEDING.tif": (11, 9, np.array([[7e-6]])),
+}
+WIDTH, HEIGHT = 12, 10
+
+def write_raster(path: Path, left: int, top: int, data: np.ndarray) -> None:
+    with yg.from_array(data, (left, -top), PROJECTION) as layer:
+        layer.to_geotiff(path)
+
+def expected_sum(species: dict[str, tuple[int, int, np.ndarray]]) -> np.ndarray:
+    total = np.zeros((HEIGHT, WIDTH))
+    for left, top, data in species.values():
+        height, width = data.shape
+        total[top:top + height, left:left + width] += data
+    return total
+
+def read_sum(path: Path) -> np.ndarray:
+    with yg.read_raster(path) as layer:
+        area = layer.area
+        assert (area.left, area.top) == (0, 0)
+        assert layer.window.xsize == WIDTH and layer.window.ysize == HEIGHT
+        return layer.read_array(0, 0, WIDTH, HEIGHT)
+
+@pytest.fixture(name="images_dir")
+def fixture_images_dir(tmp_path: Path) -> Path:
+    images_dir = tmp_path / "deltap"
+    images_dir.mkdir()
+    for name, (left, top, data) in SPECIES.items():
+        write_raster(images_dir / name, left, top, data)
+    return images_dir
+
+def test_accumulator_matches_plain_sum(tmp_path: Path, images_dir: Path) -> None:
+    area = yg.Area(left=0, top=0, right=WIDTH, bottom=-HEIGHT, projection=PROJECTION)
+    accumulator = RasterAccumulator(area, 1, tmp_path / "accumulator.dat")
+    for name in SPECIES:
+        accumulator.add(images_dir / name)
+    assert np.allclose(accumulator.data[0], expected_sum(SPECIES), rtol=1e-12, atol=0.0)
+
+    # Subtracting a species takes out just what it added
+    accumulator.add(images_dir / "deltap_2_RESIDENT.tif", negate=True)
+    remaining = {k: v for k, v in SPECIES.items() if k != "deltap_2_RESIDENT.tif"}
+    assert np.allclose(accumulator.data[0], expected_sum(remaining), rtol=1e-12, atol=1e-18)
+
+def test_accumulator_rejects_raster_outside_area(tmp_path: Path, images_dir: Path) -> None:
+    area, _ = raster_info(images_dir / "deltap_1_RESIDENT.tif")
+    accumulator = RasterAccumulator(area, 1, tmp_path / "accumulator.dat")
+    with pytest.raises(ValueError):
+        accumulator.add(images_dir / "deltap_2_RESIDENT.tif")
+
+def test_count_contributing_species_rasters(tmp_path: Path) -> None:
+    filenames = [tmp_path / f"deltap_T{x}A{x}_RESIDENT.tif" for x in range(3)]
+    assert count_contributing(filenames) == 3
+
+def test_count_contributing_shards(tmp_path: Path) -> None:
+    filenames = [tmp_path / "shard_0.tif", tmp_path / "shard_1.tif"]
+    pd.DataFrame([[4, 2]], columns=["contributing", "unchanged"]).to_csv(counts_path_for(filenames[0]), index=False)
+    pd.DataFrame([[5, 0]], columns=["contributing", "unchanged"]).to_csv(counts_path_for(filenames[1]), index=False)
+    assert count_contributing(filenames) == 9
+
+def test_count_contributing_partials(tmp_path: Path) -> None:
+    filenames = [tmp_path / "chunk_0.tif", tmp_path / "chunk_1.tif"]
+    pd.DataFrame([["1", "RESIDENT"], ["2", "NONBREEDING"]], columns=["taxid", "season"]).to_csv(
+        counts_path_for(filenames[0]), index=False)
+    pd.DataFrame([], columns=["taxid", "season"]).to_csv(counts_path_for(filenames[1]), index=False)
+    assert count_contributing(filenames) == 2
+
+def test_ledger_matches_full_sum(tmp_path: Path, images_dir: Path) -> None:
+    ledger_path = tmp_path / "ledger"
+    raster_sum(images_dir, tmp_path / "first.tif", 2, ledger_path)
+    assert (ledger_path / LEDGER_FILENAME).exists()
+    assert np.allclose(read_sum(tmp_path / "first.tif"), expected_sum(SPECIES), rtol=1e-12, atol=1e-18)
+
+    # Add a species, modify one, and remove another, all within the area of the existing sum, so
+    # that the sum is updated from the ledger
+    species = dict(SPECIES)
+    species["deltap_4_RESIDENT.tif"] = (3, 6, np.full((2, 2), 4e-4))
+    species["deltap_2_RESIDENT.tif"] = (2, 1, np.full((5, 6), 1.5e-4))
+    del species["deltap_3_BREEDING.tif"]
+    (images_dir / "deltap_3_BREEDING.tif").unlink()
+    for name in ["deltap_4_RESIDENT.tif", "deltap_2_RESIDENT.tif"]:
+        left, top, data = species[name]
+        (images_dir / name).unlink(missing_ok=True)
+        write_raster(images_dir / name, left, top, data)
+
+    raster_sum(images_dir, tmp_path / "incremental.tif", 2, ledger_path)
+    raster_sum(images_dir, tmp_path / "full.tif", 2)
+    incremental = read_sum(tmp_path / "incremental.tif")
+    assert np.allclose(incremental, read_sum(tmp_path / "full.tif"), rtol=1e-9, atol=1e-15)
+    assert np.allclose(incremental, expected_sum(species), rtol=1e-9, atol=1e-15)
+
+    # With nothing changed, the sum kept with the ledger is used as is
+    raster_sum(images_dir, tmp_path / "unchanged.tif", 2, ledger_path)
+    assert np.array_equal(read_sum(tmp_path / "unchanged.tif"), incremental)
+
+@pytest.mark.parametrize("processes_count", [1, 3])
+def test_deterministic_sum_ignores_order(tmp_path: Path, images_dir: Path, processes_count: int) -> None:
+    filenames = sorted(images_dir.glob("*.tif"))
+    deterministic_sum(filenames, tmp_path / "forwards.tif", tmp_path, 1)
+    for index, order in enumerate([filenames[::-1], filenames[1:] + filenames[:1]]):
+        output_path = tmp_path / f"order_{index}.tif"
+        deterministic_sum(order, output_path, tmp_path, processes_count)
+        assert np.array_equal(read_sum(output_path), read_sum(tmp_path / "forwards.tif"))
+    assert np.allclose(read_sum(tmp_path / "forwards.tif"), expected_sum(SPECIES), rtol=1e-12, atol=1e-18)
+
+@pytest.mark.parametrize(
+    "markers,expected",
+    [
+        (None, 0),
+        ([], 0),
+        (["deltap_1_RESIDENT", "deltap_2_NONBREEDING"], 2),
+    ]
+)
+def test_count_unchanged(tmp_path: Path, markers, expected) -> None:
+    unchanged_path = tmp_path / "unchanged"
+    if markers is not None:
+        unchanged_path.mkdir()
+        for marker in markers:
+            (unchanged_path / marker).touch()
+    assert count_unchanged(unchanged_path) == expected
@@ -0,0 +1,69 @@
+import argparse
+import json
+import os
+from pathlib import Path
+
+import pandas as pd
+
+def aoh_totals_index(
+    aohs_path: Path,
+    output_path: Path,
+) -> None:
+    """Gather the AOH totals from the JSON file that sits besides each AOH raster into a single
+    table, so that downstream stages can look up totals without opening a file per species."""
+    res = []
+    for scenario_path in sorted(x for x in aohs_path.iterdir() if x.is_dir()):
+        for taxa_path in sorted(x for x in scenario_path.iterdir() if x.is_dir()):
+            for json_path in sorted(taxa_path.glob("aoh_*.json")):
+                with open(json_path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                # Filenames are of the form aoh_{taxid}_{season}.json
+                taxid, season = json_path.stem.removeprefix("aoh_").split("_")
+                res.append([
+                    scenario_path.name,
+                    taxa_path.name,
+                    taxid,
+                    data.get("id_no"),
+                    season,
+                    data["aoh_total"],
+                    # Not every AOH has a raster, for instance if the species has no habitat
+                    json_path.with_suffix(".tif").exists(),
+                ])
+
+    df = pd.DataFrame(res, columns=[
+        "scenario",
+        "taxa",
+        "taxid",
+        "id_no",
+        "season",
+        "aoh_total",
+        "has_raster",
+    ])
+    os.makedirs(output_path.parent, exist_ok=True)
+    df.to_parquet(output_path, index=False)
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Build an index of the AOH totals for all species and scenarios.")
+    parser.add_argument(
+        "--aohs",
+        type=Path,
+        required=True,
+        dest="aohs_path",
+        help="Directory containing the AOHs, with a subdirectory per scenario and then per taxa",
+    )
+    parser.add_argument(
+        "--output",
+        type=Path,
+        required=True,
+        dest="output_path",
+        help="Destination parquet file",
+    )
+    args = parser.parse_args()
+
+    aoh_totals_index(
+        args.aohs_path,
+        args.output_path,
+    )
+
+if __name__ == "__main__":
+    main()
@@ -9,14 +9,15 @@ import pandas as pd
 TAXA = ["AMPHIBIA", "AVES", "MAMMALIA", "REPTILIA"]
 
 def absolute(
-    current_filename: Path,
-    pnv_filename: Path,
-    scenario_filename: Path,
+    totals_filename: Path,
+    scenario_name: str,
     output_filename: Path,
 ) -> None:
-    current = pd.read_csv(current_filename)
-    pnv = pd.read_csv(pnv_filename)
-    scenario = pd.read_csv(scenario_filename)
+    totals = pd.read_parquet(totals_filename, columns=["scenario", "taxa", "id_no", "season", "aoh_total"])
+    totals.rename(columns={"taxa": "class_name"}, inplace=True)
+    current = totals[totals.scenario == "current"].drop(columns="scenario")
+    pnv = totals[totals.scenario == "pnv"].drop(columns="scenario")
+    scenario = totals[totals.scenario == scenario_name].drop(columns="scenario")
 
     current_cleaned = current[current.aoh_total.notnull() & current.aoh_total != 0]
     pnv_cleaned = pnv[pnv.aoh_total.notnull() & pnv.aoh_total != 0]
@@ -62,25 +63,18 @@ def absolute(
 def main() -> None:
     parser = argparse.ArgumentParser()
     parser.add_argument(
-        "--current",
+        "--totals",
         type=Path,
         required=True,
-        dest="current_filename",
-        help="Current AoH validation summary"
-    )
-    parser.add_argument(
-        "--pnv",
-        type=Path,
-        required=True,
-        dest="pnv_filename",
-        help="PNV AoH validation summary"
+        dest="totals_filename",
+        help="AOH totals index, as generated by aoh_totals_index.py"
     )
     parser.add_argument(
         "--scenario",
-        type=Path,
+        type=str,
         required=True,
-        dest="scenario_filename",
-        help="Scenario AoH validation summary"
+        dest="scenario_name",
+        help="Name of the scenario to compare against current"
     )
     parser.add_argument(
         "--output",
@@ -92,9 +86,8 @@ def main() -> None:
     args = parser.parse_args()
 
     absolute(
-        args.current_filename,
-        args.pnv_filename,
-        args.scenario_filename,
+        args.totals_filename,
+        args.scenario_name,
         args.output_filename,
     )
 
@@ -11,9 +11,12 @@ def species_generator(
     curve: str,
     output_csv_path: Path,
     scenarios: List[str],
+    taxas: List[str] | None = None,
+    extra_curves: List[str] | None = None,
 ):
     species_info_dir = data_dir / "species-info"
-    taxas = [x.name for x in species_info_dir.iterdir()]
+    if not taxas:
+        taxas = [x.name for x in species_info_dir.iterdir()]
 
     if aohs_path is None:
         aohs_path = data_dir / "aohs"
@@ -21,10 +24,15 @@ def species_generator(
     if curve not in ["0.1", "0.25", "0.5", "1.0", "gompertz"]:
         sys.exit(f'curve {curve} not in expected set of values: ["0.1", "0.25", "0.5", "1.0", "gompertz"]')
 
+    # Any extra curves are calculated at the same time as the main curve, and stored as extra bands
+    # in the same rasters, which are stored under the main curve's name.
+    curves = list(dict.fromkeys([curve] + (extra_curves or [])))
+
     res = []
     for taxa in taxas:
         taxa_path = species_info_dir / taxa / "current"
-        speciess = [x.stem.split('_') for x in taxa_path.glob("*.geojson")]
+        # Range files are named range_{taxid}_{season}.geojson
+        speciess = [x.stem.removeprefix("range_").split('_') for x in sorted(taxa_path.glob("*.geojson"))]
         for scenario in scenarios:
             for taxid, season in speciess:
                 res.append([
@@ -33,8 +41,8 @@ def species_generator(
                     aohs_path / "current" / taxa,
                     aohs_path / scenario / taxa,
                     aohs_path / "pnv" / taxa,
-                    curve,
-                    data_dir / "deltap" / scenario / curve / taxa,
+                    ",".join(curves),
+                    data_dir / "deltap" / scenario / curve / taxa / f"deltap_{taxid}_{season}.tif",
                 ])
 
     df = pd.DataFrame(res, columns=[
@@ -73,6 +81,15 @@ def main() -> None:
         required=True,
         dest="curve",
     )
+    parser.add_argument(
+        '--extra_curves',
+        nargs='*',
+        type=str,
+        choices=["0.1", "0.25", "0.5", "1.0", "gompertz"],
+        help='additional extinction curves to calculate as extra bands alongside the main curve',
+        required=False,
+        dest="extra_curves",
+    )
     parser.add_argument(
         '--output',
         type=Path,
@@ -88,6 +105,14 @@ def main() -> None:
         required=True,
         dest="scenarios",
     )
+    parser.add_argument(
+        '--taxa',
+        nargs='*',
+        type=str,
+        help="list of taxa to include, defaults to all taxa in the species info directory",
+        required=False,
+        dest="taxas",
+    )
     args = parser.parse_args()
 
     species_generator(
@@ -96,6 +121,8 @@ def main() -> None:
         args.curve,
         args.output,
         args.scenarios,
+        args.taxas,
+        args.extra_curves,
     )
 
 if __name__ == "__main__":
@@ -1,28 +1,435 @@
 import argparse
-import resource
+import hashlib
+import operator
+import os
+import shutil
+import tempfile
+import zlib
+from functools import reduce
+from multiprocessing import Pool, cpu_count
 from pathlib import Path
+from typing import NamedTuple
 
+import numpy as np
+import pandas as pd
 import yirgacheffe as yg
 from alive_progress import alive_bar # type: ignore
 from snakemake_argparse_bridge import snakemake_compatible # type: ignore
 
+# How many rows of data we process at once when moving data in and out of the accumulator
+CHUNK_ROWS = 512
+
+# The files kept in the ledger directory for incremental sums
+LEDGER_FILENAME = "ledger.csv"
+SUM_FILENAME = "sum.tif"
+CONTRIBUTIONS_DIRNAME = "contributions"
+
+# Alongside the sum we record how many species went into it, and how many were left out because
+# the scenario doesn't change them, as both count towards the number of species when scaling.
+COUNTS_COLUMNS = ["contributing", "unchanged"]
+
+class RasterAccumulator: # pylint: disable=R0903
+    """Sums rasters into a float64 array covering a given area, with a band per curve. Each raster
+    is only added into its own window of the array, so the cost of adding a species is proportional
+    to its range rather than to the whole area. The array is backed by a memory mapped file, so only
+    the parts of the map actually covered by species ranges take up memory or disk."""
+
+    def __init__(self, area: yg.Area, bands: int, filename: Path) -> None:
+        assert area.projection is not None
+        self.area = area
+        self.map_projection = area.projection
+        width, height = area.pixel_dimensions
+        self.shape = (bands, height, width)
+        self.filename = filename
+        self.data = np.memmap(filename, dtype=np.float64, mode="w+", shape=self.shape)
+
+    def add(self, filename: Path, negate: bool = False) -> None:
+        """Add a raster into its window of the accumulator, or subtract it if negate is set."""
+        layers = [yg.read_raster(filename, band=band) for band in range(1, self.shape[0] + 1)]
+        try:
+            layer = layers[0]
+            projection = self.map_projection
+            if layer.map_projection != projection:
+                raise ValueError(f"Map projection of {filename} does not match accumulator")
+            if layer._dataset.RasterCount != self.shape[0]: # pylint: disable=W0212
+                raise ValueError(f"Band count of {filename} does not match accumulator")
+
+            xoff = round((layer.area.left - self.area.left) / projection.xstep)
+            yoff = round((layer.area.top - self.area.top) / projection.ystep)
+            width, height = layer.window.xsize, layer.window.ysize
+            if (xoff < 0) or (yoff < 0) or (xoff + width > self.shape[2]) or (yoff + height > self.shape[1]):
+                raise ValueError(f"{filename} is not within the accumulator area")
+
+            # The rasters may be stored as float32 to save space, but the values are small and
+            # there are many of them, so they are always summed as float64.
+            for yoffset in range(0, height, CHUNK_ROWS):
+                step = min(CHUNK_ROWS, height - yoffset)
+                window = self.data[:, yoff + yoffset:yoff + yoffset + step, xoff:xoff + width]
+                for band, band_layer in enumerate(layers):
+                    if negate:
+                        window[band] -= band_layer.read_array(0, yoffset, width, step)
+                    else:
+                        window[band] += band_layer.read_array(0, yoffset, width, step)
+        finally:
+            for layer in layers:
+                layer.close()
+
+def raster_info(filename: Path) -> tuple[yg.Area, list[str]]:
+    """Get the area of a raster and the labels of its bands."""
+    with yg.read_raster(filename) as layer:
+        dataset = layer._dataset # pylint: disable=W0212
+        return layer.area, [dataset.GetRasterBand(x).GetDescription() for x in range(1, dataset.RasterCount + 1)]
+
+# Each worker process in the pool has its own accumulator, as there is no locking between workers.
+_ACCUMULATOR: RasterAccumulator | None = None
+
+def init_worker(area: yg.Area, bands: int, partials_dir: Path) -> None:
+    global _ACCUMULATOR # pylint: disable=W0603
+    _ACCUMULATOR = RasterAccumulator(area, bands, partials_dir / f"partial_{os.getpid()}.dat")
+
+def accumulate(item: tuple[Path, bool]) -> Path:
+    filename, negate = item
+    assert _ACCUMULATOR is not None
+    _ACCUMULATOR.add(filename, negate)
+    return _ACCUMULATOR.filename
+
+def accumulate_rasters(
+    items: list[tuple[Path, bool]],
+    area: yg.Area,
+    bands: int,
+    partials_dir: Path,
+    processes_count: int,
+) -> list[Path]:
+    """Add (or subtract, where the flag is set) each raster into a per worker accumulator covering the
+    area, returning the paths of the accumulators that were used."""
+    partial_paths = set()
+    with Pool(
+        processes=max(1, min(processes_count, len(items))),
+        initializer=init_worker,
+        initargs=(area, bands, partials_dir),
+    ) as pool:
+        with alive_bar(len(items)) as bar:
+            for partial_path in pool.imap_unordered(accumulate, items, chunksize=16):
+                partial_paths.add(partial_path)
+                bar() # pylint: disable=E1102
+    return sorted(partial_paths)
+
+def write_sum(
+    area: yg.Area,
+    labels: list[str],
+    partial_paths: list[Path],
+    output_filename: Path,
+    base_filename: Path | None = None,
+) -> None:
+    """Sum the accumulators, and optionally an existing raster of the same area, into a new raster."""
+    assert area.projection is not None
+    width, height = area.pixel_dimensions
+    shape = (len(labels), height, width)
+    partials = [np.memmap(x, dtype=np.float64, mode="r", shape=shape) for x in partial_paths]
+    base = [yg.read_raster(base_filename, band=x) for x in range(1, len(labels) + 1)] \
+        if base_filename is not None else []
+    result = yg.layers.RasterLayer.empty_raster_layer(
+        area,
+        area.projection.scale,
+        yg.DataType.Float64,
+        filename=output_filename,
+        projection=area.projection.name,
+        bands=len(labels),
+    )
+    try:
+        for index, label in enumerate(labels):
+            band = result._dataset.GetRasterBand(index + 1) # pylint: disable=W0212
+            if len(labels) > 1:
+                band.SetDescription(label)
+            for yoffset in range(0, height, CHUNK_ROWS):
+                step = min(CHUNK_ROWS, height - yoffset)
+                total = np.zeros((step, width), dtype=np.float64)
+                if base:
+                    total += base[index].read_array(0, yoffset, width, step)
+                for data in partials:
+                    total += data[index, yoffset:yoffset + step]
+                band.WriteArray(total, 0, yoffset)
+    finally:
+        result.close()
+        for layer in base:
+            layer.close()
+
+def file_hash(filename: Path) -> str:
+    digest = hashlib.sha256()
+    with open(filename, "rb") as f:
+        while block := f.read(1 << 20):
+            digest.update(block)
+    return digest.hexdigest()
+
+def load_ledger(ledger_path: Path) -> dict[str, str]:
+    """Load the record of which rasters, by filename and content hash, make up the sum kept
+    alongside the ledger. If there is no ledger then there is no sum to update."""
+    try:
+        df = pd.read_csv(ledger_path / LEDGER_FILENAME, dtype=str)
+    except FileNotFoundError:
+        return {}
+    return dict(zip(df.filename, df.hash))
+
+def full_sum(
+    filenames: list[Path],
+    output_filename: Path,
+    partials_dir: Path,
+    processes_count: int,
+) -> None:
+    with Pool(processes=max(1, min(processes_count, len(filenames)))) as pool:
+        info = pool.map(raster_info, filenames, chunksize=64)
+    area = reduce(operator.or_, [x for x, _ in info])
+    labels = info[0][1]
+
+    items = [(x, False) for x in filenames]
+    partial_paths = accumulate_rasters(items, area, len(labels), partials_dir, processes_count)
+    write_sum(area, labels, partial_paths, output_filename)
+
+class RasterWindow(NamedTuple):
+    """Where a raster sits within the area being summed, in pixels"""
+    filename : Path
+    xoff : int
+    yoff : int
+    width : int
+    height : int
+
+# For deterministic sums each worker needs to know where every raster is, and where the result is
+_WINDOWS: list[RasterWindow] = []
+_RESULT_SETTINGS: tuple[Path, tuple[int, int, int]] | None = None
+
+def init_deterministic_worker(windows: list[RasterWindow], result_path: Path, shape: tuple[int, int, int]) -> None:
+    global _WINDOWS, _RESULT_SETTINGS # pylint: disable=W0603
+    _WINDOWS = windows
+    _RESULT_SETTINGS = (result_path, shape)
+
+def sum_rows(rows: tuple[int, int]) -> None:
+    """Sum every raster that covers a block of rows, always in the same order, into that block of the
+    result. The sum is compensated (Neumaier), as the many small values lose precision otherwise."""
+    top, bottom = rows
+    assert _RESULT_SETTINGS is not None
+    result_path, shape = _RESULT_SETTINGS
+    bands, _, width = shape
+    total = np.zeros((bands, bottom - top, width), dtype=np.float64)
+    compensation = np.zeros_like(total)
+    for window in _WINDOWS:
+        start, end = max(top, window.yoff), min(bottom, window.yoff + window.height)
+        if start >= end:
+            continue
+        columns = slice(window.xoff, window.xoff + window.width)
+        for band in range(bands):
+            with yg.read_raster(window.filename, band=band + 1) as layer:
+                data = np.asarray(layer.read_array(0, start - window.yoff, window.width, end - start), dtype=np.float64)
+            current = total[band, start - top:end - top, columns]
+            updated = current + data
+            compensation[band, start - top:end - top, columns] += np.where(
+                np.abs(current) >= np.abs(data),
+                (current - updated) + data,
+                (data - updated) + current,
+            )
+            current[:] = updated
+
+    result = np.memmap(result_path, dtype=np.float64, mode="r+", shape=shape)
+    np.add(total, compensation, out=result[:, top:bottom])
+    result.flush()
+
+def deterministic_sum(
+    filenames: list[Path],
+    output_filename: Path,
+    partials_dir: Path,
+    processes_count: int,
+) -> None:
+    """Sum the rasters such that the result doesn't depend on the number of workers or the order in
+    which they run. Rather than each worker summing some of the rasters over the whole area, each
+    worker sums all of the rasters, in the order of their filenames, over a fixed block of rows."""
+    filenames = sorted(filenames)
+    with Pool(processes=max(1, min(processes_count, len(filenames)))) as pool:
+        info = pool.map(raster_info, filenames, chunksize=64)
+    area = reduce(operator.or_, [x for x, _ in info])
+    labels = info[0][1]
+    assert area.projection is not None
+    projection = area.projection
+
+    windows = []
+    for filename, (raster_area, raster_labels) in zip(filenames, info):
+        if len(raster_labels) != len(labels):
+            raise ValueError(f"Band count of {filename} does not match the other rasters")
+        width, height = raster_area.pixel_dimensions
+        windows.append(RasterWindow(
+            filename,
+            round((raster_area.left - area.left) / projection.xstep),
+            round((raster_area.top - area.top) / projection.ystep),
+            width,
+            height,
+        ))
+
+    width, height = area.pixel_dimensions
+    shape = (len(labels), height, width)
+    result_path = partials_dir / "sum.dat"
+    np.memmap(result_path, dtype=np.float64, mode="w+", shape=shape).flush()
+
+    blocks = [(x, min(x + CHUNK_ROWS, height)) for x in range(0, height, CHUNK_ROWS)]
+    with Pool(
+        processes=max(1, min(processes_count, len(blocks))),
+        initializer=init_deterministic_worker,
+        initargs=(windows, result_path, shape),
+    ) as pool:
+        with alive_bar(len(blocks)) as bar:
+            for _ in pool.imap_unordered(sum_rows, blocks):
+                bar() # pylint: disable=E1102
+    write_sum(area, labels, [result_path], output_filename)
+
+def incremental_sum(
+    images_dir: Path,
+    ledger_path: Path,
+    added: list[str],
+    removed: list[str],
+    output_filename: Path,
+    partials_dir: Path,
+    processes_count: int,
+) -> None:
+    """Update the sum kept with the ledger by subtracting the old contribution of the removed
+    rasters, using the copies kept with the ledger, and adding the new ones. This raises a
+    ValueError if the new rasters don't fit within the existing sum."""
+    base_filename = ledger_path / SUM_FILENAME
+    area, labels = raster_info(base_filename)
+    items = [(ledger_path / CONTRIBUTIONS_DIRNAME / x, True) for x in removed] + \
+        [(images_dir / x, False) for x in added]
+    partial_paths = accumulate_rasters(items, area, len(labels), partials_dir, processes_count)
+    write_sum(area, labels, partial_paths, output_filename, base_filename)
+
+def shard_of(filename: Path, shards: int) -> int:
+    """Pick the shard for a raster from a stable hash of its name, so that a species stays in the
+    same shard as others are added or removed, which keeps the shard ledgers useful."""
+    return zlib.crc32(filename.name.encode("utf-8")) % shards
+
+def counts_path_for(filename: Path) -> Path:
+    return filename.with_suffix(".csv")
+
+def count_contributing(filenames: list[Path]) -> int:
+    """Count the species that went into a set of rasters. A raster with no CSV alongside it is a
+    single species. Otherwise it is already a sum, and the CSV either has the species counts from
+    an earlier raster_sum, as for shards, or lists the species in it, as for fused partial sums."""
+    count = 0
+    for filename in filenames:
+        counts_path = counts_path_for(filename)
+        if not counts_path.exists():
+            count += 1
+            continue
+        df = pd.read_csv(counts_path)
+        if "contributing" in df.columns:
+            count += int(df.contributing.sum())
+        else:
+            count += len(df.drop_duplicates())
+    return count
+
+def count_unchanged(unchanged_path: Path | None) -> int:
+    """Count the species marked as unchanged by the delta P calculation, which leaves a file per
+    species in the given directory. If there is no directory then no species were unchanged."""
+    if unchanged_path is None or not unchanged_path.is_dir():
+        return 0
+    return sum(1 for _ in unchanged_path.iterdir())
+
 def raster_sum(
     images_dir: Path,
     output_filename: Path,
+    processes_count: int = 1,
+    ledger_path: Path | None = None,
+    shard: int = 0,
+    shards: int = 1,
+    deterministic: bool = False,
+    unchanged_path: Path | None = None,
 ) -> None:
-    # We'll be opening all the deltap files per taxa in one, so we'll need to raise
-    # the number of files we can open.
-    _, max_fd_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
-    resource.setrlimit(resource.RLIMIT_NOFILE, (max_fd_limit, max_fd_limit))
+    """Sum all the rasters in a directory. Rather than evaluate every raster over the union of all their
+    areas, each worker in a process pool adds rasters one at a time into just their window of its own
+    memory mapped accumulator, which covers that union. The accumulators are then summed into the result
+    in blocks of rows. If delta P was calculated for several curves at once then there is a band per
+    curve, and each band is summed separately.
+
+    If a ledger directory is given, then it keeps a copy of the sum, along with the content hash and a
+    copy of each raster that went into it. On later runs only the rasters that were added, removed,
+    or changed since are subtracted from or added to that sum, rather than summing everything again.
+    Rounding means this can differ very slightly from a full sum, so deleting the ledger directory
+    forces a full sum.
+
+    The work can be split over several jobs by giving each a shard index, in which case the job only
+    sums its share of the rasters. Summing the directory of shard results then gives the full sum.
+
+    If deterministic is set, the result is identical whatever the number of workers, which the
+    default per worker accumulators can't guarantee, though it is slower. This can't be combined with
+    the ledger, as the result of an incremental update depends on the history of updates."""
+    if deterministic and ledger_path is not None:
+        raise ValueError("Deterministic sums can't be updated incrementally from a ledger")
+    if not 0 <= shard < shards:
+        raise ValueError(f"Shard {shard} is out of range for {shards} shards")
+    filenames = [x for x in sorted(images_dir.glob("*.tif")) if shard_of(x, shards) == shard]
+    if not filenames:
+        if shards == 1:
+            raise ValueError(f"No rasters found in {images_dir}")
+        # With many shards and few species a shard can be empty, and then it has nothing to add
+        print(f"No rasters found in {images_dir} for shard {shard}")
+        return
+    os.makedirs(output_filename.parent, exist_ok=True)
+    pd.DataFrame(
+        [[count_contributing(filenames), count_unchanged(unchanged_path)]],
+        columns=COUNTS_COLUMNS,
+    ).to_csv(counts_path_for(output_filename), index=False)
+
+    with tempfile.TemporaryDirectory(dir=output_filename.parent) as tmpdir:
+        partials_dir = Path(tmpdir)
+        if deterministic:
+            deterministic_sum(filenames, output_filename, partials_dir, processes_count)
+            return
+        if ledger_path is None:
+            full_sum(filenames, output_filename, partials_dir, processes_count)
+            return
+
+        with Pool(processes=max(1, min(processes_count, len(filenames)))) as pool:
+            hashes = dict(zip([x.name for x in filenames], pool.map(file_hash, filenames, chunksize=64)))
+        previous = load_ledger(ledger_path)
+        changed = [name for name, digest in hashes.items() if previous.get(name) != digest]
+        removed = [name for name, digest in previous.items() if hashes.get(name) != digest]
+        print(f"{len(set(changed) - set(previous))} rasters added, {len(set(changed) & set(previous))} changed, "
+            f"{len(set(removed) - set(hashes))} removed")
+
+        if previous and not changed and not removed:
+            shutil.copyfile(ledger_path / SUM_FILENAME, output_filename)
+            return
 
-    layers = [yg.read_raster(x) for x in images_dir.glob("*.tif")]
-    total = yg.sum(layers)
-    with alive_bar(manual=True) as bar:
-        total.to_geotiff(output_filename, callback=bar, parallelism=True)
+        new_sum = partials_dir / SUM_FILENAME
+        try:
+            if not previous or not (ledger_path / SUM_FILENAME).exists():
+                raise ValueError("no existing sum to update")
+            incremental_sum(images_dir, ledger_path, changed, removed, new_sum, partials_dir, processes_count)
+        except ValueError as exc:
+            print(f"Calculating full sum: {exc}")
+            full_sum(filenames, new_sum, partials_dir, processes_count)
+            changed, removed = list(hashes), list(previous)
+
+        # The ledger is removed first, so that if we fail part way through updating the
+        # contributions, the next run will do a full sum rather than use a mismatched ledger.
+        contributions_path = ledger_path / CONTRIBUTIONS_DIRNAME
+        os.makedirs(contributions_path, exist_ok=True)
+        (ledger_path / LEDGER_FILENAME).unlink(missing_ok=True)
+        for name in removed:
+            (contributions_path / name).unlink(missing_ok=True)
+        for name in changed:
+            shutil.copyfile(images_dir / name, contributions_path / name)
+        shutil.copyfile(new_sum, output_filename)
+        shutil.move(new_sum, ledger_path / SUM_FILENAME)
+        pd.DataFrame(list(hashes.items()), columns=["filename", "hash"]).to_csv(
+            ledger_path / LEDGER_FILENAME,
+            index=False,
+        )
 
 @snakemake_compatible(mapping={
     "rasters_directory": "params.rasters_dir",
     "output_filename": "output[0]",
+    "processes_count": "params.processes",
+    "ledger_path": "params.ledger_dir",
+    "shard": "params.shard",
+    "shards": "params.shards",
+    "deterministic": "params.deterministic",
+    "unchanged_path": "params.unchanged",
 })
 def main() -> None:
     parser = argparse.ArgumentParser(description="Sums many rasters into a single raster")
@@ -40,11 +447,67 @@ def main() -> None:
         dest="output_filename",
         help="Destination geotiff file for results."
     )
+    parser.add_argument(
+        "-j",
+        type=int,
+        required=False,
+        default=cpu_count() // 2,
+        dest="processes_count",
+        help="Number of concurrent processes to use."
+    )
+    parser.add_argument(
+        "--ledger",
+        type=Path,
+        required=False,
+        default=None,
+        dest="ledger_path",
+        help="Directory in which to keep a copy of the sum and of what went into it, so that later runs only "
+            "need to add and subtract the rasters that changed."
+    )
+    parser.add_argument(
+        "--shard",
+        type=int,
+        required=False,
+        default=0,
+        dest="shard",
+        help="Which shard of the rasters to sum, if the work is split over several jobs."
+    )
+    parser.add_argument(
+        "--shards",
+        type=int,
+        required=False,
+        default=1,
+        dest="shards",
+        help="How many shards the rasters are split into."
+    )
+    parser.add_argument(
+        "--deterministic",
+        action="store_true",
+        required=False,
+        default=False,
+        dest="deterministic",
+        help="Sum in a fixed order, so the result doesn't depend on the number of processes."
+    )
+    parser.add_argument(
+        "--unchanged",
+        type=Path,
+        required=False,
+        default=None,
+        dest="unchanged_path",
+        help="Directory of markers for the species the scenario left unchanged, as written by the delta P "
+            "calculation, to be counted alongside the species summed."
+    )
     args = parser.parse_args()
 
     raster_sum(
         args.rasters_directory,
         args.output_filename,
+        args.processes_count,
+        args.ledger_path,
+        args.shard,
+        args.shards,
+        args.deterministic,
+        args.unchanged_path,
     )
 
 if __name__ == "__main__":
@@ -132,6 +132,36 @@ rule aggregate_aohs_per_taxa:
         """
 
 
+# =============================================================================
+# AOH Totals Index
+# =============================================================================
+
+
+rule aoh_totals_index:
+    """
+    Gather the AOH totals for every species in every scenario into a single
+    table, so that downstream rules can look up totals without reading the
+    JSON file for each AOH.
+    """
+    input:
+        sentinels=expand(
+            str(DATADIR / "aohs" / "{scenario}" / "{taxa}" / ".complete"),
+            scenario=ALL_AOH_SCENARIOS,
+            taxa=TAXA,
+        ),
+    output:
+        totals=DATADIR / "aohs" / "totals.parquet",
+    log:
+        DATADIR / "logs" / "aoh_totals_index.log",
+    shell:
+        """
+        python3 {SRCDIR}/utils/aoh_totals_index.py \
+            --aohs {DATADIR}/aohs \
+            --output {output.totals} \
+            2>&1 | tee {log}
+        """
+
+
 # =============================================================================
 # Collate AOH Data (per scenario)
 # =============================================================================
@@ -175,12 +205,10 @@ rule footprint_of_humanity:
     """
     Compute the footprint of humanity metric for a given scenario.
 
-    Compares current AOH data against PNV and the scenario CSVs.
+    Compares current AOH totals against PNV and the scenario.
     """
     input:
-        pnv_csv=DATADIR / "aohs" / "pnv.csv",
-        scenario_csv=DATADIR / "aohs" / "{scenario}.csv",
-        current_csv=DATADIR / "aohs" / "current.csv",
+        totals=DATADIR / "aohs" / "totals.parquet",
     output:
         DATADIR / "footprint" / "{scenario}.csv",
     log:
@@ -191,9 +219,8 @@ rule footprint_of_humanity:
         """
         mkdir -p $(dirname {output})
         python3 {SRCDIR}/utils/footprint_of_humanity.py \
-            --current {input.current_csv} \
-            --pnv {input.pnv_csv} \
-            --scenario {input.scenario_csv} \
+            --totals {input.totals} \
+            --scenario {wildcards.scenario} \
             --output {output} \
             2>&1 | tee {log}
         """
@@ -5,17 +5,47 @@
 # for each user-defined scenario, then aggregates to produce final maps.
 #
 # Pipeline per scenario:
-# 1. calculate_delta_p: per species, uses current + scenario + pnv AOHs
+# 0. change_mask_scenario: tile map of where the scenario changes habitat
+# 1. calculate_delta_p: per species, uses current + scenario + pnv AOHs, or
+#    calculate_delta_p_batch if delta_p_chunks is set in the config. Species
+#    the scenario doesn't change get no raster, and are marked in unchanged/
 # 2. aggregate_delta_p_per_taxa: sentinel that all species are done
-# 3. raster_sum_per_taxa: sum per-species delta P values per taxa
-# 4. species_totals: count species per taxa for normalisation
-# 5. delta_p_scaled: final scaled output map
+# 3. raster_sum_per_taxa: sum per-species delta P values per taxa, and count
+#    the species summed and left unchanged for normalisation
+# 4. delta_p_scaled: final scaled output map
+# 5. delta_p_cog: optional Cloud Optimized GeoTIFF copy of the final map
+# 6. delta_p_groups: optional sums by arbitrary species groupings from the config
 
 
 import os
 from pathlib import Path
 from types import SimpleNamespace
 
+# =============================================================================
+# Scenario Change Masks
+# =============================================================================
+
+
+rule change_mask_scenario:
+    """
+    Generate a tile level map of where a scenario changes habitat, which lets
+    delta P skip species whose AOH the scenario does not touch.
+    """
+    input:
+        diffmap=DATADIR / "habitat" / "{scenario}_diff_area.tif",
+    output:
+        DATADIR / "habitat" / "{scenario}_change_mask.tif",
+    log:
+        DATADIR / "logs" / "change_mask_{scenario}.log",
+    shell:
+        """
+        python3 {SRCDIR}/deltap/change_mask.py \
+            --diffmap {input.diffmap} \
+            --output {output} \
+            2>&1 | tee {log}
+        """
+
+
 # =============================================================================
 # Per-Species Delta P Calculation
 # =============================================================================
@@ -33,6 +63,8 @@ rule calculate_delta_p:
         current_sentinel=DATADIR / "aohs" / "current" / "{taxa}" / ".complete",
         scenario_sentinel=DATADIR / "aohs" / "{scenario}" / "{taxa}" / ".complete",
         pnv_sentinel=DATADIR / "aohs" / "pnv" / "{taxa}" / ".complete",
+        totals=DATADIR / "aohs" / "totals.parquet",
+        change_mask=DATADIR / "habitat" / "{scenario}_change_mask.tif",
     output:
         sentinel=DATADIR
         / "deltap"
@@ -42,6 +74,8 @@ rule calculate_delta_p:
         / ".{species_id}.done",
     log:
         DATADIR / "logs" / "deltap" / "{scenario}" / "{taxa}" / "{species_id}.log",
+    wildcard_constraints:
+        species_id="T[0-9]+A[0-9]+_[A-Z]+",
     params:
         current_path=lambda wildcards: DATADIR / "aohs" / "current" / wildcards.taxa,
         scenario_path=lambda wildcards: DATADIR
@@ -49,9 +83,13 @@ rule calculate_delta_p:
         / wildcards.scenario
         / wildcards.taxa,
         pnv_path=lambda wildcards: DATADIR / "aohs" / "pnv" / wildcards.taxa,
+        change_masks_dir=DATADIR / "habitat",
+        changed_tiles_only=config["delta_p_changed_tiles_only"],
+        precision=config["delta_p_precision"],
+        sparse=DELTA_P_SPARSE,
         taxon_id=lambda wildcards: wildcards.species_id.rsplit("_", 1)[0],
         season=lambda wildcards: wildcards.species_id.rsplit("_", 1)[1],
-        curve=CURVE,
+        curve=",".join([CURVE] + EXTRA_CURVES),
         output_tif=lambda wildcards: DATADIR
         / "deltap"
         / wildcards.scenario
@@ -63,61 +101,237 @@ rule calculate_delta_p:
 
 
 # =============================================================================
-# Per-Taxa Raster Sum
+# Batched Delta P Calculation
 # =============================================================================
 
 
-rule raster_sum_per_taxa:
+rule delta_p_manifest:
     """
-    Sum all per-species delta P rasters for a taxa into a single raster.
-    Implicitly waits for all calculate_delta_p jobs via direct tif dependencies.
+    Generate the list of species for which to calculate delta P for a taxa
+    under all the scenarios, used by the batched delta P calculation.
     """
     input:
-        rasters=get_delta_p_sentinels_for_taxa_scenario,
+        current_report=DATADIR / "species-info" / "{taxa}" / "current" / "report.csv",
     output:
-        tif=DATADIR / "deltap_sum" / "{scenario}" / CURVE / "{taxa}.tif",
+        manifest=DATADIR / "deltap" / "manifests" / CURVE / "{taxa}.csv",
     log:
-        DATADIR / "logs" / "raster_sum" / "{scenario}" / "{taxa}.log",
+        DATADIR / "logs" / "deltap" / "manifests" / "{taxa}.log",
+    params:
+        scenarios=" ".join(SCENARIOS),
+        extra_curves=(
+            f"--extra_curves {' '.join(EXTRA_CURVES)}" if EXTRA_CURVES else ""
+        ),
+    shell:
+        """
+        python3 {SRCDIR}/utils/persistencegenerator.py \
+            --datadir {DATADIR} \
+            --curve {CURVE} \
+            {params.extra_curves} \
+            --scenarios {params.scenarios} \
+            --taxa {wildcards.taxa} \
+            --output {output.manifest} \
+            2>&1 | tee {log}
+        """
+
+
+rule calculate_delta_p_batch:
+    """
+    Calculate the change in probability of persistence for one chunk of the
+    species in a taxa under all the scenarios. Each species still gets its own
+    output raster and sentinel per scenario, but all the species in the chunk are
+    processed by a single long lived process pool, and each species' current
+    AOH is read just once for all the scenarios.
+
+    If delta_p_fused is set then each chunk also sums its species' delta P into
+    a partial per taxa sum, which is stored in the partials directory.
+    """
+    input:
+        manifest=DATADIR / "deltap" / "manifests" / CURVE / "{taxa}.csv",
+        current_sentinel=DATADIR / "aohs" / "current" / "{taxa}" / ".complete",
+        scenario_sentinels=expand(
+            str(DATADIR / "aohs" / "{scenario}" / "{{taxa}}" / ".complete"),
+            scenario=SCENARIOS,
+        ),
+        pnv_sentinel=DATADIR / "aohs" / "pnv" / "{taxa}" / ".complete",
+        totals=DATADIR / "aohs" / "totals.parquet",
+        change_masks=expand(
+            str(DATADIR / "habitat" / "{scenario}_change_mask.tif"),
+            scenario=SCENARIOS,
+        ),
+        diffmaps=expand(
+            str(DATADIR / "habitat" / "{scenario}_diff_area.tif"),
+            scenario=SCENARIOS,
+        ),
+    output:
+        sentinels=expand(
+            str(
+                DATADIR
+                / "deltap"
+                / "{scenario}"
+                / CURVE
+                / "{{taxa}}"
+                / ".chunk_{{chunk}}.done"
+            ),
+            scenario=SCENARIOS,
+        ),
+    log:
+        DATADIR / "logs" / "deltap" / "batch" / "{taxa}" / "chunk_{chunk}.log",
+    wildcard_constraints:
+        chunk="[0-9]+",
     threads: workflow.cores
     params:
-        rasters_dir=lambda wildcards: DATADIR
-        / "deltap"
-        / wildcards.scenario
-        / CURVE
-        / wildcards.taxa,
-        curve=CURVE,
+        chunk=lambda wildcards: int(wildcards.chunk),
+        chunks=DELTA_P_CHUNKS,
+        change_masks_dir=DATADIR / "habitat",
+        changed_tiles_only=config["delta_p_changed_tiles_only"],
+        precision=config["delta_p_precision"],
+        sparse=DELTA_P_SPARSE,
+        # All the scenario diff maps share the same pixel grid, so any one of them
+        # can be used as the reference for the accumulated sums.
+        reference=lambda wildcards, input: input.diffmaps[0] if DELTA_P_FUSED else None,
+        accumulate=DELTA_P_FUSED,
+        write_rasters=not DELTA_P_FUSED or config["delta_p_species_rasters"],
     script:
-        str(SRCDIR / "utils" / "raster_sum.py")
+        str(SRCDIR / "deltap" / "global_code_residents_pixel_batch.py")
 
 
 # =============================================================================
-# Species Totals
+# Per-Taxa Raster Sum
 # =============================================================================
 
 
-def get_all_delta_p_tifs_for_scenario(wildcards):
-    tifs = []
-    for taxa in TAXA:
-        mock = SimpleNamespace(taxa=taxa, scenario=wildcards.scenario)
-        tifs.extend(get_delta_p_sentinels_for_taxa_scenario(mock))
-    return tifs
+def get_delta_p_rasters_dir(wildcards):
+    # In fused mode we only need to sum the partial sums from each chunk, and
+    # in sparse mode we sum the sparse store rather than per species rasters
+    if DELTA_P_FUSED:
+        subdir = "partials"
+    elif DELTA_P_SPARSE:
+        subdir = "store"
+    else:
+        subdir = ""
+    return DATADIR / "deltap" / wildcards.scenario / CURVE / wildcards.taxa / subdir
+
+
+def get_raster_sum_shards_dir(wildcards):
+    return (
+        DATADIR / "deltap_sum" / wildcards.scenario / CURVE / "shards" / wildcards.taxa
+    )
+
+
+def get_raster_sum_ledger_dir(wildcards):
+    return (
+        DATADIR / "deltap_sum" / wildcards.scenario / CURVE / ".ledger" / wildcards.taxa
+    )
+
+
+def get_raster_sum_inputs(wildcards):
+    if DELTA_P_SUM_SHARDS:
+        return [
+            get_raster_sum_shards_dir(wildcards) / f".shard_{shard}.done"
+            for shard in range(DELTA_P_SUM_SHARDS)
+        ]
+    return get_delta_p_sentinels_for_taxa_scenario(wildcards)
+
+
+rule raster_sum_shard:
+    """
+    Sum one shard of the per-species delta P rasters for a taxa, so that the
+    per taxa sum can be spread over several jobs, and so several nodes. A shard
+    with no species writes no raster.
+    """
+    input:
+        rasters=get_delta_p_sentinels_for_taxa_scenario,
+    output:
+        sentinel=DATADIR
+        / "deltap_sum"
+        / "{scenario}"
+        / CURVE
+        / "shards"
+        / "{taxa}"
+        / ".shard_{shard}.done",
+    log:
+        DATADIR / "logs" / "raster_sum" / "{scenario}" / "{taxa}_shard_{shard}.log",
+    wildcard_constraints:
+        shard="[0-9]+",
+    threads: workflow.cores
+    params:
+        rasters_dir=get_delta_p_rasters_dir,
+        shards_dir=get_raster_sum_shards_dir,
+        shards=DELTA_P_SUM_SHARDS,
+        ledger_args=lambda wildcards: (
+            f"--ledger {get_raster_sum_ledger_dir(wildcards) / ('shard_' + wildcards.shard)}"
+            if config["delta_p_sum_ledger"]
+            else ""
+        ),
+        deterministic="--deterministic" if DELTA_P_DETERMINISTIC else "",
+    shell:
+        """
+        rm -f {params.shards_dir}/shard_{wildcards.shard}.tif {params.shards_dir}/shard_{wildcards.shard}.csv
+        # Remove shards left from a run with more of them, which the merge would otherwise add again
+        for stale in {params.shards_dir}/shard_*.tif {params.shards_dir}/shard_*.csv; do
+            index=$(basename "${{stale%.*}}")
+            index=${{index#shard_}}
+            if [ -e "$stale" ] && [ "$index" -ge {params.shards} ] 2>/dev/null; then
+                rm -f "$stale"
+            fi
+        done
+        python3 {SRCDIR}/utils/raster_sum.py \
+            --rasters_directory {params.rasters_dir} \
+            --output {params.shards_dir}/shard_{wildcards.shard}.tif \
+            --shard {wildcards.shard} \
+            --shards {params.shards} \
+            {params.ledger_args} \
+            {params.deterministic} \
+            -j {threads} \
+            2>&1 | tee {log}
+        touch {output.sentinel}
+        """
 
 
-rule species_totals:
+rule raster_sum_per_taxa:
     """
-    Count the number of species per taxa used in the delta P calculation.
-    Used by delta_p_scaled for normalisation.
+    Sum all per-species delta P rasters for a taxa into a single raster.
+    Implicitly waits for all calculate_delta_p jobs via direct tif dependencies.
+    If delta_p_sum_shards is set, this instead merges the shard sums.
+
+    Alongside the sum, a CSV records how many species were summed, and how
+    many the scenario left unchanged, which delta_p_scaled uses to normalise.
     """
     input:
-        rasters=get_all_delta_p_tifs_for_scenario,
+        rasters=get_raster_sum_inputs,
     output:
-        totals=DATADIR / "deltap" / "{scenario}" / CURVE / "totals.csv",
+        tif=DATADIR / "deltap_sum" / "{scenario}" / CURVE / "{taxa}.tif",
+        counts=DATADIR / "deltap_sum" / "{scenario}" / CURVE / "{taxa}.csv",
     log:
-        DATADIR / "logs" / "species_totals_{scenario}.log",
+        DATADIR / "logs" / "raster_sum" / "{scenario}" / "{taxa}.log",
+    threads: workflow.cores
     params:
-        deltaps_dir=lambda wildcards: DATADIR / "deltap" / wildcards.scenario / CURVE,
+        rasters_dir=lambda wildcards: (
+            get_raster_sum_shards_dir(wildcards)
+            if DELTA_P_SUM_SHARDS
+            else get_delta_p_rasters_dir(wildcards)
+        ),
+        curve=CURVE,
+        processes=lambda wildcards, threads: threads,
+        # The shards keep their own ledgers, and merging them is cheap
+        ledger_dir=lambda wildcards: (
+            get_raster_sum_ledger_dir(wildcards)
+            if config["delta_p_sum_ledger"] and not DELTA_P_SUM_SHARDS
+            else None
+        ),
+        deterministic=DELTA_P_DETERMINISTIC,
+        unchanged=lambda wildcards: DATADIR
+        / "deltap"
+        / wildcards.scenario
+        / CURVE
+        / wildcards.taxa
+        / "unchanged",
     script:
-        str(SRCDIR / "utils" / "species_totals.py")
+        (
+            str(SRCDIR / "deltap" / "delta_p_store.py")
+            if DELTA_P_SPARSE and not DELTA_P_FUSED
+            else str(SRCDIR / "utils" / "raster_sum.py")
+        )
 
 
 # =============================================================================
@@ -130,15 +344,19 @@ rule delta_p_scaled:
     Generate the final scaled delta P map for a scenario.
 
     Combines per-taxa delta P sums with the habitat difference map and
-    species totals to produce the final normalised LIFE output.
+    the species counts recorded with each sum to produce the final
+    normalised LIFE output.
     """
     input:
         taxa_rasters=expand(
             str(DATADIR / "deltap_sum" / "{{scenario}}" / CURVE / "{taxa}.tif"),
             taxa=TAXA,
         ),
+        taxa_counts=expand(
+            str(DATADIR / "deltap_sum" / "{{scenario}}" / CURVE / "{taxa}.csv"),
+            taxa=TAXA,
+        ),
         diffmap=DATADIR / "habitat" / "{scenario}_diff_area.tif",
-        totals=DATADIR / "deltap" / "{scenario}" / CURVE / "totals.csv",
     output:
         final=DATADIR / "deltap_final" / f"scaled_{{scenario}}_{CURVE}.tif",
     log:
@@ -147,3 +365,73 @@ rule delta_p_scaled:
         input_dir=lambda wildcards: DATADIR / "deltap_sum" / wildcards.scenario / CURVE,
     script:
         str(SRCDIR / "deltap" / "delta_p_scaled.py")
+
+
+rule delta_p_cog:
+    """
+    Write a Cloud Optimized GeoTIFF copy of the final scaled delta P map, with
+    internal tiles and overviews, compressed with the codec set by delta_p_cog
+    in the config. Web viewers and dashboards can then read any region or zoom
+    level with a handful of block reads rather than the whole file.
+    """
+    input:
+        final=DATADIR / "deltap_final" / f"scaled_{{scenario}}_{CURVE}.tif",
+    output:
+        cog=DATADIR / "deltap_final" / "cog" / f"scaled_{{scenario}}_{CURVE}.tif",
+    log:
+        DATADIR / "logs" / "delta_p_cog_{scenario}.log",
+    threads: workflow.cores
+    params:
+        codec=DELTA_P_COG,
+    shell:
+        """
+        gdal_translate \
+            -of COG \
+            -co COMPRESS={params.codec} \
+            -co PREDICTOR=YES \
+            -co BLOCKSIZE=512 \
+            -co OVERVIEWS=IGNORE_EXISTING \
+            -co RESAMPLING=AVERAGE \
+            -co BIGTIFF=IF_SAFER \
+            -co NUM_THREADS={threads} \
+            {input.final} \
+            {output.cog} \
+            2>&1 | tee {log}
+        """
+
+
+# =============================================================================
+# Delta P by Species Grouping
+# =============================================================================
+
+
+def get_delta_p_sentinels_for_scenario(wildcards):
+    return [
+        sentinel
+        for taxa in TAXA
+        for sentinel in get_delta_p_sentinels_for_taxa_scenario(
+            SimpleNamespace(scenario=wildcards.scenario, taxa=taxa)
+        )
+    ]
+
+
+rule delta_p_groups:
+    """
+    Sum the per-species delta P for a scenario by one of the species groupings
+    in the config, with a band per group, along with a CSV of the number of
+    species in each group. This needs the per species delta P, either as
+    rasters or in the sparse store.
+    """
+    input:
+        rasters=get_delta_p_sentinels_for_scenario,
+        groups=lambda wildcards: config["groupings"][wildcards.grouping],
+        totals=DATADIR / "aohs" / "totals.parquet",
+    output:
+        tif=DATADIR / "deltap_groups" / "{scenario}" / CURVE / "{grouping}.tif",
+        csv=DATADIR / "deltap_groups" / "{scenario}" / CURVE / "{grouping}.csv",
+    log:
+        DATADIR / "logs" / "delta_p_groups" / "{scenario}" / "{grouping}.log",
+    params:
+        deltap_dir=lambda wildcards: DATADIR / "deltap" / wildcards.scenario / CURVE,
+    script:
+        str(SRCDIR / "deltap" / "delta_p_groups.py")
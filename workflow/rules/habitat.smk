@@ -249,6 +249,7 @@ rule build_food_map:
     params:
         jung_dir=DATADIR / "100m" / "jung_current",
         output_dir=DATADIR / "100m" / "current",
+        strips=config["food_map_strips"],
     script:
         str(SRCDIR / "prepare_layers" / "make_food_current_map.py")
 